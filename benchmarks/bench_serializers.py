@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+"""
+Microbenchmark of the serialization methods of ``ExtendedDocument``,
+compares the compiled accessor plan with the previous per field
+``self._data.get`` implementation. No database is needed.
+
+Usage::
+
+    python benchmarks/bench_serializers.py
+"""
+
+from __future__ import print_function
+
+import timeit
+from collections import OrderedDict
+
+import mongoengine
+from mongoengine_mate import ExtendedDocument
+
+
+class Row(ExtendedDocument):
+    _id = mongoengine.IntField(primary_key=True)
+    f1 = mongoengine.StringField()
+    f2 = mongoengine.IntField()
+    f3 = mongoengine.FloatField()
+    f4 = mongoengine.StringField()
+    f5 = mongoengine.IntField()
+    f6 = mongoengine.StringField()
+    f7 = mongoengine.IntField()
+    f8 = mongoengine.StringField()
+    f9 = mongoengine.FloatField()
+
+
+# --- the implementation before the accessor plan ---
+def old_items(doc):
+    return [(attr, doc._data.get(attr)) for attr in doc._fields_ordered]
+
+
+def old_values(doc):
+    return [doc._data.get(attr) for attr in doc._fields_ordered]
+
+
+def old_to_dict(doc, include_none=True):
+    if include_none:
+        return dict(old_items(doc))
+    else:
+        return {
+            key: value
+            for key, value in old_items(doc)
+            if value is not None
+        }
+
+
+def old_to_OrderedDict(doc):
+    return OrderedDict(old_items(doc))
+
+
+def make_docs(n):
+    return [
+        Row._from_son({
+            "_id": i, "f1": "a", "f2": i, "f3": 1.5, "f4": None,
+            "f5": i, "f6": "b", "f7": None, "f8": "c", "f9": 0.5,
+        })
+        for i in range(n)
+    ]
+
+
+def bench(title, func, docs, repeat=10):
+    elapsed = min(timeit.repeat(lambda: func(docs), number=1, repeat=repeat))
+    rate = len(docs) / elapsed
+    print("%-40s %12.0f docs/sec" % (title, rate))
+    return rate
+
+
+def main(n=20000):
+    docs = make_docs(n)
+    pairs = [
+        (
+            "values",
+            lambda docs: [old_values(doc) for doc in docs],
+            lambda docs: [doc.values() for doc in docs],
+        ),
+        (
+            "items",
+            lambda docs: [old_items(doc) for doc in docs],
+            lambda docs: [doc.items() for doc in docs],
+        ),
+        (
+            "to_OrderedDict",
+            lambda docs: [old_to_OrderedDict(doc) for doc in docs],
+            lambda docs: [doc.to_OrderedDict() for doc in docs],
+        ),
+        (
+            "to_dict(include_none=True)",
+            lambda docs: [old_to_dict(doc) for doc in docs],
+            lambda docs: [doc.to_dict() for doc in docs],
+        ),
+        (
+            "to_dict(include_none=False)",
+            lambda docs: [old_to_dict(doc, False) for doc in docs],
+            lambda docs: [doc.to_dict(False) for doc in docs],
+        ),
+        (
+            "to_dicts(include_none=True)",
+            lambda docs: [old_to_dict(doc) for doc in docs],
+            lambda docs: Row.to_dicts(docs),
+        ),
+        (
+            "to_dicts(include_none=False)",
+            lambda docs: [old_to_dict(doc, False) for doc in docs],
+            lambda docs: Row.to_dicts(docs, include_none=False),
+        ),
+    ]
+    for title, old_func, new_func in pairs:
+        old_rate = bench("old %s" % title, old_func, docs)
+        new_rate = bench("new %s" % title, new_func, docs)
+        print("%-40s %12.2fx" % ("speedup", new_rate / old_rate))
+
+
+if __name__ == "__main__":
+    main()
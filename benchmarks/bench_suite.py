@@ -0,0 +1,502 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark suite of ``smart_insert``, ``smart_update``, ``by_id`` and
+``random_sample``. It runs against a local mongod or an in-memory mongomock
+stand-in, parametrized by batch size, duplicate ratio, document width and
+strategy, and records throughput and latency percentiles to JSON. The
+compare mode flags the cases regressed between two runs.
+
+Usage::
+
+    # against mongomock (pip install mongomock)
+    python benchmarks/bench_suite.py run --output base.json
+
+    # against a local mongod, only the smart_insert cases, small grid
+    python benchmarks/bench_suite.py run --backend mongod \\
+        --host mongodb://localhost:27017 --only smart_insert --quick \\
+        --output new.json
+
+    # exit with code 1 if any case is more than 10% slower
+    python benchmarks/bench_suite.py compare base.json new.json --threshold 0.1
+
+Numbers from mongomock measure the python side overhead only, compare runs
+of the same backend.
+
+Each case records throughput and p50 of every repeat. Compare takes the best
+repeat of the new run and flags it only when it falls outside the min..max
+range of the base repeats widened by the threshold, so run to run noise is
+not reported as regression. The range needs samples to be meaningful, use
+``--repeat 5`` or more for both runs, the default 3 (2 with ``--quick``) only
+catches large slow downs.
+"""
+
+from __future__ import print_function
+
+import sys
+import json
+import random
+import argparse
+import datetime
+import itertools
+from timeit import default_timer
+from collections import OrderedDict
+
+import pymongo
+import mongoengine
+from mongoengine_mate import ExtendedDocument
+
+DB_NAME = "mongoengine_mate_bench"
+
+FULL_GRID = dict(
+    repeat=3,
+    n_batches=10,
+    batch_size=[100, 1000],
+    dup_ratio=[0.0, 0.1, 0.5],
+    width=[5, 20],
+    insert_strategy=["recursive", "unordered", "adaptive"],
+    update_strategy=["one_by_one", "bulk", "precheck", "changed"],
+    cache=[False, True],
+    n_sample=[5, 100],
+    sample_strategy=["sample", "reservoir", "random_field"],
+    collection_size=10000,
+)
+
+QUICK_GRID = dict(
+    repeat=2,
+    n_batches=3,
+    batch_size=[100],
+    dup_ratio=[0.0, 0.5],
+    width=[5],
+    insert_strategy=["recursive", "unordered", "adaptive"],
+    update_strategy=["one_by_one", "bulk", "precheck", "changed"],
+    cache=[False, True],
+    n_sample=[5],
+    sample_strategy=["sample", "reservoir", "random_field"],
+    collection_size=1000,
+)
+
+
+# --- Document ---
+_row_classes = dict()
+
+
+def get_row_class(width, cache=False):
+    """
+    Create a document class with ``width`` data fields, once per
+    ``(width, cache)``.
+    """
+    key = (width, cache)
+    if key not in _row_classes:
+        name = "BenchRowW%s%s" % (width, "Cached" if cache else "")
+        attrs = OrderedDict()
+        attrs["_id"] = mongoengine.IntField(primary_key=True)
+        attrs["rand"] = mongoengine.FloatField()
+        for i in range(width):
+            if i % 2:
+                attrs["f%s" % i] = mongoengine.IntField()
+            else:
+                attrs["f%s" % i] = mongoengine.StringField()
+        meta = {
+            "collection": name.lower(),
+            "random_field": "rand",
+            "indexes": ["rand"],
+        }
+        if cache:
+            meta["cache"] = {"max_size": 100000}
+        attrs["meta"] = meta
+        _row_classes[key] = type(str(name), (ExtendedDocument,), attrs)
+    return _row_classes[key]
+
+
+def make_docs(row_class, ids, width, rng, version=0):
+    docs = list()
+    for _id in ids:
+        kwargs = {"_id": _id, "rand": rng.random()}
+        for i in range(width):
+            if i % 2:
+                kwargs["f%s" % i] = _id + version
+            else:
+                kwargs["f%s" % i] = "v%s-%s" % (version, _id)
+        docs.append(row_class(**kwargs))
+    return docs
+
+
+def mutate_docs(docs, width, version):
+    """
+    Change the data fields of loaded documents in place, the same values
+    as ``make_docs(..., version=version)``.
+    """
+    for doc in docs:
+        for i in range(width):
+            if i % 2:
+                setattr(doc, "f%s" % i, doc.pk + version)
+            else:
+                setattr(doc, "f%s" % i, "v%s-%s" % (version, doc.pk))
+    return docs
+
+
+def reset(row_class):
+    """
+    Empty the collection, clear the cache and the learned adaptive insert
+    parameters, so every repeat starts from the same state.
+    """
+    row_class.col().delete_many({})
+    if row_class._get_id_cache() is not None:
+        row_class._invalidate_cache()
+    if "_insert_tuner" in row_class.__dict__:
+        delattr(row_class, "_insert_tuner")
+
+
+def pick_existing(ids, dup_ratio, rng):
+    return rng.sample(ids, int(len(ids) * dup_ratio))
+
+
+# --- Measurement ---
+def percentile(sorted_values, p):
+    """
+    Linear interpolated percentile of a sorted list, ``p`` in [0, 100].
+    """
+    if not sorted_values:
+        return None
+    k = (len(sorted_values) - 1) * p / 100.0
+    lower = int(k)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + \
+        (sorted_values[upper] - sorted_values[lower]) * (k - lower)
+
+
+def _throughput(n_items, latencies):
+    total = sum(latencies)
+    return n_items / total if total else None
+
+
+def summarize(name, params, runs):
+    """
+    :type runs: List[Tuple[int, List[float]]]
+    :param runs: ``(n_items, latencies)`` of each repeat.
+    """
+    n_items = sum(n for n, _ in runs)
+    latencies = sorted(itertools.chain.from_iterable(l for _, l in runs))
+    return OrderedDict([
+        ("name", name),
+        ("params", OrderedDict(sorted(params.items()))),
+        ("n_calls", len(latencies)),
+        ("n_items", n_items),
+        ("throughput", _throughput(n_items, latencies)),
+        ("latency", OrderedDict([
+            ("min", latencies[0]),
+            ("p50", percentile(latencies, 50)),
+            ("p90", percentile(latencies, 90)),
+            ("p99", percentile(latencies, 99)),
+            ("max", latencies[-1]),
+        ])),
+        # per repeat numbers, the spread is the noise estimate of compare
+        ("repeats", [
+            OrderedDict([
+                ("throughput", _throughput(n, l)),
+                ("p50", percentile(sorted(l), 50)),
+            ])
+            for n, l in runs
+        ]),
+    ])
+
+
+def timed(func, *args, **kwargs):
+    st = default_timer()
+    func(*args, **kwargs)
+    return default_timer() - st
+
+
+# --- Cases ---
+def bench_smart_insert(grid, rng):
+    for width, batch_size, dup_ratio, strategy in itertools.product(
+            grid["width"], grid["batch_size"],
+            grid["dup_ratio"], grid["insert_strategy"]):
+        row_class = get_row_class(width)
+        runs = list()
+        for _ in range(grid["repeat"]):
+            latencies = list()
+            n_items = 0
+            reset(row_class)
+            batches = list()
+            for i in range(grid["n_batches"]):
+                ids = list(range(i * batch_size, (i + 1) * batch_size))
+                existing = pick_existing(ids, dup_ratio, rng)
+                if existing:
+                    row_class.smart_insert(
+                        make_docs(row_class, existing, width, rng))
+                batches.append(make_docs(row_class, ids, width, rng))
+            for docs in batches:
+                latencies.append(
+                    timed(row_class.smart_insert, docs, strategy=strategy))
+                n_items += len(docs)
+            runs.append((n_items, latencies))
+        params = dict(width=width, batch_size=batch_size,
+                      dup_ratio=dup_ratio, strategy=strategy)
+        yield summarize("smart_insert", params, runs)
+
+
+def bench_smart_update(grid, rng):
+    for width, batch_size, dup_ratio, strategy in itertools.product(
+            grid["width"], grid["batch_size"],
+            grid["dup_ratio"], grid["update_strategy"]):
+        row_class = get_row_class(width)
+        runs = list()
+        for _ in range(grid["repeat"]):
+            latencies = list()
+            n_items = 0
+            reset(row_class)
+            batches = list()
+            for i in range(grid["n_batches"]):
+                ids = list(range(i * batch_size, (i + 1) * batch_size))
+                existing = pick_existing(ids, dup_ratio, rng)
+                if existing:
+                    row_class.smart_insert(
+                        make_docs(row_class, existing, width, rng))
+                # existing documents are loaded and modified, as a real
+                # application does, so "changed" can track the changes
+                loaded = {
+                    doc.pk: doc
+                    for doc in mutate_docs(
+                        row_class.by_ids(existing), width, version=1)
+                }
+                new_docs = make_docs(
+                    row_class,
+                    [_id for _id in ids if _id not in loaded],
+                    width, rng, version=1,
+                )
+                new_docs.reverse()
+                batches.append([
+                    loaded[_id] if _id in loaded else new_docs.pop()
+                    for _id in ids
+                ])
+            for docs in batches:
+                latencies.append(timed(
+                    row_class.smart_update, docs,
+                    upsert=True, strategy=strategy, batch_size=batch_size,
+                ))
+                n_items += len(docs)
+            runs.append((n_items, latencies))
+        params = dict(width=width, batch_size=batch_size,
+                      dup_ratio=dup_ratio, strategy=strategy)
+        yield summarize("smart_update", params, runs)
+
+
+def bench_by_id(grid, rng):
+    for width, cache in itertools.product(grid["width"], grid["cache"]):
+        row_class = get_row_class(width, cache=cache)
+        reset(row_class)
+        ids = list(range(grid["collection_size"]))
+        row_class.smart_insert(make_docs(row_class, ids, width, rng))
+        # 10% hot keys receive most lookups, to make the cache matter
+        hot_ids = ids[:max(len(ids) // 10, 1)]
+        n_lookups = grid["n_batches"] * max(grid["batch_size"])
+        runs = list()
+        for _ in range(grid["repeat"]):
+            latencies = list()
+            for _ in range(n_lookups):
+                if rng.random() < 0.8:
+                    _id = rng.choice(hot_ids)
+                else:
+                    _id = rng.choice(ids)
+                latencies.append(timed(row_class.by_id, _id))
+            runs.append((len(latencies), latencies))
+        params = dict(width=width, cache=cache)
+        yield summarize("by_id", params, runs)
+
+
+def bench_random_sample(grid, rng):
+    for width in grid["width"]:
+        row_class = get_row_class(width)
+        reset(row_class)
+        ids = list(range(grid["collection_size"]))
+        row_class.smart_insert(make_docs(row_class, ids, width, rng))
+        for n, strategy in itertools.product(
+                grid["n_sample"], grid["sample_strategy"]):
+            runs = list()
+            for _ in range(grid["repeat"]):
+                latencies = [
+                    timed(row_class.random_sample, n=n, strategy=strategy)
+                    for _ in range(grid["n_batches"])
+                ]
+                runs.append((n * len(latencies), latencies))
+            params = dict(width=width, n=n, strategy=strategy)
+            yield summarize("random_sample", params, runs)
+
+
+CASES = OrderedDict([
+    ("smart_insert", bench_smart_insert),
+    ("smart_update", bench_smart_update),
+    ("by_id", bench_by_id),
+    ("random_sample", bench_random_sample),
+])
+
+
+# --- Command ---
+def connect(backend, host):
+    if backend == "mongomock":
+        import mongomock
+        mongoengine.connect(
+            DB_NAME,
+            host="mongodb://localhost",
+            mongo_client_class=mongomock.MongoClient,
+        )
+    else:
+        mongoengine.connect(DB_NAME, host=host)
+
+
+def run(args):
+    connect(args.backend, args.host)
+    grid = dict(QUICK_GRID if args.quick else FULL_GRID)
+    if args.repeat:
+        grid["repeat"] = args.repeat
+    results = list()
+    try:
+        for name, bench in CASES.items():
+            if args.only and name not in args.only:
+                continue
+            # same data for a case no matter which other cases run
+            rng = random.Random("%s-%s" % (args.seed, name))
+            for result in bench(grid, rng):
+                print("%-14s %-70s %12.0f items/sec  p50 %8.2f ms" % (
+                    result["name"],
+                    json.dumps(result["params"]),
+                    result["throughput"] or 0,
+                    result["latency"]["p50"] * 1000,
+                ))
+                results.append(result)
+    finally:
+        for row_class in _row_classes.values():
+            row_class.col().drop()
+
+    report = OrderedDict([
+        ("meta", OrderedDict([
+            ("created_at", datetime.datetime.utcnow().isoformat()),
+            ("backend", args.backend),
+            ("quick", args.quick),
+            ("repeat", grid["repeat"]),
+            ("seed", args.seed),
+            ("python", sys.version.split()[0]),
+            ("mongoengine", mongoengine.__version__),
+            ("pymongo", pymongo.version),
+        ])),
+        ("results", results),
+    ])
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+    return 0
+
+
+def case_id(result):
+    return "%s %s" % (result["name"], json.dumps(result["params"], sort_keys=True))
+
+
+def spread(result):
+    """
+    Throughput and p50 of each repeat of a case. Results written before the
+    per repeat numbers were recorded give a single value.
+    """
+    repeats = result.get("repeats") or [
+        {"throughput": result["throughput"], "p50": result["latency"]["p50"]}
+    ]
+    return (
+        [repeat["throughput"] for repeat in repeats],
+        [repeat["p50"] for repeat in repeats],
+    )
+
+
+def noise(values):
+    """
+    Half of the relative min..max range.
+    """
+    mid = (max(values) + min(values)) / 2.0
+    return (max(values) - min(values)) / 2.0 / mid if mid else 0.0
+
+
+def compare(args):
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    if base["meta"]["backend"] != new["meta"]["backend"]:
+        print("warning: comparing %s run with %s run" % (
+            base["meta"]["backend"], new["meta"]["backend"]))
+
+    base_results = OrderedDict(
+        (case_id(result), result) for result in base["results"])
+    regressions = list()
+    for result in new["results"]:
+        key = case_id(result)
+        if key not in base_results:
+            print("%-90s %s" % (key, "new case"))
+            continue
+        base_throughput, base_p50 = spread(base_results.pop(key))
+        new_throughput, new_p50 = spread(result)
+        # best new repeat against the worst base repeat
+        throughput_ratio = max(new_throughput) / min(base_throughput)
+        p50_ratio = min(new_p50) / max(base_p50)
+        regressed = throughput_ratio < 1 - args.threshold \
+            or p50_ratio > 1 + args.threshold
+        if regressed:
+            regressions.append(key)
+        print("%-90s throughput %6.2fx (base +-%4.1f%%)  "
+              "p50 %6.2fx (base +-%4.1f%%)  %s" % (
+                  key,
+                  throughput_ratio, noise(base_throughput) * 100,
+                  p50_ratio, noise(base_p50) * 100,
+                  "REGRESSION" if regressed else "ok",
+              ))
+    for key in base_results:
+        print("%-90s %s" % (key, "missing in new run"))
+
+    print("%s regression(s), threshold %.0f%% beyond the base range" % (
+        len(regressions), args.threshold * 100))
+    for run_name, report in (("base", base), ("new", new)):
+        repeat = report["meta"].get("repeat")
+        if repeat is not None and repeat < 5:
+            print("warning: %s run has %s repeats, use --repeat 5 or more "
+                  "for a reliable noise range" % (run_name, repeat))
+    return 1 if regressions else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n\n")[0])
+    subparsers = parser.add_subparsers(dest="command")
+
+    run_parser = subparsers.add_parser("run", help="run the benchmark")
+    run_parser.add_argument(
+        "--backend", choices=["mongomock", "mongod"], default="mongomock")
+    run_parser.add_argument("--host", default="mongodb://localhost:27017")
+    run_parser.add_argument("--output", help="write result to this json file")
+    run_parser.add_argument(
+        "--only", nargs="+", choices=list(CASES), help="only run these cases")
+    run_parser.add_argument(
+        "--quick", action="store_true", help="run a smaller grid")
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument(
+        "--repeat", type=int,
+        help="number of repeats per case, use 5 or more for compare")
+
+    compare_parser = subparsers.add_parser(
+        "compare", help="compare two results, exit 1 on regression")
+    compare_parser.add_argument("base")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument(
+        "--threshold", type=float, default=0.1,
+        help="relative slow down beyond the base min..max range to flag "
+             "as regression, default 0.1")
+
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        return run(args)
+    elif args.command == "compare":
+        return compare(args)
+    else:
+        parser.print_help()
+        return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
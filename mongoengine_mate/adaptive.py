@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+
+"""
+Learn the duplicate density and the round trip cost of inserting into a
+collection, and plan the batch size of ``smart_insert(strategy="adaptive")``.
+"""
+
+import math
+import threading
+
+
+class InsertPlan(object):
+    """
+    :param strategy: "bulk", "precheck" or "one_by_one".
+    :param batch_size: number of documents per round trip.
+    """
+    __slots__ = ("strategy", "batch_size")
+
+    def __init__(self, strategy, batch_size):
+        self.strategy = strategy
+        self.batch_size = batch_size
+
+    def to_dict(self):
+        return dict(strategy=self.strategy, batch_size=self.batch_size)
+
+    def __repr__(self):
+        return "InsertPlan(strategy=%r, batch_size=%r)" % (
+            self.strategy, self.batch_size)
+
+
+class InsertTuner(object):
+    """
+    Online estimator of:
+
+    - ``dup_rate``: fraction of duplicate documents, from the recently
+      examined documents, by the server or by the precheck query.
+    - ``latency``, ``doc_cost``: the fixed seconds per round trip and the
+      seconds per document sent, from an exponentially weighted least
+      square fit of ``elapsed = latency + doc_cost * n_documents`` of the
+      insert round trips.
+    - ``query_cost``: seconds per ``_id`` of the precheck query, including
+      its round trip.
+
+    An ordered bulk insert stops at the first duplicate, the documents after
+    it are sent again in the next round trip. With duplicate rate ``p`` and
+    batch size ``B``, the cost per document is about::
+
+        latency * (1 / B + p) + doc_cost * (1 + p * B / 2)
+
+    which is minimal at ``B = sqrt(2 * latency / (p * doc_cost))``. Large
+    batches when duplicates are rare or the round trip is expensive, small
+    batches when duplicates are dense. Until the fit can tell ``doc_cost``,
+    which needs round trips of different sizes, ``B = 1 / p``, the expected
+    number of documents until the next duplicate. If the ``_id`` of all
+    documents are known, "precheck" (find the existing ``_id`` first, then
+    insert the others) costs::
+
+        query_cost + latency / max_batch_size + doc_cost * (1 - p)
+
+    and is used when it is cheaper. Before any precheck is observed,
+    ``query_cost`` is assumed to be one insert round trip per
+    ``max_batch_size`` ids.
+
+    :type max_batch_size: int
+    :param max_batch_size: upper bound of batch size.
+
+    :type decay: float
+    :param decay: weight of the previous observations after every
+        ``max_batch_size`` documents examined or sent, smaller adapts
+        faster. The weight doesn't depend on the number of round trips, so
+        a batch stopped by many duplicates doesn't wipe out the history.
+
+    **中文文档**
+
+    在线地估计一个 collection 的重复文档比例, 每次网络往返的固定延迟, 以及每个文档
+    的传输开销, 并以此决定每批插入的文档数量。重复少或者延迟高时使用大批量, 重复多
+    时使用小批量, 在能够预知 ``_id`` 时, 如果先查询已存在的 ``_id`` 更划算, 则使用
+    "precheck" 策略。
+    """
+
+    def __init__(self, max_batch_size=1000, decay=0.9):
+        self.max_batch_size = max_batch_size
+        self.decay = decay
+        self.n_round_trips = 0
+        self.last_plan = None
+        # decayed sums of duplicate and examined documents
+        self._dup = 0.0
+        self._examined = 0.0
+        # decayed sums for least square fit of elapsed = a + b * n
+        self._w = 0.0
+        self._sn = 0.0
+        self._st = 0.0
+        self._snn = 0.0
+        self._snt = 0.0
+        # decayed sums of precheck ids and seconds
+        self._qn = 0.0
+        self._qt = 0.0
+        self._lock = threading.Lock()
+
+    def _decay(self, n):
+        """
+        Weight of the previous observations after ``n`` documents.
+        """
+        return self.decay ** (float(n) / self.max_batch_size)
+
+    def _observe_dup(self, n_examined, n_dup):
+        decay = self._decay(n_examined)
+        self._dup = self._dup * decay + n_dup
+        self._examined = self._examined * decay + n_examined
+
+    def observe(self, n_sent, n_examined, n_dup, elapsed):
+        """
+        Record one insert round trip.
+
+        :type n_sent: int
+        :param n_sent: number of documents sent.
+
+        :type n_examined: int
+        :param n_examined: number of documents checked for duplicate, an
+            ordered insert stops at the first duplicate.
+
+        :type n_dup: int
+        :param n_dup: number of duplicate documents found.
+
+        :type elapsed: float
+        :param elapsed: seconds of the round trip.
+        """
+        with self._lock:
+            self.n_round_trips += 1
+            self._observe_dup(n_examined, n_dup)
+            decay = self._decay(n_sent)
+            self._w = self._w * decay + 1
+            self._sn = self._sn * decay + n_sent
+            self._st = self._st * decay + elapsed
+            self._snn = self._snn * decay + n_sent * n_sent
+            self._snt = self._snt * decay + n_sent * elapsed
+
+    def observe_precheck(self, n_checked, n_dup, elapsed):
+        """
+        Record one precheck query, it updates the duplicate rate and the
+        query cost, but not the insert cost.
+
+        :type n_checked: int
+        :param n_checked: number of ``_id`` queried.
+
+        :type n_dup: int
+        :param n_dup: number of existing ``_id``.
+
+        :type elapsed: float
+        :param elapsed: seconds of the query.
+        """
+        with self._lock:
+            self._observe_dup(n_checked, n_dup)
+            decay = self._decay(n_checked)
+            self._qn = self._qn * decay + n_checked
+            self._qt = self._qt * decay + elapsed
+
+    @property
+    def dup_rate(self):
+        """
+        :rtype: float
+        """
+        if self._examined == 0:
+            return 0.0
+        return self._dup / self._examined
+
+    def _fit(self):
+        """
+        :rtype: Tuple[float, float]
+        :return: latency and doc_cost.
+        """
+        if self._w == 0:
+            return 0.0, 0.0
+        mean_n = self._sn / self._w
+        mean_t = self._st / self._w
+        var_n = self._snn / self._w - mean_n * mean_n
+        if var_n <= 1e-9:  # all round trips have the same size
+            return mean_t, 0.0
+        doc_cost = (self._snt / self._w - mean_n * mean_t) / var_n
+        doc_cost = max(doc_cost, 0.0)
+        latency = max(mean_t - doc_cost * mean_n, 0.0)
+        return latency, doc_cost
+
+    @property
+    def latency(self):
+        """
+        Estimated fixed seconds per round trip.
+
+        :rtype: float
+        """
+        return self._fit()[0]
+
+    @property
+    def doc_cost(self):
+        """
+        Estimated seconds per document sent.
+
+        :rtype: float
+        """
+        return self._fit()[1]
+
+    @property
+    def query_cost(self):
+        """
+        Estimated seconds per ``_id`` of the precheck query, None if no
+        precheck is observed.
+
+        :rtype: float
+        """
+        if self._qn == 0:
+            return None
+        return self._qt / self._qn
+
+    def _batch_size(self, n, p, latency, doc_cost):
+        upper = self.max_batch_size if n is None else min(n, self.max_batch_size)
+        if p == 0:
+            return max(upper, 1)
+        if doc_cost == 0:  # unknown, expected distance to next duplicate
+            size = int(1.0 / p)
+        else:
+            size = int(math.sqrt(2 * latency / (p * doc_cost)))
+        return max(min(size, upper), 1)
+
+    def batch_size(self, n=None):
+        """
+        Batch size of ordered bulk insert.
+
+        :type n: int
+        :param n: number of documents to insert, the upper bound.
+
+        :rtype: int
+        """
+        with self._lock:
+            p = self.dup_rate
+            latency, doc_cost = self._fit()
+        return self._batch_size(n, p, latency, doc_cost)
+
+    def plan(self, n, has_ids=False):
+        """
+        Plan the insert of ``n`` documents.
+
+        :type n: int
+        :type has_ids: bool
+        :param has_ids: if the ``_id`` of all documents are known.
+
+        :rtype: InsertPlan
+        """
+        with self._lock:
+            p = self.dup_rate
+            latency, doc_cost = self._fit()
+            query_cost = self.query_cost
+        batch_size = self._batch_size(n, p, latency, doc_cost)
+        if has_ids and p > 0:
+            bulk_cost = latency * (1.0 / batch_size + p) \
+                + doc_cost * (1 + p * batch_size / 2.0)
+            precheck_size = max(min(n, self.max_batch_size), 1)
+            if query_cost is None:
+                query_cost = latency / self.max_batch_size
+            precheck_cost = query_cost \
+                + latency / precheck_size \
+                + doc_cost * (1 - p)
+            if precheck_cost < bulk_cost:
+                plan = InsertPlan("precheck", precheck_size)
+                self.last_plan = plan
+                return plan
+        if batch_size == 1:
+            plan = InsertPlan("one_by_one", 1)
+        else:
+            plan = InsertPlan("bulk", batch_size)
+        self.last_plan = plan
+        return plan
+
+    def info(self):
+        """
+        Return the learned parameters and the last plan.
+
+        :rtype: dict
+        """
+        with self._lock:
+            latency, doc_cost = self._fit()
+            return dict(
+                dup_rate=self.dup_rate,
+                latency=latency,
+                doc_cost=doc_cost,
+                query_cost=self.query_cost,
+                n_round_trips=self.n_round_trips,
+                max_batch_size=self.max_batch_size,
+                decay=self.decay,
+                last_plan=None if self.last_plan is None
+                else self.last_plan.to_dict(),
+            )
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+"""
+A thread safe in-process cache with size bound, TTL and hit / miss /
+eviction counters, used by the read helpers of
+:class:`~mongoengine_mate.document.ExtendedDocument`.
+"""
+
+import threading
+from collections import OrderedDict
+from timeit import default_timer
+
+#: returned by :meth:`LRUCache.get` when key is not in the cache
+MISSING = object()
+
+
+class LRUCache(object):
+    """
+    A size bounded cache with optional TTL.
+
+    :type max_size: int
+    :param max_size: max number of entries, the oldest entry is evicted
+        when it is full.
+
+    :type ttl: Union[int, float, None]
+    :param ttl: time to live in seconds, None means never expire.
+
+    :type policy: str
+    :param policy: "lru" (least recently used is evicted first) or "fifo"
+        (first inserted is evicted first).
+
+    **中文文档**
+
+    一个线程安全的缓存, 支持容量上限, 过期时间, 以及 LRU 和 FIFO 两种淘汰策略。
+    并且记录命中, 未命中, 淘汰, 失效的次数, 用于监控。
+    """
+
+    def __init__(self, max_size=1000, ttl=None, policy="lru"):
+        if policy not in ("lru", "fifo"):
+            raise ValueError("unknown cache policy: %r" % policy)
+        self.max_size = max_size
+        self.ttl = ttl
+        self.policy = policy
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._data = OrderedDict()  # key -> (expire_at, value)
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, count=False) is not MISSING
+
+    def get(self, key, count=True):
+        """
+        Get the value of a key, return :data:`MISSING` if the key is not
+        in the cache or expired.
+
+        :param count: if False, not update the hit / miss counter.
+        """
+        with self._lock:
+            try:
+                expire_at, value = self._data[key]
+            except KeyError:
+                if count:
+                    self.misses += 1
+                return MISSING
+            if expire_at is not None and expire_at <= default_timer():
+                del self._data[key]
+                self._on_remove(key, value)
+                if count:
+                    self.misses += 1
+                return MISSING
+            if self.policy == "lru":
+                self._data[key] = self._data.pop(key)
+            if count:
+                self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """
+        Put a value in the cache, evict the oldest entries if it is full.
+        """
+        with self._lock:
+            if self.ttl is None:
+                expire_at = None
+            else:
+                expire_at = default_timer() + self.ttl
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._on_remove(key, old[1])
+            self._data[key] = (expire_at, value)
+            while len(self._data) > self.max_size:
+                evicted_key, (_, evicted_value) = self._data.popitem(last=False)
+                self._on_remove(evicted_key, evicted_value)
+                self.evictions += 1
+
+    def delete(self, key):
+        """
+        Invalidate a key.
+        """
+        with self._lock:
+            item = self._data.pop(key, MISSING)
+            if item is not MISSING:
+                self._on_remove(key, item[1])
+                self.invalidations += 1
+
+    def clear(self):
+        """
+        Invalidate all keys.
+        """
+        with self._lock:
+            self.invalidations += len(self._data)
+            for key, (_, value) in self._data.items():
+                self._on_remove(key, value)
+            self._data.clear()
+
+    def _on_remove(self, key, value):
+        """
+        Hook called when an entry is evicted, expired or invalidated.
+        """
+        pass
+
+    def info(self):
+        """
+        Return the counters and settings.
+
+        :rtype: dict
+        """
+        with self._lock:
+            return dict(
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                invalidations=self.invalidations,
+                size=len(self._data),
+                max_size=self.max_size,
+                ttl=self.ttl,
+                policy=self.policy,
+            )
+
+
+class QueryCache(LRUCache):
+    """
+    A :class:`LRUCache` of query results, the value is a list of raw
+    documents. It also indexes cache keys by the ``_id`` of the documents
+    in the result, so the results containing a written document can be
+    invalidated without dropping the whole cache.
+
+    **中文文档**
+
+    缓存查询结果的 :class:`LRUCache`。同时记录了每个 ``_id`` 出现在哪些查询结果
+    中, 所以在某个文档被修改后, 可以只让包含该文档的查询结果失效。
+    """
+
+    def __init__(self, max_size=1000, ttl=None, policy="lru"):
+        super(QueryCache, self).__init__(
+            max_size=max_size, ttl=ttl, policy=policy)
+        self._keys_by_id = dict()
+
+    def set(self, key, value):
+        with self._lock:
+            super(QueryCache, self).set(key, value)
+            for doc in value:
+                try:
+                    self._keys_by_id.setdefault(doc["_id"], set()).add(key)
+                except (KeyError, TypeError):  # no _id or unhashable _id
+                    pass
+
+    def _on_remove(self, key, value):
+        for doc in value:
+            try:
+                keys = self._keys_by_id[doc["_id"]]
+            except (KeyError, TypeError):
+                continue
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_id[doc["_id"]]
+
+    def delete_ids(self, ids):
+        """
+        Invalidate all results containing any of the ``_id``.
+
+        :type ids: list
+        """
+        with self._lock:
+            for _id in ids:
+                try:
+                    keys = list(self._keys_by_id.get(_id, ()))
+                except TypeError:  # unhashable _id
+                    continue
+                for key in keys:
+                    self.delete(key)
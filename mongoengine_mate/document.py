@@ -5,18 +5,35 @@ This module extend the power of ``mongoengine.Document``.
 """
 
 import math
-from collections import OrderedDict
+import random
 from copy import deepcopy
+from timeit import default_timer
+from collections import OrderedDict
+from operator import itemgetter
 
 import mongoengine
+from bson import json_util
+from bson.son import SON
 
 from . import util
+from . import metrics
+from .cache import LRUCache, QueryCache, MISSING
+from .adaptive import InsertTuner
+from .record import make_record_class
+from . import export
+from . import parallel
 
 try:
     from typing import Type, Any, List, Dict
 except ImportError:  # pragma: no cover
     pass
 
+from pymongo import UpdateOne, ReplaceOne
+from pymongo.errors import (
+    BulkWriteError as PyMongoBulkWriteError,
+    DuplicateKeyError,
+)
+
 try:
     from pymongo.collection import Collection
     from pymongo.database import Database
@@ -29,6 +46,16 @@ try:
 except:
     insert_errors = (mongoengine.NotUniqueError,)
 
+#: errors raised by pymongo when insert raw dict violates unique index
+raw_insert_errors = (PyMongoBulkWriteError, DuplicateKeyError)
+
+#: MongoDB error codes of duplicate key error
+duplicate_key_error_codes = (11000, 11001, 12582)
+
+#: max number of matched documents for ``$match`` + ``$sample``, which
+#: sorts all matched documents randomly in memory
+sample_match_limit = 100000
+
 
 class ExtendedDocument(mongoengine.Document):
     """
@@ -61,6 +88,42 @@ class ExtendedDocument(mongoengine.Document):
         """
         return list(cls._fields_ordered)
 
+    @classmethod
+    def _get_serializer_plan(cls):
+        """
+        Get the field accessor plan shared by the serialization methods,
+        built once per class on first use.
+
+        :rtype: Tuple[Tuple[str], callable]
+        :return: the field names in order, and a function that takes the
+            ``_data`` dict and returns the values tuple in the same order.
+        """
+        try:
+            return cls.__dict__["_serializer_plan"]
+        except KeyError:
+            names = tuple(cls._fields_ordered)
+            if len(names) == 1:
+                name = names[0]
+                getter = lambda data: (data[name],)
+            else:
+                getter = itemgetter(*names)
+            plan = (names, getter)
+            setattr(cls, "_serializer_plan", plan)
+            return plan
+
+    def _names_and_values(self):
+        """
+        :rtype: Tuple[Tuple[str], tuple]
+        """
+        try:
+            names, getter = self.__class__.__dict__["_serializer_plan"]
+        except KeyError:
+            names, getter = self._get_serializer_plan()
+        try:
+            return names, getter(self._data)
+        except KeyError:
+            return names, tuple([self._data.get(attr) for attr in names])
+
     def keys(self):
         """
         Convert to field list.
@@ -75,7 +138,7 @@ class ExtendedDocument(mongoengine.Document):
 
         :rtype: list
         """
-        return [self._data.get(attr) for attr in self._fields_ordered]
+        return list(self._names_and_values()[1])
 
     def items(self):
         """
@@ -83,7 +146,8 @@ class ExtendedDocument(mongoengine.Document):
 
         :rtype: List[Tuple[str, Any]]
         """
-        return [(attr, self._data.get(attr)) for attr in self._fields_ordered]
+        get = self._data.get
+        return [(attr, get(attr)) for attr in self._fields_ordered]
 
     def to_tuple(self):
         """
@@ -110,27 +174,62 @@ class ExtendedDocument(mongoengine.Document):
 
         :rtype: Dict[str, Any]
         """
+        names, values = self._names_and_values()
         if include_none:
-            return dict(self.items())
+            return dict(zip(names, values))
         else:
             return {
                 key: value
-                for key, value in self.items()
+                for key, value in zip(names, values)
                 if value is not None
             }
 
+    @classmethod
+    def to_dicts(cls, docs, include_none=True):
+        """
+        Convert many documents to dicts, with minimal per document overhead.
+
+        :type docs: Iterable[ExtendedDocument]
+
+        :type include_none: bool
+        :param include_none: if False, None value field will be removed.
+
+        :rtype: List[Dict[str, Any]]
+
+        **中文文档**
+
+        批量的将文档转化为字典, 每个文档的额外开销最小。
+        """
+        names, getter = cls._get_serializer_plan()
+        docs = list(docs)
+        try:
+            if include_none:
+                return [dict(zip(names, getter(doc._data))) for doc in docs]
+            else:
+                return [
+                    {
+                        key: value
+                        for key, value in zip(names, getter(doc._data))
+                        if value is not None
+                    }
+                    for doc in docs
+                ]
+        except KeyError:
+            return [doc.to_dict(include_none=include_none) for doc in docs]
+
     def to_OrderedDict(self, include_none=True):
         """
         Convert to OrderedDict.
 
         :param include_none: bool, if False, None value field will be removed.
         """
+        names, values = self._names_and_values()
         if include_none:
-            return OrderedDict(self.items())
+            return OrderedDict(zip(names, values))
         else:
             return OrderedDict([
                 (key, value)
-                for key, value in self.items()
+                for key, value in zip(names, values)
                 if value is not None
             ])
 
@@ -143,11 +242,18 @@ class ExtendedDocument(mongoengine.Document):
     def __str__(self):
         return self.__repr__()
 
-    def absorb(self, other):
+    def absorb(self, other, copy=True):
         """
         For attributes of others that value is not None, assign it to self.
 
         :type other: ExtendedDocument
+
+        :type copy: bool
+        :param copy: if True, the value is copied by
+            :func:`~mongoengine_mate.util.smart_copy`, immutable value is
+            not copied. If False, the value is assigned as it is, use it
+            when you own ``other``.
+
         :rtype: dict
 
         **中文文档**
@@ -160,17 +266,46 @@ class ExtendedDocument(mongoengine.Document):
         overwritten_data = dict()
         for attr, value in other.items():
             if value is not None:
-                copied_value = deepcopy(value)
-                setattr(self, attr, copied_value)
-                overwritten_data[attr] = copied_value
+                if copy:
+                    value = util.smart_copy(value)
+                setattr(self, attr, value)
+                overwritten_data[attr] = value
 
         return overwritten_data
 
-    def revise(self, data):
+    @classmethod
+    def absorb_many(cls, docs, others, copy=True):
+        """
+        Pairwise :meth:`~ExtendedDocument.absorb`, ``docs[i]`` absorbs
+        ``others[i]``.
+
+        :type docs: List[ExtendedDocument]
+        :type others: List[ExtendedDocument]
+        :type copy: bool
+
+        :rtype: List[dict]
+        :return: the overwritten data of each document.
+
+        **中文文档**
+
+        批量地将 ``others`` 中的每个文档的数据更新到 ``docs`` 中对应的文档。
+        """
+        if len(docs) != len(others):
+            raise ValueError("docs and others must have the same length")
+        return [
+            doc.absorb(other, copy=copy)
+            for doc, other in zip(docs, others)
+        ]
+
+    def revise(self, data, copy=True):
         """
         Revise attributes value with dictionary data.
 
         :type data: dict
+
+        :type copy: bool
+        :param copy: see :meth:`~ExtendedDocument.absorb`.
+
         :rtype: dict
 
         **中文文档**
@@ -183,9 +318,10 @@ class ExtendedDocument(mongoengine.Document):
         overwritten_data = dict()
         for key, value in data.items():
             if value is not None:
-                copied_value = deepcopy(value)
-                setattr(self, key, copied_value)
-                overwritten_data[key] = copied_value
+                if copy:
+                    value = util.smart_copy(value)
+                setattr(self, key, value)
+                overwritten_data[key] = value
 
         return overwritten_data
 
@@ -230,13 +366,223 @@ class ExtendedDocument(mongoengine.Document):
         return cls._get_db()
 
     @classmethod
-    def smart_insert(cls, data, minimal_size=5, n_insert=0, n_skipped=0):
+    def _to_son_list(cls, data, validate=True):
+        """
+        Convert documents or dicts to a list of ``SON`` that can be sent to
+        pymongo directly.
+
+        - ``ExtendedDocument``: use ``to_mongo()``.
+        - ``bson.son.SON``: considered as already converted, keep as it is.
+        - ``dict``: a dict of field name and value, the field name is mapped
+          to the db field name (the primary key field, ``id`` and ``_id``
+          are mapped to ``_id``), the value is converted by the field's ``to_mongo()``.
+          Same as ``to_mongo()``, missing or None value takes the field's
+          default, and ``_cls`` is added if ``allow_inheritance`` is set.
+          No ``Document`` is constructed.
+
+        :type data: List[Union[ExtendedDocument, dict, SON]]
+
+        :type validate: bool
+        :param validate: if True, the field names of all dicts in this
+            batch are validated against the declared fields once, raise
+            ``mongoengine.FieldDoesNotExist`` for unknown field. If False,
+            unknown field is sent as it is.
+
+        :rtype: List[SON]
+        """
+        fields = dict(cls._fields)
+        for alias in ("id", "_id"):
+            if alias not in fields:
+                fields[alias] = cls._fields[cls._meta["id_field"]]
+
+        if validate:
+            keys = set()
+            for row in data:
+                if isinstance(row, dict) and not isinstance(row, SON):
+                    keys.update(row)
+            unknown_keys = sorted(keys.difference(fields))
+            if unknown_keys:
+                raise mongoengine.FieldDoesNotExist(
+                    "fields %s are not defined in %s" % (
+                        unknown_keys, cls.__name__)
+                )
+
+        if cls._meta.get("allow_inheritance"):
+            class_name = cls._class_name
+        else:
+            class_name = None
+
+        son_list = list()
+        for row in data:
+            if isinstance(row, SON):
+                son_list.append(row)
+            elif isinstance(row, dict):
+                values = dict()
+                son = SON()
+                son["_id"] = None
+                if class_name is not None:
+                    son["_cls"] = class_name
+                for key, value in row.items():
+                    field = fields.get(key)
+                    if field is None:
+                        son[key] = value
+                    else:
+                        values[field.name] = value
+                for field_name in cls._fields_ordered:
+                    field = cls._fields[field_name]
+                    value = values.get(field_name)
+                    if value is None and not field.null:
+                        value = field.default
+                        if callable(value):
+                            value = value()
+                    if value is not None:
+                        value = field.to_mongo(value)
+                    elif field._auto_gen:
+                        value = field.generate()
+                    if value is not None or field.null:
+                        son[field.db_field] = value
+                if son["_id"] is None:
+                    del son["_id"]
+                son_list.append(son)
+            else:
+                son_list.append(row.to_mongo())
+        return son_list
+
+    @classmethod
+    def _dedup(cls, data, policy="first"):
+        """
+        Drop the documents with repeated ``_id`` in one pass. Documents
+        without ``_id`` (to be generated by the server) are always kept.
+
+        Raw dicts are deduplicated before :meth:`_to_son_list` applies the
+        field defaults, so "merge" only merges the keys the caller supplied,
+        a defaulted value never overwrites an explicit one. The primary key
+        is read from the primary key field name, ``id`` or ``_id``.
+
+        :type data: List[Union[ExtendedDocument, dict, SON]]
+
+        :type policy: str
+        :param policy:
+
+            - "first": keep the first document.
+            - "last": keep the last document, at the position of the first.
+            - "merge": merge the not None fields of the later documents into
+              the first one with :meth:`~ExtendedDocument.absorb`, the first
+              document is modified in place. A raw dict is copied before
+              merging, the input dict is not changed.
+
+        :rtype: Tuple[list, int]
+        :return: the deduplicated documents and the number of dropped
+            documents.
+
+        **中文文档**
+
+        用一次遍历去除 ``_id`` 重复的文档。"first" 保留第一个, "last" 保留最后
+        一个, "merge" 将后面的文档中不为 None 的字段合并到第一个文档中。原始字典
+        在填充默认值之前去重, 所以合并时只合并调用者给出的键, 默认值不会覆盖显式
+        给出的值。
+        """
+        if policy not in ("first", "last", "merge"):
+            raise ValueError("unknown dedup policy: %r" % policy)
+
+        id_field = cls._fields[cls._meta["id_field"]]
+        id_keys = [
+            key for key in (id_field.name, "id", "_id")
+            if key == id_field.name or key not in cls._fields
+        ]
+
+        index_by_id = dict()
+        deduped = list()
+        for obj in data:
+            if isinstance(obj, SON):
+                _id = obj.get("_id")
+            elif isinstance(obj, dict):
+                _id = None
+                for key in id_keys:
+                    if obj.get(key) is not None:
+                        _id = id_field.to_mongo(obj[key])
+                        break
+                if policy == "merge":
+                    obj = dict(obj)
+            elif obj.pk is None:
+                _id = None
+            else:
+                _id = cls._mongo_id(obj)
+            try:
+                index = None if _id is None else index_by_id.get(_id)
+            except TypeError:  # unhashable _id
+                _id = index = None
+            if index is None:
+                if _id is not None:
+                    index_by_id[_id] = len(deduped)
+                deduped.append(obj)
+            elif policy == "last":
+                deduped[index] = obj
+            elif policy == "merge":
+                first = deduped[index]
+                if isinstance(first, dict):
+                    for key, value in obj.items():
+                        if value is not None and key not in id_keys:
+                            first[key] = value
+                else:
+                    first.absorb(obj)
+        return deduped, len(data) - len(deduped)
+
+    @classmethod
+    @metrics.instrument(
+        "smart_insert",
+        result=metrics.tuple_counts("n_insert", "n_skipped"),
+        batch_arg="data",
+    )
+    def smart_insert(cls,
+                     data,
+                     minimal_size=5,
+                     n_insert=0,
+                     n_skipped=0,
+                     strategy="recursive",
+                     validate=True,
+                     workers=None,
+                     chunk_size=1000,
+                     dedup=None):
         """
         An optimized Insert strategy.
 
-        :type data: Union[ExtendedDocument, List[ExtendedDocument]]
+        :type data: Union[ExtendedDocument, List[ExtendedDocument], dict, List[dict]]
+        :param data: documents, or raw dicts / ``SON`` to skip the document
+            construction, see :meth:`~ExtendedDocument._to_son_list`.
+
         :type minimal_size: int
 
+        :type strategy: str
+        :param strategy: "recursive", "unordered" or "adaptive". "recursive"
+            is the sqrt splitting strategy described below. "unordered"
+            sends the whole batch in one unordered bulk insert, see
+            :meth:`~ExtendedDocument.smart_insert_unordered`. "adaptive"
+            chooses the batch size from the learned duplicate rate and round
+            trip cost of this collection, see
+            :meth:`~ExtendedDocument.smart_insert_adaptive`.
+
+        :type validate: bool
+        :param validate: validate the field names of raw dicts once per
+            batch, only used when ``data`` are dicts.
+
+        :type workers: int
+        :param workers: if given, divide ``data`` into chunks of
+            ``chunk_size`` documents, and insert the chunks in a pool of
+            ``workers`` threads, see
+            :meth:`~ExtendedDocument.iter_smart_insert`.
+
+        :type chunk_size: int
+
+        :type dedup: str
+        :param dedup: None, "first", "last" or "merge", drop the documents
+            with repeated ``_id`` in ``data`` before sending to the server,
+            see :meth:`~ExtendedDocument._dedup`. The returned tuple has a
+            ``n_duplicate`` attribute, the number of dropped documents.
+
+        :rtype: Tuple[int, int]
+        :return: number of inserted and skipped documents.
+
         **中文文档**
 
         在Insert中, 如果已经预知不会出现IntegrityError, 那么使用Bulk Insert的速度要
@@ -249,14 +595,223 @@ class ExtendedDocument(mongoengine.Document):
 
         该Insert策略在内存上需要额外的 sqrt(nbytes) 的开销, 跟原数据相比体积很小。
         但时间上是各种情况下平均最优的。
+
+        如果 ``strategy="unordered"``, 则只进行一次无序的 Bulk Insert, 由服务器
+        跳过重复的文档, 参考 :meth:`~ExtendedDocument.smart_insert_unordered`。
+
+        如果 ``strategy="adaptive"``, 则根据该 collection 历史上的重复率和网络
+        往返开销决定每批的大小, 参考 :meth:`~ExtendedDocument.smart_insert_adaptive`。
+
+        ``data`` 也可以是字典或是 ``SON``, 此时不会创建 Document 对象, 而是直接
+        转化为 ``SON`` 后交给 pymongo 插入, 以节约构造和验证 Document 的开销。
+
+        如果指定了 ``workers``, 则将数据分包后使用多线程并行插入。
+
+        如果指定了 ``dedup``, 则在发送到服务器之前, 先在本地用一次遍历去除 ``_id``
+        重复的文档, 被去除的文档数量记录在返回值的 ``n_duplicate`` 属性中。
+        """
+        if dedup is not None:
+            if not isinstance(data, list):
+                data = [data, ]
+            # dedup raw dicts before the defaults are applied
+            data, n_duplicate = cls._dedup(data, dedup)
+            if len(data) and isinstance(data[0], dict):
+                data = cls._to_son_list(data, validate=validate)
+            stats = cls._smart_insert(
+                data,
+                minimal_size=minimal_size,
+                n_insert=n_insert,
+                n_skipped=n_skipped,
+                strategy=strategy,
+                validate=validate,
+                workers=workers,
+                chunk_size=chunk_size,
+            )
+            return util.StatsTuple(stats, n_duplicate=n_duplicate)
+        return cls._smart_insert(
+            data,
+            minimal_size=minimal_size,
+            n_insert=n_insert,
+            n_skipped=n_skipped,
+            strategy=strategy,
+            validate=validate,
+            workers=workers,
+            chunk_size=chunk_size,
+        )
+
+    @classmethod
+    def _smart_insert(cls,
+                      data,
+                      minimal_size=5,
+                      n_insert=0,
+                      n_skipped=0,
+                      strategy="recursive",
+                      validate=True,
+                      workers=None,
+                      chunk_size=1000):
+        """
+        The implementation of :meth:`~ExtendedDocument.smart_insert` after
+        the in batch deduplication, not instrumented.
+        """
+        if workers and isinstance(data, list):
+            n_insert_, n_skipped_ = cls.smart_insert_stream(
+                data,
+                chunk_size=chunk_size,
+                minimal_size=minimal_size,
+                strategy=strategy,
+                validate=validate,
+                workers=workers,
+            )
+            return n_insert + n_insert_, n_skipped + n_skipped_
+
+        if strategy == "unordered":
+            n_insert_, n_skipped_, _ = cls.smart_insert_unordered(
+                data, validate=validate)
+            return n_insert + n_insert_, n_skipped + n_skipped_
+        elif strategy == "adaptive":
+            n_insert_, n_skipped_ = cls.smart_insert_adaptive(
+                data, validate=validate)
+            return n_insert + n_insert_, n_skipped + n_skipped_
+        elif strategy != "recursive":
+            raise ValueError("unknown smart_insert strategy: %r" % strategy)
+
+        if isinstance(data, dict):
+            data = [data, ]
+        if isinstance(data, list) and len(data) and isinstance(data[0], dict):
+            col = cls.col()
+
+            def insert(data):
+                if isinstance(data, list):
+                    col.insert_many(data)
+                else:
+                    col.insert_one(data)
+
+            data = cls._to_son_list(data, validate=validate)
+            insert_func, errors = insert, raw_insert_errors
+        else:
+            insert_func, errors = cls.objects.insert, insert_errors
+        # a failed write may have applied part of the documents
+        try:
+            n_insert, n_skipped = cls._smart_insert_recursive(
+                data,
+                insert_func, errors,
+                minimal_size, n_insert, n_skipped,
+            )
+        finally:
+            cls._invalidate_cache(data, inserted=True)
+        return n_insert, n_skipped
+
+    @classmethod
+    def iter_smart_insert(cls,
+                          data,
+                          chunk_size=1000,
+                          minimal_size=5,
+                          strategy="recursive",
+                          validate=True,
+                          workers=None):
+        """
+        Streaming version of :meth:`~ExtendedDocument.smart_insert`. Pull
+        ``chunk_size`` documents at a time from any iterable or generator,
+        apply :meth:`~ExtendedDocument.smart_insert` to each chunk, then
+        yield the per-chunk stats. Peak memory is bounded by ``chunk_size``
+        instead of the dataset size.
+
+        :type data: Iterable[Union[ExtendedDocument, dict]]
+        :type chunk_size: int
+
+        :type workers: int
+        :param workers: if given, insert the chunks in a pool of ``workers``
+            threads sharing the connection pool, at most ``2 * workers``
+            chunks are in flight. The stats are yielded in completion order.
+
+        :rtype: Iterable[Tuple[int, int]]
+        :return: yield ``(n_insert, n_skipped)`` of each chunk.
+
+        **中文文档**
+
+        流式的 :meth:`~ExtendedDocument.smart_insert`。从任意可迭代对象中每次读取
+        ``chunk_size`` 个文档进行插入, 并返回每个包的统计结果。内存占用只和包的大小
+        有关, 与数据总量无关。
+
+        pymongo 在网络 IO 时会释放 GIL, 所以指定 ``workers`` 后可以使用多线程并行
+        插入多个包, 同时在处理中的包最多为 ``2 * workers`` 个。
+        """
+
+        def insert_chunk(chunk):
+            return cls.smart_insert(
+                chunk,
+                minimal_size=minimal_size,
+                strategy=strategy,
+                validate=validate,
+            )
+
+        chunks = util.grouper_iterable(data, chunk_size)
+        if workers:
+            for stats in util.parallel_imap(
+                    metrics.bind_context(insert_chunk), chunks, workers):
+                yield stats
+        else:
+            for chunk in chunks:
+                yield insert_chunk(chunk)
+
+    @classmethod
+    def smart_insert_stream(cls,
+                            data,
+                            chunk_size=1000,
+                            minimal_size=5,
+                            strategy="recursive",
+                            validate=True,
+                            workers=None):
+        """
+        Same as :meth:`~ExtendedDocument.iter_smart_insert`, but accumulate
+        the per-chunk stats.
+
+        :type data: Iterable[Union[ExtendedDocument, dict]]
+        :type chunk_size: int
+
+        :rtype: Tuple[int, int]
+        :return: total number of inserted and skipped documents.
+        """
+        n_insert, n_skipped = 0, 0
+        for n_insert_, n_skipped_ in cls.iter_smart_insert(
+                data,
+                chunk_size=chunk_size,
+                minimal_size=minimal_size,
+                strategy=strategy,
+                validate=validate,
+                workers=workers):
+            n_insert += n_insert_
+            n_skipped += n_skipped_
+        return n_insert, n_skipped
+
+    @classmethod
+    def _smart_insert_recursive(cls,
+                                data,
+                                insert,
+                                errors,
+                                minimal_size,
+                                n_insert,
+                                n_skipped,
+                                depth=0):
+        """
+        The recursive sqrt splitting strategy of
+        :meth:`~ExtendedDocument.smart_insert`.
+
+        :param insert: a callable inserts a list or a single document.
+        :param errors: exception classes considered as duplicate.
+        :param depth: recursion depth, reported to :mod:`~.metrics`.
+
+        :rtype: Tuple[int, int]
         """
+        metrics.split_depth(depth)
         if isinstance(data, list):
             # 首先进行尝试bulk insert
             try:
-                cls.objects.insert(data)
+                metrics.round_trip()
+                insert(data)
                 n_insert += len(data)
             # 失败了
-            except insert_errors:
+            except errors:
                 # 分析数据量
                 n = len(data)
                 # 如果数据条数多于一定数量
@@ -264,23 +819,267 @@ class ExtendedDocument(mongoengine.Document):
                     # 则进行分包
                     n_chunk = math.floor(math.sqrt(n))
                     for chunk in util.grouper_list(data, n_chunk):
-                        n_insert, n_skipped = cls.smart_insert(chunk, minimal_size, n_insert, n_skipped)
+                        n_insert, n_skipped = cls._smart_insert_recursive(
+                            chunk, insert, errors,
+                            minimal_size, n_insert, n_skipped,
+                            depth=depth + 1,
+                        )
                 # 否则则一条条地逐条插入
                 else:
+                    metrics.round_trip(len(data))
                     for document in data:
                         try:
-                            cls.objects.insert(document)
+                            insert(document)
                             n_insert += 1
-                        except insert_errors:
+                        except errors:
                             n_skipped += 1
         else:
             try:
-                cls.objects.insert(data)
+                metrics.round_trip()
+                insert(data)
                 n_insert += 1
-            except insert_errors:
+            except errors:
                 n_skipped += 1
         return n_insert, n_skipped
 
+    @classmethod
+    @metrics.instrument(
+        "smart_insert_unordered",
+        result=metrics.tuple_counts("n_insert", "n_skipped"),
+        batch_arg="data",
+    )
+    def smart_insert_unordered(cls, data, validate=True):
+        """
+        Insert all documents with one unordered bulk insert. The server
+        skips documents violating a unique index and keeps inserting the
+        rest, then the skipped documents are read out of the
+        ``BulkWriteError`` details.
+
+        :type data: Union[ExtendedDocument, List[ExtendedDocument], dict, List[dict]]
+        :param data: documents, or raw dicts / ``SON``, see
+            :meth:`~ExtendedDocument._to_son_list`.
+
+        :type validate: bool
+        :param validate: validate the field names of raw dicts once per batch.
+
+        :rtype: Tuple[int, int, List[int]]
+        :return: number of inserted documents, number of skipped documents,
+            and the indices of the skipped documents in ``data``.
+
+        **中文文档**
+
+        使用一次无序的 Bulk Insert 插入所有文档。重复的文档会被服务器跳过, 而其他
+        文档会继续插入。最后从 ``BulkWriteError`` 的信息中解析出被跳过的文档。
+        无论有多少重复, 都只需要一次网络往返。
+        """
+        if not isinstance(data, list):
+            data = [data, ]
+        if len(data) == 0:
+            return 0, 0, list()
+
+        raw = cls._to_son_list(data, validate=validate)
+        try:
+            metrics.round_trip()
+            cls.col().insert_many(raw, ordered=False)
+            failed_indices = list()
+        except PyMongoBulkWriteError as e:
+            write_errors = e.details.get("writeErrors", list())
+            for write_error in write_errors:
+                if write_error.get("code") not in duplicate_key_error_codes:
+                    cls._invalidate_cache(raw, inserted=True)
+                    raise
+            if e.details.get("writeConcernErrors"):
+                cls._invalidate_cache(raw, inserted=True)
+                raise
+            failed_indices = sorted(
+                write_error["index"] for write_error in write_errors
+            )
+
+        # pymongo generates the ``_id`` for document without primary key
+        for document, son in zip(data, raw):
+            if isinstance(document, dict):
+                continue
+            if document.pk is None:
+                document.pk = son["_id"]
+
+        cls._invalidate_cache(raw, inserted=True)
+
+        n_skipped = len(failed_indices)
+        return len(data) - n_skipped, n_skipped, failed_indices
+
+    @classmethod
+    def _get_insert_tuner(cls):
+        """
+        Get the :class:`~mongoengine_mate.adaptive.InsertTuner` of this
+        document class, configured in ``meta["adaptive_insert"]`` with
+        ``max_batch_size`` and ``decay``.
+
+        :rtype: InsertTuner
+        """
+        try:
+            return cls.__dict__["_insert_tuner"]
+        except KeyError:
+            tuner = InsertTuner(**cls._meta.get("adaptive_insert", {}))
+            setattr(cls, "_insert_tuner", tuner)
+            return tuner
+
+    @classmethod
+    def adaptive_insert_info(cls):
+        """
+        Return the learned duplicate rate, round trip latency, per document
+        cost and the last plan of ``smart_insert(strategy="adaptive")``.
+
+        :rtype: dict
+
+        **中文文档**
+
+        返回自适应插入策略学习到的重复率, 网络往返延迟, 单个文档的开销, 以及最近
+        一次的插入计划。
+        """
+        return cls._get_insert_tuner().info()
+
+    @classmethod
+    @metrics.instrument(
+        "smart_insert_adaptive",
+        result=metrics.tuple_counts("n_insert", "n_skipped"),
+        batch_arg="data",
+    )
+    def smart_insert_adaptive(cls, data, validate=True):
+        """
+        Insert documents, skip duplicates, with the batch size planned by
+        the :class:`~mongoengine_mate.adaptive.InsertTuner` of this class
+        from the observed duplicate rate and round trip cost.
+
+        - "bulk": ordered bulk insert. When a batch hits a duplicate, the
+          server reports its index, the documents before it are inserted.
+        - "precheck": when duplicates are dense and ``_id`` of all documents
+          are known, find the existing ``_id`` of the remaining documents
+          first, then bulk insert the others.
+        - "one_by_one": when the planned batch size is 1.
+
+        The remaining documents are planned again before every round trip,
+        with the estimate updated by the previous round trips, so a call
+        starting with "bulk" switches to smaller batches or "precheck" as
+        soon as dense duplicates are observed.
+
+        The learned parameters can be inspected with
+        :meth:`~ExtendedDocument.adaptive_insert_info`.
+
+        :type data: Union[ExtendedDocument, List[ExtendedDocument], dict, List[dict]]
+        :type validate: bool
+
+        :rtype: Tuple[int, int]
+        :return: number of inserted and skipped documents.
+
+        **中文文档**
+
+        根据该 collection 历史上观察到的重复率和网络往返开销, 自动选择每批插入的
+        数量: 重复少时使用大批量, 重复多时使用小批量, 如果所有文档的 ``_id`` 已知
+        并且重复很多, 则先查询已存在的 ``_id``, 再插入其他文档。有序批量插入失败时
+        服务器会返回重复文档的位置, 之前的文档已经插入, 只需重新规划之后的文档,
+        所以统计的插入和跳过数量是精确的。
+        """
+        if not isinstance(data, list):
+            data = [data, ]
+        if len(data) == 0:
+            return 0, 0
+
+        tuner = cls._get_insert_tuner()
+        col = cls.col()
+        raw = cls._to_son_list(data, validate=validate)
+        has_ids = all("_id" in son for son in raw)
+        n_insert, n_skipped = 0, 0
+
+        def insert(sons):
+            """
+            Ordered insert, return the index of the duplicate document, or
+            None if all inserted.
+            """
+            st = default_timer()
+            failed_index = None
+            metrics.round_trip()
+            try:
+                if len(sons) == 1:
+                    col.insert_one(sons[0])
+                else:
+                    col.insert_many(sons, ordered=True)
+            except DuplicateKeyError:
+                failed_index = 0
+            except PyMongoBulkWriteError as e:
+                write_errors = e.details.get("writeErrors", list())
+                if len(write_errors) != 1 \
+                        or write_errors[0].get("code") \
+                        not in duplicate_key_error_codes:
+                    raise
+                failed_index = write_errors[0]["index"]
+            if failed_index is None:
+                tuner.observe(len(sons), len(sons), 0, default_timer() - st)
+            else:
+                tuner.observe(
+                    len(sons), failed_index + 1, 1, default_timer() - st)
+            return failed_index
+
+        def precheck(sons, chunk_size):
+            """
+            Remove the documents whose ``_id`` already exists.
+            """
+            to_insert_list = list()
+            n_existing = 0
+            for chunk in util.grouper_list(sons, chunk_size):
+                st = default_timer()
+                existing_ids = cls._existing_ids(
+                    [son["_id"] for son in chunk], chunk_size=len(chunk))
+                tuner.observe_precheck(
+                    len(chunk), len(existing_ids), default_timer() - st)
+                n_existing += len(existing_ids)
+                to_insert_list.extend(
+                    son for son in chunk if son["_id"] not in existing_ids)
+            return to_insert_list, n_existing
+
+        # a failed write may have applied part of the documents
+        try:
+            to_insert_list = raw
+            position = 0
+            depth = 0  # number of round trips stopped by duplicate
+            prechecked = False
+            while position < len(to_insert_list):
+                n_rest = len(to_insert_list) - position
+                if prechecked:
+                    # the rest are known to be new, except in batch duplicates
+                    batch_size = min(n_rest, tuner.max_batch_size)
+                else:
+                    plan = tuner.plan(n_rest, has_ids=has_ids)
+                    if plan.strategy == "precheck":
+                        to_insert_list, n_existing = precheck(
+                            to_insert_list[position:], plan.batch_size)
+                        n_skipped += n_existing
+                        position = 0
+                        prechecked = True
+                        continue
+                    batch_size = plan.batch_size
+                sons = to_insert_list[position:position + batch_size]
+                metrics.split_depth(depth)
+                failed_index = insert(sons)
+                if failed_index is None:
+                    n_insert += len(sons)
+                    position += len(sons)
+                else:
+                    n_insert += failed_index
+                    n_skipped += 1
+                    position += failed_index + 1
+                    depth += 1
+        finally:
+            cls._invalidate_cache(raw, inserted=True)
+
+        # pymongo generates the ``_id`` for document without primary key
+        for document, son in zip(data, raw):
+            if isinstance(document, dict):
+                continue
+            if document.pk is None and "_id" in son:
+                document.pk = son["_id"]
+
+        return n_insert, n_skipped
+
     @classmethod
     def _smart_update(cls, obj, upsert=False):
         """
@@ -288,134 +1087,1687 @@ class ExtendedDocument(mongoengine.Document):
         the field defined with the ExtendedDocument instance. None field is
         ignored.
 
-        :type obj: ExtendedDocument
+        :type obj: Union[ExtendedDocument, SON]
 
         :rtype: int
-        :return: 0 or 1, number of document been updated
+        :return: 0 or 1, number of existing document been updated, an
+            upserted document is not counted.
         """
-        if isinstance(obj, cls):
+        if isinstance(obj, SON):
+            filter_, update = cls._to_update_args(obj)
+            metrics.round_trip()
+            result = cls.col().update_one(filter_, update, upsert=upsert)
+            return 1 if result.matched_count else 0
+        elif isinstance(obj, cls):
             dct = obj.to_dict(include_none=False)
             id_field_name = cls.id_field_name()
             if id_field_name in dct:
                 dct.pop(id_field_name)
-            return cls.objects(__raw__={"_id": obj.id}) \
-                .update_one(upsert=upsert, **dct)
+            metrics.round_trip()
+            result = cls.objects(__raw__={"_id": obj.id}) \
+                .update_one(upsert=upsert, full_result=True, **dct)
+            return 1 if result.matched_count else 0
         else:  # pragma: no cover
             raise TypeError
 
     @classmethod
-    def smart_update(cls, data, upsert=False, _insert_after_update=False):
+    def _mongo_id(cls, obj):
         """
-        Batch update with a lots orm data model.
+        Get the ``_id`` value in MongoDB of a document or a ``SON``.
 
-        .. note::
+        :type obj: Union[ExtendedDocument, SON]
+        """
+        if isinstance(obj, dict):
+            try:
+                return obj["_id"]
+            except KeyError:
+                raise ValueError("'_id' is required: %r" % obj)
+        else:
+            return cls._fields[cls._meta["id_field"]].to_mongo(obj.pk)
 
-            The batch update operation is not atomic. It can be done
-            with transaction in MongoDB 4.0 +
+    @classmethod
+    def _to_update_args(cls, obj):
+        """
+        Convert one document to the filter and update argument of a pymongo
+        update, locate the document by _id, then only ``$set`` the field
+        defined with the ExtendedDocument instance. None field is ignored.
+
+        :type obj: Union[ExtendedDocument, SON]
+
+        :rtype: Tuple[dict, dict]
+        """
+        if isinstance(obj, dict):
+            son = SON(obj)
+        elif isinstance(obj, cls):
+            son = obj.to_mongo()  # None field is not in ``to_mongo()``
+        else:  # pragma: no cover
+            raise TypeError
+        _id = cls._mongo_id(son)
+        son.pop("_id")
+        if len(son):
+            update = {"$set": son}
+        else:  # empty ``$set`` is not allowed
+            update = {"$setOnInsert": {"_id": _id}}
+        return {"_id": _id}, update
+
+    @classmethod
+    def _to_update_one(cls, obj, upsert=False):
+        """
+        Convert one document to a pymongo ``UpdateOne`` operation, see
+        :meth:`~ExtendedDocument._to_update_args`.
+
+        :type obj: Union[ExtendedDocument, SON]
+
+        :rtype: UpdateOne
+        """
+        filter_, update = cls._to_update_args(obj)
+        return UpdateOne(filter_, update, upsert=upsert)
+
+    @classmethod
+    def _smart_update_bulk(cls, data, upsert=False, batch_size=1000):
+        """
+        Update documents with pymongo ``bulk_write``, ``batch_size``
+        ``UpdateOne`` operations per round trip.
 
-        :type data: Union[ExtendedDocument, List[ExtendedDocument]]
-        :param _insert_after_update: for developer use only, if True, will
-            collect all to-insert document and bulk insert it at once after
-            update.
+        :type data: List[ExtendedDocument]
+        :type upsert: bool
+        :type batch_size: int
 
         :rtype: Tuple[int, int]
         """
         n_update, n_insert = 0, 0
-        if isinstance(data, list):
-            if _insert_after_update:
-                upsert = False
-                to_insert_list = list()
-                for obj in data:
-                    update_flag = cls._smart_update(obj, upsert=upsert)
-                    if not update_flag:
-                        to_insert_list.append(obj)
-                cls.smart_insert(to_insert_list)
-                n_insert = len(to_insert_list)
-                n_update = len(data) - n_insert
-            else:
-                for obj in data:
-                    update_flag = cls._smart_update(obj, upsert=upsert)
-                    if update_flag:
-                        n_update += 1
-                    else:
-                        n_insert += 1
-        else:
-            update_flag = cls._smart_update(data, upsert=upsert)
-            if update_flag:
-                n_update += 1
-            else:
-                n_insert += 1
-
+        col = cls.col()
+        for chunk in util.grouper_list(data, batch_size):
+            requests = [cls._to_update_one(obj, upsert=upsert) for obj in chunk]
+            metrics.round_trip()
+            result = col.bulk_write(requests, ordered=False)
+            n_update += result.matched_count
+            n_insert += result.upserted_count
         return n_update, n_insert
 
     @classmethod
-    def by_id(cls, _id):
+    def _smart_update_changed(cls, data, upsert=False, batch_size=1000):
         """
-        Get one document instance by _id.
+        Only send the fields changed since the document is loaded, use
+        mongoengine's change tracking ``_delta()`` to build minimal
+        ``$set`` / ``$unset`` operation, documents without change are
+        skipped. Documents not loaded from database (constructed by user)
+        and raw dicts send all not None fields, same as "bulk" strategy.
+
+        :type data: List[Union[ExtendedDocument, SON]]
+        :type upsert: bool
+        :type batch_size: int
+
+        :rtype: StatsTuple
+        :return: ``(n_update, n_insert)`` with ``n_unchanged`` attribute.
+        """
+        n_update, n_insert, n_unchanged = 0, 0, 0
+        col = cls.col()
+        for chunk in util.grouper_list(data, batch_size):
+            requests, written = list(), list()
+            for obj in chunk:
+                if isinstance(obj, dict) or obj._created:
+                    requests.append(cls._to_update_one(obj, upsert=upsert))
+                else:
+                    set_data, unset_data = obj._delta()
+                    if not (set_data or unset_data):
+                        n_unchanged += 1
+                        continue
+                    update = dict()
+                    if set_data:
+                        update["$set"] = set_data
+                    if unset_data:
+                        update["$unset"] = unset_data
+                    requests.append(UpdateOne(
+                        {"_id": cls._mongo_id(obj)}, update, upsert=upsert,
+                    ))
+                written.append(obj)
+            if requests:
+                metrics.round_trip()
+                result = col.bulk_write(requests, ordered=False)
+                n_update += result.matched_count
+                n_insert += result.upserted_count
+                for obj in written:
+                    if not isinstance(obj, dict):
+                        obj._clear_changed_fields()
+        return util.StatsTuple((n_update, n_insert), n_unchanged=n_unchanged)
 
-        :rtype: ExtendedDocument
+    @classmethod
+    def _existing_ids(cls, ids, chunk_size=1000):
+        """
+        Find out which ``_id`` already exists in the collection, with one
+        ``{"_id": {"$in": [...]}}`` query per ``chunk_size`` ids, only the
+        ``_id`` field is returned.
 
-        **中文文档**
+        :type ids: list
+        :type chunk_size: int
 
-        根据_id, 返回一条文档。
+        :rtype: set
         """
-        return cls.objects(__raw__={"_id": _id}).get()
+        col = cls.col()
+        existing_ids = set()
+        for chunk in util.grouper_list(ids, chunk_size):
+            metrics.round_trip()
+            for doc in col.find({"_id": {"$in": chunk}}, {"_id": True}):
+                existing_ids.add(doc["_id"])
+        return existing_ids
 
     @classmethod
-    def by_filter(cls, filters):
+    def _smart_update_precheck(cls, data, upsert=False, batch_size=1000):
         """
-        Filter objects by pymongo dict query.
+        Find out the existing documents first, then bulk update the
+        existing documents and bulk insert the others.
 
-        :rtype: QuerySet
+        :type data: List[ExtendedDocument]
+        :type upsert: bool
+        :type batch_size: int
 
-        **中文文档**
+        :rtype: StatsTuple
+        """
+        elapsed = OrderedDict()
+
+        st = default_timer()
+        ids = [cls._mongo_id(obj) for obj in data]
+        existing_ids = cls._existing_ids(ids, chunk_size=batch_size)
+        to_update_list, to_insert_list = list(), list()
+        for obj, _id in zip(data, ids):
+            if _id in existing_ids:
+                to_update_list.append(obj)
+            else:
+                to_insert_list.append(obj)
+        elapsed["precheck"] = default_timer() - st
 
-        使用pymongo的API进行查询。
+        st = default_timer()
+        n_update, _ = cls._smart_update_bulk(
+            to_update_list, upsert=False, batch_size=batch_size)
+        elapsed["update"] = default_timer() - st
+
+        st = default_timer()
+        n_insert = 0
+        if upsert:
+            for chunk in util.grouper_list(to_insert_list, batch_size):
+                n_insert += cls.smart_insert(chunk, strategy="unordered")[0]
+        elapsed["insert"] = default_timer() - st
+
+        return util.StatsTuple((n_update, n_insert), elapsed=elapsed)
+
+    @classmethod
+    def _smart_update_parallel(cls,
+                               data,
+                               upsert=False,
+                               strategy="one_by_one",
+                               batch_size=1000,
+                               workers=4):
         """
-        return cls.objects(__raw__=filters)
+        Apply :meth:`~ExtendedDocument.smart_update` to chunks of
+        ``batch_size`` documents in a thread pool, then merge the counts.
+
+        :type data: List[Union[ExtendedDocument, SON]]
+
+        :rtype: Tuple[int, int]
+        """
+
+        def update_chunk(chunk):
+            return cls.smart_update(
+                chunk, upsert=upsert, strategy=strategy, batch_size=batch_size,
+            )
+
+        n_update, n_insert = 0, 0
+        extra = dict()
+        for stats in util.parallel_imap(
+                metrics.bind_context(update_chunk),
+                util.grouper_list(data, batch_size), workers):
+            n_update += stats[0]
+            n_insert += stats[1]
+            if hasattr(stats, "elapsed"):
+                elapsed = extra.setdefault("elapsed", OrderedDict())
+                for phase, seconds in stats.elapsed.items():
+                    elapsed[phase] = elapsed.get(phase, 0) + seconds
+            if hasattr(stats, "n_unchanged"):
+                extra["n_unchanged"] = \
+                    extra.get("n_unchanged", 0) + stats.n_unchanged
+        if extra:
+            return util.StatsTuple((n_update, n_insert), **extra)
+        return n_update, n_insert
 
     @classmethod
-    def random_sample(cls, filters=None, n=5):
+    @metrics.instrument(
+        "smart_update",
+        result=metrics.tuple_counts("n_update", "n_insert"),
+        batch_arg="data",
+    )
+    def smart_update(cls,
+                     data,
+                     upsert=False,
+                     _insert_after_update=False,
+                     strategy="one_by_one",
+                     batch_size=1000,
+                     validate=True,
+                     workers=None,
+                     dedup=None):
         """
-        Randomly select n samples.
+        Batch update with a lots orm data model.
 
-        :type filters: Union[Dict, None]
-        :param filters: nature pymongo query dictionary.
+        .. note::
 
-        :type n: int
-        :param n: number of document you want to select.
+            The batch update operation is not atomic. It can be done
+            with transaction in MongoDB 4.0 +
 
-        :rtype: List[ExtendedDocument]
+        :type data: Union[ExtendedDocument, List[ExtendedDocument], dict, List[dict]]
+        :param data: documents, or raw dicts / ``SON`` to skip the document
+            construction, see :meth:`~ExtendedDocument._to_son_list`.
+            ``_id`` is required for raw dicts.
+
+        :param _insert_after_update: deprecated, same as
+            ``strategy="precheck", upsert=True``.
+
+        :type strategy: str
+        :param strategy: "one_by_one", "bulk", "precheck" or "changed".
+
+            - "one_by_one": sends one ``update_one`` per document.
+            - "bulk": sends ``batch_size`` ``UpdateOne`` operations per
+              ``bulk_write`` round trip, then ``n_update`` is the matched
+              count and ``n_insert`` is the upserted count.
+            - "precheck": finds out the existing ``_id`` with one ``$in``
+              query per ``batch_size`` documents, then bulk updates the
+              existing documents and, if ``upsert``, bulk inserts the
+              others. The returned tuple has an ``elapsed`` attribute,
+              an ordered dict of seconds spent on the "precheck",
+              "update" and "insert" phases.
+            - "changed": like "bulk", but for documents loaded from
+              database, only ``$set`` / ``$unset`` the fields changed
+              since loaded, and skip the documents without change. The
+              returned tuple has a ``n_unchanged`` attribute. See
+              :meth:`~ExtendedDocument._smart_update_changed`.
+
+        :type batch_size: int
+        :param batch_size: number of operations per round trip, used by the
+            "bulk", "precheck" and "changed" strategy.
+
+        :type validate: bool
+        :param validate: validate the field names of raw dicts once per
+            batch, only used when ``data`` are dicts.
+
+        :type workers: int
+        :param workers: if given, divide ``data`` into chunks of
+            ``batch_size`` documents, and update the chunks in a pool of
+            ``workers`` threads. The counts of all chunks are merged, the
+            "precheck" ``elapsed`` and "changed" ``n_unchanged`` are the
+            sum of all chunks.
+
+        :type dedup: str
+        :param dedup: None, "first", "last" or "merge", drop the documents
+            with repeated ``_id`` in ``data`` before sending to the server,
+            see :meth:`~ExtendedDocument._dedup`. The returned tuple has a
+            ``n_duplicate`` attribute, the number of dropped documents.
+
+        :rtype: Tuple[int, int]
 
         **中文文档**
 
-        随机选择 ``n`` 个样本。
-        """
-        data = list()
+        ``strategy="bulk"`` 时, 将所有文档转化为 ``UpdateOne`` 操作, 每
+        ``batch_size`` 个操作使用一次无序的 ``bulk_write`` 发送到服务器。
 
-        id_field = cls._meta["id_field"]
+        ``strategy="precheck"`` 时, 先用 ``$in`` 查询分批找出已经存在的 ``_id``,
+        然后对存在的文档进行 Bulk Update, 对不存在的文档进行 Bulk Insert。网络往返
+        次数从 O(n) 降低到 O(n/batch_size)。返回值的 ``elapsed`` 属性记录了每个
+        阶段的耗时。
 
-        pipeline = list()
-        if filters is not None:
-            filters = dict(filters)
-            if id_field != "_id":
-                filters["_id"] = filters[id_field]
-                del filters[id_field]
-            pipeline.append({"$match": filters})
-        pipeline.append({"$sample": {"size": n}})
+        ``strategy="changed"`` 时, 对于从数据库读取的文档, 只更新读取后被修改过的
+        字段, 没有修改的文档会被跳过, 返回值的 ``n_unchanged`` 属性记录了被跳过的
+        文档数量。
 
-        col = cls.col()
+        ``data`` 也可以是包含 ``_id`` 的字典或是 ``SON``, 此时不会创建 Document
+        对象, 而是直接转化为 ``SON`` 后交给 pymongo 更新。
 
-        if id_field == "_id":
-            for doc in col.aggregate(pipeline):
-                obj = cls(**doc)
-                data.append(obj)
+        如果指定了 ``workers``, 则将数据分包后使用多线程并行更新。
 
-        else:
-            for doc in col.aggregate(pipeline):
-                doc[id_field] = doc["_id"]
-                del doc["_id"]
-                obj = cls(**doc)
-                data.append(obj)
+        如果指定了 ``dedup``, 则在发送到服务器之前, 先在本地用一次遍历去除 ``_id``
+        重复的文档, 被去除的文档数量记录在返回值的 ``n_duplicate`` 属性中。
+        """
+        if _insert_after_update:
+            strategy, upsert = "precheck", True
+
+        if dedup is not None:
+            if not isinstance(data, list):
+                data = [data, ]
+            # dedup raw dicts before the defaults are applied
+            data, n_duplicate = cls._dedup(data, dedup)
+
+        if isinstance(data, dict):
+            data = cls._to_son_list([data, ], validate=validate)[0]
+        elif isinstance(data, list) and len(data) and isinstance(data[0], dict):
+            data = cls._to_son_list(data, validate=validate)
+
+        if dedup is not None:
+            stats = cls._smart_update_many(
+                data,
+                upsert=upsert,
+                strategy=strategy,
+                batch_size=batch_size,
+                workers=workers,
+            )
+            extra = dict(getattr(stats, "__dict__", {}))
+            extra["n_duplicate"] = n_duplicate
+            return util.StatsTuple(stats, **extra)
+        return cls._smart_update_many(
+            data,
+            upsert=upsert,
+            strategy=strategy,
+            batch_size=batch_size,
+            workers=workers,
+        )
 
-        return data
+    @classmethod
+    def _smart_update_many(cls,
+                           data,
+                           upsert=False,
+                           strategy="one_by_one",
+                           batch_size=1000,
+                           workers=None):
+        """
+        The implementation of :meth:`~ExtendedDocument.smart_update` after
+        the conversion of raw dicts and the in batch deduplication, not
+        instrumented.
+
+        :type data: Union[ExtendedDocument, List[ExtendedDocument], SON, List[SON]]
+        """
+        if workers and isinstance(data, list):
+            return cls._smart_update_parallel(
+                data,
+                upsert=upsert,
+                strategy=strategy,
+                batch_size=batch_size,
+                workers=workers,
+            )
+
+        if strategy in ("bulk", "precheck", "changed"):
+            if not isinstance(data, list):
+                data = [data, ]
+            # a failed write may have applied part of the documents
+            try:
+                if strategy == "bulk":
+                    stats = cls._smart_update_bulk(
+                        data, upsert=upsert, batch_size=batch_size)
+                elif strategy == "changed":
+                    stats = cls._smart_update_changed(
+                        data, upsert=upsert, batch_size=batch_size)
+                else:
+                    stats = cls._smart_update_precheck(
+                        data, upsert=upsert, batch_size=batch_size)
+            finally:
+                cls._invalidate_cache(data, inserted=upsert)
+            return stats
+        elif strategy != "one_by_one":
+            raise ValueError("unknown smart_update strategy: %r" % strategy)
+
+        n_update, n_insert = 0, 0
+        try:
+            if isinstance(data, list):
+                for obj in data:
+                    update_flag = cls._smart_update(obj, upsert=upsert)
+                    if update_flag:
+                        n_update += 1
+                    else:
+                        n_insert += 1
+            else:
+                update_flag = cls._smart_update(data, upsert=upsert)
+                if update_flag:
+                    n_update += 1
+                else:
+                    n_insert += 1
+        finally:
+            cls._invalidate_cache(data, inserted=upsert)
+
+        return n_update, n_insert
+
+    def save(self, *args, **kwargs):
+        """
+        Same as ``mongoengine.Document.save``, also invalidate the cache of
+        this document.
+        """
+        created = self._created
+        result = super(ExtendedDocument, self).save(*args, **kwargs)
+        self._invalidate_cache(self, inserted=created)
+        return result
+
+    def delete(self, *args, **kwargs):
+        """
+        Same as ``mongoengine.Document.delete``, also invalidate the cache
+        of this document.
+        """
+        result = super(ExtendedDocument, self).delete(*args, **kwargs)
+        self._invalidate_cache(self)
+        return result
+
+    @classmethod
+    def _get_id_cache(cls):
+        """
+        Get the :class:`~mongoengine_mate.cache.LRUCache` of
+        :meth:`~ExtendedDocument.by_id`, configured in ``meta["cache"]``
+        with ``max_size``, ``ttl`` and ``policy``. Return None if cache is
+        not enabled.
+
+        Example::
+
+            class User(ExtendedDocument):
+                meta = {
+                    "cache": {"max_size": 10000, "ttl": 60, "policy": "lru"},
+                }
+
+        :rtype: Union[LRUCache, None]
+        """
+        try:
+            return cls.__dict__["_id_cache"]
+        except KeyError:
+            config = cls._meta.get("cache")
+            cache = None if config is None else LRUCache(**config)
+            setattr(cls, "_id_cache", cache)
+            return cache
+
+    @classmethod
+    def _get_query_cache(cls):
+        """
+        Get the :class:`~mongoengine_mate.cache.QueryCache` of
+        :meth:`~ExtendedDocument.by_filter_cached`, configured in
+        ``meta["query_cache"]`` with ``max_size``, ``ttl``, ``policy`` and
+        ``invalidation``. Return None if cache is not enabled.
+
+        ``invalidation`` is "collection" (default) or "id":
+
+        - "collection": any write drops all cached results.
+        - "id": update and delete only drop the results containing the
+          written ``_id``, insert still drops all cached results. A written
+          document that didn't match a cached filter before the write is
+          not detected.
+
+        Example::
+
+            class User(ExtendedDocument):
+                meta = {
+                    "query_cache": {
+                        "max_size": 1000, "ttl": 60, "invalidation": "id",
+                    },
+                }
+
+        :rtype: Union[QueryCache, None]
+        """
+        try:
+            return cls.__dict__["_query_cache"]
+        except KeyError:
+            config = cls._meta.get("query_cache")
+            if config is None:
+                cache = None
+            else:
+                config = dict(config)
+                invalidation = config.pop("invalidation", "collection")
+                if invalidation not in ("collection", "id"):
+                    raise ValueError(
+                        "unknown invalidation option: %r" % invalidation)
+                cache = QueryCache(**config)
+                cache.invalidation = invalidation
+            setattr(cls, "_query_cache", cache)
+            return cache
+
+    @classmethod
+    def _invalidate_cache(cls, data=None, inserted=False):
+        """
+        Invalidate the cache of the written documents, called by the write
+        helpers, ``save()`` and ``delete()``. Writes through other API,
+        such as ``QuerySet.update()``, are not tracked.
+
+        :type data: Union[ExtendedDocument, SON, list, None]
+        :param data: written documents, if None, invalidate all.
+
+        :type inserted: bool
+        :param inserted: if True, new documents may be inserted.
+        """
+        id_cache = cls._get_id_cache()
+        query_cache = cls._get_query_cache()
+        if id_cache is None and query_cache is None:
+            return
+
+        if data is None:
+            ids = None
+        else:
+            if not isinstance(data, list):
+                data = [data, ]
+            ids = list()
+            for obj in data:
+                if not isinstance(obj, dict) and obj.pk is None:
+                    continue  # skipped document without _id
+                try:
+                    ids.append(cls._mongo_id(obj))
+                except ValueError:  # no _id
+                    pass
+
+        if id_cache is not None:
+            if ids is None:
+                id_cache.clear()
+            else:
+                for _id in ids:
+                    try:
+                        id_cache.delete(_id)
+                    except TypeError:  # unhashable _id
+                        pass
+
+        if query_cache is not None:
+            if ids is None or inserted \
+                    or query_cache.invalidation == "collection":
+                query_cache.clear()
+            else:
+                query_cache.delete_ids(ids)
+
+    @classmethod
+    def cache_info(cls):
+        """
+        Return the hit / miss / eviction / invalidation counters and the
+        settings of the by_id cache, None if cache is not enabled.
+
+        :rtype: Union[dict, None]
+
+        **中文文档**
+
+        返回 by_id 缓存的命中, 未命中, 淘汰, 失效次数等信息, 用于监控。
+        """
+        cache = cls._get_id_cache()
+        if cache is None:
+            return None
+        return cache.info()
+
+    @classmethod
+    def query_cache_info(cls):
+        """
+        Return the counters and the settings of the
+        :meth:`~ExtendedDocument.by_filter_cached` cache, None if cache is
+        not enabled.
+
+        :rtype: Union[dict, None]
+        """
+        cache = cls._get_query_cache()
+        if cache is None:
+            return None
+        info = cache.info()
+        info["invalidation"] = cache.invalidation
+        return info
+
+    @classmethod
+    @metrics.instrument(
+        "smart_sync",
+        result=metrics.tuple_counts(
+            "n_insert", "n_update", "n_unchanged", "n_delete"),
+        batch_arg="data",
+    )
+    def smart_sync(cls,
+                   data,
+                   key=None,
+                   hash_field=None,
+                   delete=False,
+                   chunk_size=1000,
+                   validate=True):
+        """
+        Reconcile a local dataset with the collection. A content hash of
+        each document is stored in ``hash_field``. For each chunk, only the
+        key and hash of the existing documents are fetched, then new
+        documents are inserted, changed documents are replaced, unchanged
+        documents are skipped, all in bulk. Optionally, documents not in
+        ``data`` are deleted.
+
+        Memory is proportional to ``chunk_size`` (plus the key set if
+        ``delete=True``), not the dataset size.
+
+        :type data: Iterable[Union[ExtendedDocument, dict]]
+        :param data: the full snapshot, can be a generator.
+
+        :type key: str
+        :param key: the unique field name to match local and remote
+            document, default is the primary key.
+
+        :type hash_field: str
+        :param hash_field: a declared string field to store the content
+            hash, default is ``meta["hash_field"]``.
+
+        :type delete: bool
+        :param delete: if True, delete documents whose key is not in
+            ``data``.
+
+        :type chunk_size: int
+        :type validate: bool
+
+        :rtype: Tuple[int, int, int, int]
+        :return: number of inserted, updated, unchanged, deleted documents.
+
+        **中文文档**
+
+        将本地的完整数据集与数据库中的集合同步。每个文档的内容哈希值保存在
+        ``hash_field`` 字段中。对于每一批数据, 只读取已存在文档的键和哈希值, 然后只
+        插入新文档, 只替换内容改变的文档, 跳过未改变的文档。``delete=True`` 时, 删除
+        本地数据中没有的文档。内存占用只和批的大小 (以及删除时的键集合) 有关。
+        """
+        if hash_field is None:
+            hash_field = cls._meta.get("hash_field")
+        if hash_field not in cls._fields:
+            raise ValueError(
+                "hash_field %r is not a declared field of %s" % (
+                    hash_field, cls.__name__)
+            )
+        hash_db_field = cls._fields[hash_field].db_field
+        if key is None:
+            key = cls._meta["id_field"]
+        key_db_field = cls._fields[key].db_field
+
+        col = cls.col()
+        n_insert, n_update, n_unchanged, n_delete = 0, 0, 0, 0
+        seen_keys = set()
+        written = False
+        # a failed write may have applied part of the documents
+        try:
+            for chunk in util.grouper_iterable(data, chunk_size):
+                son_list = cls._to_son_list(chunk, validate=validate)
+                son_by_key = OrderedDict()
+                for son in son_list:
+                    son.pop(hash_db_field, None)
+                    son[hash_db_field] = util.canonical_key(son)
+                    try:
+                        son_by_key[son[key_db_field]] = son
+                    except KeyError:
+                        raise ValueError("%r is required: %r" % (key, son))
+                if delete:
+                    seen_keys.update(son_by_key)
+
+                metrics.round_trip()
+                existing_hashes = {
+                    doc.get(key_db_field): doc.get(hash_db_field)
+                    for doc in col.find(
+                        {key_db_field: {"$in": list(son_by_key)}},
+                        {key_db_field: True, hash_db_field: True},
+                    )
+                }
+                to_insert_list, requests = list(), list()
+                for key_value, son in son_by_key.items():
+                    if key_value not in existing_hashes:
+                        to_insert_list.append(son)
+                    elif existing_hashes[key_value] != son[hash_db_field]:
+                        requests.append(
+                            ReplaceOne({key_db_field: key_value}, son))
+                    else:
+                        n_unchanged += 1
+                if to_insert_list:
+                    metrics.round_trip()
+                    written = True
+                    col.insert_many(to_insert_list, ordered=False)
+                    n_insert += len(to_insert_list)
+                if requests:
+                    metrics.round_trip()
+                    written = True
+                    col.bulk_write(requests, ordered=False)
+                    n_update += len(requests)
+
+            if delete:
+                to_delete_ids = list()
+                metrics.round_trip()
+                cursor = col.find({}, {key_db_field: True}) \
+                    .batch_size(chunk_size)
+                for doc in cursor:
+                    if doc.get(key_db_field) not in seen_keys:
+                        to_delete_ids.append(doc["_id"])
+                for chunk in util.grouper_list(to_delete_ids, chunk_size):
+                    metrics.round_trip()
+                    written = True
+                    n_delete += col.delete_many(
+                        {"_id": {"$in": chunk}}).deleted_count
+        finally:
+            if written:
+                cls._invalidate_cache()
+        return n_insert, n_update, n_unchanged, n_delete
+
+    @classmethod
+    @metrics.instrument("by_id", result=metrics.one_read)
+    def by_id(cls, _id):
+        """
+        Get one document instance by _id.
+
+        If cache is enabled in ``meta["cache"]``, the raw document is
+        cached, and a new instance is created from it for every call.
+
+        :rtype: ExtendedDocument
+
+        **中文文档**
+
+        根据_id, 返回一条文档。
+
+        如果在 ``meta["cache"]`` 中启用了缓存, 则优先从缓存中读取, 通过本类的写入
+        方法, ``save()`` 和 ``delete()`` 写入时缓存会自动失效。
+        """
+        cache = cls._get_id_cache()
+        if cache is None:
+            metrics.round_trip()
+            return cls.objects(__raw__={"_id": _id}).get()
+
+        son = cache.get(_id)
+        if son is MISSING:
+            metrics.round_trip()
+            son = cls.col().find_one({"_id": _id})
+            if son is None:
+                raise cls.DoesNotExist(
+                    "%s matching _id %r does not exist." % (cls.__name__, _id)
+                )
+            cache.set(_id, son)
+        return cls._from_son(son)
+
+    @classmethod
+    def record_class(cls):
+        """
+        Get the lightweight ``__slots__`` record class of this document
+        class, generated once from :meth:`~ExtendedDocument.fields_ordered`.
+        See :class:`~mongoengine_mate.record.BaseRecord`.
+
+        :rtype: Type[BaseRecord]
+
+        **中文文档**
+
+        返回本类对应的轻量级 ``__slots__`` 记录类, 只在第一次调用时生成一次。
+        """
+        try:
+            return cls.__dict__["_record_class"]
+        except KeyError:
+            record_class = make_record_class(cls)
+            setattr(cls, "_record_class", record_class)
+            return record_class
+
+    @classmethod
+    def _son_converter(cls, output, copy=False):
+        """
+        Get the function converting the raw document returned by pymongo
+        to the ``output`` type.
+
+        :type output: str
+        :param output: "document" for document instance, "raw" for shallow
+            copy of the raw document, "record" for lightweight record, see
+            :meth:`~ExtendedDocument.record_class`.
+
+        :type copy: bool
+        :param copy: if True, "raw" and "record" don't share nested list
+            and dict with the raw document, use it when the raw document is
+            cached. "document" never shares them.
+
+        :rtype: callable
+        """
+        if output == "document":
+            return cls._from_son
+        elif output == "raw":
+            if copy:
+                return deepcopy
+            return lambda son: son.__class__(son)
+        elif output == "record":
+            from_son = cls.record_class()._from_son
+            if copy:
+                return lambda son: from_son(deepcopy(son))
+            return from_son
+        else:
+            raise ValueError("unknown output option: %r" % output)
+
+    @classmethod
+    def _to_projection(cls, fields):
+        """
+        Convert a list of field names to a pymongo projection dict of db
+        field names. ``_id`` is always included.
+
+        :type fields: List[str]
+
+        :rtype: dict
+        """
+        projection = {"_id": True}
+        for field_name in fields:
+            projection[cls._db_field_map.get(field_name, field_name)] = True
+        return projection
+
+    @classmethod
+    @metrics.instrument("by_ids", result=metrics.read_count, batch_arg="ids")
+    def by_ids(cls,
+               ids,
+               chunk_size=1000,
+               missing="skip",
+               projection=None,
+               output="document"):
+        """
+        Get many document instances by _id, with one
+        ``{"_id": {"$in": [...]}}`` query per ``chunk_size`` unique ids.
+        The documents are returned in the order of ``ids``, repeated id
+        is only queried once and returns the same instance.
+
+        :type ids: list
+        :type chunk_size: int
+
+        :type missing: str
+        :param missing: what to do with id not found. "skip": leave it out,
+            "none": put None at its position, "raise": raise
+            ``DoesNotExist``.
+
+        :type projection: List[str]
+        :param projection: only load these fields.
+
+        :type output: str
+        :param output: "document", "raw" or "record", see
+            :meth:`~ExtendedDocument._son_converter`.
+
+        :rtype: List[ExtendedDocument]
+
+        **中文文档**
+
+        根据多个_id, 返回多条文档。每 ``chunk_size`` 个_id 只需要一次 ``$in``
+        查询, 返回结果的顺序与 ``ids`` 的顺序一致。重复的_id 只会被查询一次。
+        如果启用了缓存, 则只查询缓存中没有的_id。
+        """
+        if missing not in ("skip", "none", "raise"):
+            raise ValueError("unknown missing option: %r" % missing)
+
+        if projection is not None:
+            projection = cls._to_projection(projection)
+
+        unique_ids = list(OrderedDict.fromkeys(ids))
+        found = dict()
+
+        # only full documents are cached
+        cache = cls._get_id_cache() if projection is None else None
+        converter = cls._son_converter(output, copy=cache is not None)
+        if cache is not None:
+            to_query_ids = list()
+            for _id in unique_ids:
+                son = cache.get(_id)
+                if son is MISSING:
+                    to_query_ids.append(_id)
+                else:
+                    found[_id] = converter(son)
+        else:
+            to_query_ids = unique_ids
+
+        col = cls.col()
+        for chunk in util.grouper_list(to_query_ids, chunk_size):
+            metrics.round_trip()
+            for son in col.find({"_id": {"$in": chunk}}, projection):
+                if cache is not None:
+                    cache.set(son["_id"], son)
+                found[son["_id"]] = converter(son)
+
+        data = list()
+        for _id in ids:
+            try:
+                data.append(found[_id])
+            except KeyError:
+                if missing == "none":
+                    data.append(None)
+                elif missing == "raise":
+                    raise cls.DoesNotExist(
+                        "%s matching _id %r does not exist." % (
+                            cls.__name__, _id)
+                    )
+        return data
+
+    @classmethod
+    def by_filter(cls, filters):
+        """
+        Filter objects by pymongo dict query.
+
+        :rtype: QuerySet
+
+        **中文文档**
+
+        使用pymongo的API进行查询。
+        """
+        return cls.objects(__raw__=filters)
+
+    @classmethod
+    @metrics.instrument("by_filter_cached", result=metrics.read_count)
+    def by_filter_cached(cls,
+                         filters,
+                         projection=None,
+                         sort=None,
+                         limit=0,
+                         output="document"):
+        """
+        Same as :meth:`~ExtendedDocument.by_filter`, but return a list and
+        cache the result if ``meta["query_cache"]`` is enabled, see
+        :meth:`~ExtendedDocument._get_query_cache`. The cache key is a
+        canonical hash of ``filters``, ``projection``, ``sort`` and
+        ``limit``, the key order of the filter dict and of the operator
+        dicts doesn't matter, see :func:`~mongoengine_mate.util.canonical_key`.
+
+        :type filters: dict
+        :param filters: nature pymongo query dictionary.
+
+        :type projection: List[str]
+        :param projection: only load these fields.
+
+        :type sort: List[Tuple[str, int]]
+        :param sort: pymongo sort specification.
+
+        :type limit: int
+        :param limit: 0 means no limit.
+
+        :type output: str
+        :param output: "document", "raw" or "record", see
+            :meth:`~ExtendedDocument._son_converter`.
+
+        :rtype: list
+
+        **中文文档**
+
+        与 :meth:`~ExtendedDocument.by_filter` 相同, 但返回列表。如果在
+        ``meta["query_cache"]`` 中启用了缓存, 那么相同的查询 (与字典中键的顺序无关)
+        会直接从缓存中返回结果, 而不会再次查询数据库。
+        """
+        cache = cls._get_query_cache()
+        converter = cls._son_converter(output, copy=cache is not None)
+        if cache is None:
+            son_list = MISSING
+        else:
+            key = util.canonical_key(filters, projection, sort, limit)
+            son_list = cache.get(key)
+
+        if son_list is MISSING:
+            if projection is not None:
+                projection = cls._to_projection(projection)
+            metrics.round_trip()
+            cursor = cls.col().find(filters, projection)
+            if sort:
+                cursor = cursor.sort(sort)
+            if limit:
+                cursor = cursor.limit(limit)
+            son_list = list(cursor)
+            if cache is not None:
+                cache.set(key, son_list)
+
+        return [converter(son) for son in son_list]
+
+    @classmethod
+    @metrics.instrument("iter_by_filter", item=metrics.count_item)
+    def iter_by_filter(cls,
+                       filters=None,
+                       projection=None,
+                       sort=None,
+                       limit=0,
+                       batch_size=1000,
+                       output="record"):
+        """
+        Stream the result of a pymongo dict query, decode the raw cursor
+        straight into ``output`` type. By default it yields lightweight
+        records, which is much cheaper than document instances, use
+        ``record.to_document()`` when ORM behavior is needed.
+
+        :type filters: dict
+        :type projection: List[str]
+        :type sort: List[Tuple[str, int]]
+        :type limit: int
+
+        :type batch_size: int
+        :param batch_size: number of documents per cursor batch.
+
+        :type output: str
+        :param output: "document", "raw" or "record", see
+            :meth:`~ExtendedDocument._son_converter`.
+
+        **中文文档**
+
+        流式地返回查询结果。默认返回轻量级的记录对象, 其创建开销和内存占用远小于
+        Document 对象。需要 ORM 功能时, 可使用 ``record.to_document()`` 转化。
+        """
+        converter = cls._son_converter(output)
+        if projection is not None:
+            projection = cls._to_projection(projection)
+        metrics.round_trip()
+        cursor = cls.col().find(filters or {}, projection)
+        if sort:
+            cursor = cursor.sort(sort)
+        if limit:
+            cursor = cursor.limit(limit)
+        cursor = cursor.batch_size(batch_size)
+        for son in cursor:
+            yield converter(son)
+
+    @classmethod
+    def _keyset_filters(cls, filters, key_db_field, token):
+        """
+        Build the range query of the page after ``token``.
+
+        :type filters: Union[Dict, None]
+        :type key_db_field: str
+        :type token: Union[str, None]
+
+        :rtype: dict
+        """
+        if token is None:
+            return filters or {}
+        position = json_util.loads(token)
+        if key_db_field == "_id":
+            after = {"_id": {"$gt": position["_id"]}}
+        else:
+            last_key = position["key"]
+            if last_key is None:
+                # null sorts first, ``$gt: null`` doesn't match other types
+                next_keys = {key_db_field: {"$ne": None}}
+            else:
+                # same type only, see the note in ``iter_pages``
+                next_keys = {key_db_field: {"$gt": last_key}}
+            after = {"$or": [
+                next_keys,
+                {key_db_field: last_key, "_id": {"$gt": position["_id"]}},
+            ]}
+        if filters:
+            return {"$and": [filters, after]}
+        else:
+            return after
+
+    @classmethod
+    @metrics.instrument("iter_pages", item=metrics.count_page)
+    def iter_pages(cls,
+                   filters=None,
+                   page_size=1000,
+                   sort_key=None,
+                   token=None,
+                   projection=None,
+                   output="document"):
+        """
+        Scan a pymongo dict query page by page with keyset pagination. Each
+        page is an independent query ``{sort_key: {"$gt": last_seen}}``
+        sorted on ``(sort_key, _id)`` and limited to ``page_size``, so
+        seeking a page costs one index lookup however deep it is, and there
+        is no long lived cursor to time out. Use an index on
+        ``(sort_key, _id)`` for non primary key ``sort_key``.
+
+        ``sort_key`` (and ``_id``) must hold values of one BSON type, null
+        or missing is allowed. ``$gt`` only matches values of the same type
+        as the last seen key, so the scan stops silently at the end of the
+        first type, for example string keys after number keys are never
+        yielded.
+
+        :type filters: dict
+        :param filters: nature pymongo query dictionary.
+
+        :type page_size: int
+
+        :type sort_key: str
+        :param sort_key: field name to page on, ascending, default is the
+            primary key. ``_id`` is used to break ties.
+
+        :type token: str
+        :param token: resume after the page which returned this token.
+
+        :type projection: List[str]
+        :param projection: only load these fields, ``sort_key`` is always
+            loaded.
+
+        :type output: str
+        :param output: "document", "raw" or "record", see
+            :meth:`~ExtendedDocument._son_converter`.
+
+        :rtype: Iterable[Tuple[list, str]]
+        :return: yield ``(items, token)``, ``token`` is a extended json
+            string of the last seen position, pass it to resume from the
+            next page.
+
+        **中文文档**
+
+        使用基于键值的分页遍历查询结果。每一页都是一个独立的范围查询
+        ``{sort_key: {"$gt": 上一页的最后一个值}}``, 按 ``(sort_key, _id)`` 排序,
+        所以无论翻到第几页, 定位的开销都只是一次索引查找, 不像 ``skip`` 那样越往后
+        越慢, 也不会有长时间不关闭的游标超时的问题。每一页都返回一个 token, 用于
+        从下一页继续遍历。
+
+        ``sort_key`` (以及 ``_id``) 的值必须是同一种 BSON 类型 (允许 null 或缺失)。
+        ``$gt`` 只匹配与上一个值同类型的值, 所以遍历会在第一种类型结束时悄悄停止,
+        例如排在数字之后的字符串永远不会被返回。
+        """
+        converter = cls._son_converter(output)
+        if sort_key in (None, "_id", cls._meta["id_field"]):
+            key_db_field = "_id"
+            sort = [("_id", 1)]
+        else:
+            key_db_field = cls._fields[sort_key].db_field
+            sort = [(key_db_field, 1), ("_id", 1)]
+        if projection is not None:
+            projection = cls._to_projection(projection)
+            projection[key_db_field] = True
+
+        while True:
+            metrics.round_trip()
+            son_list = list(
+                cls.col()
+                    .find(cls._keyset_filters(filters, key_db_field, token),
+                          projection)
+                    .sort(sort)
+                    .limit(page_size)
+            )
+            if not son_list:
+                return
+            last = son_list[-1]
+            position = {"_id": last["_id"]}
+            if key_db_field != "_id":
+                position["key"] = last.get(key_db_field)
+            token = json_util.dumps(position)
+            yield [converter(son) for son in son_list], token
+            if len(son_list) < page_size:
+                return
+
+    @classmethod
+    def export_jsonl(cls,
+                     dst,
+                     filters=None,
+                     projection=None,
+                     batch_size=1000,
+                     use_gzip=None):
+        """
+        Stream the result of a pymongo dict query to a JSON Lines file,
+        see :func:`mongoengine_mate.export.export_jsonl`.
+
+        :param dst: file path, or a binary file object.
+
+        :rtype: OrderedDict
+        :return: ``n_rows``, ``n_bytes``, ``elapsed``, ``rows_per_sec`` and
+            ``bytes_per_sec``.
+
+        **中文文档**
+
+        将查询结果流式地写入 JSON Lines 文件, 内存占用恒定。路径以 ``.gz`` 结尾
+        时自动使用 gzip 压缩。返回行数, 字节数, 耗时, 以及吞吐量。
+        """
+        return export.export_jsonl(
+            cls, dst,
+            filters=filters,
+            projection=projection,
+            batch_size=batch_size,
+            use_gzip=use_gzip,
+        )
+
+    @classmethod
+    def export_csv(cls,
+                   dst,
+                   filters=None,
+                   projection=None,
+                   batch_size=1000,
+                   use_gzip=None):
+        """
+        Stream the result of a pymongo dict query to a CSV file, columns are
+        in ``fields_ordered()`` order, see
+        :func:`mongoengine_mate.export.export_csv`.
+
+        :param dst: file path, or a binary file object.
+
+        :rtype: OrderedDict
+        :return: ``n_rows``, ``n_bytes``, ``elapsed``, ``rows_per_sec`` and
+            ``bytes_per_sec``.
+
+        **中文文档**
+
+        将查询结果流式地写入 CSV 文件, 列的顺序与 ``fields_ordered()`` 一致。
+        路径以 ``.gz`` 结尾时自动使用 gzip 压缩。返回行数, 字节数, 耗时, 以及
+        吞吐量。
+        """
+        return export.export_csv(
+            cls, dst,
+            filters=filters,
+            projection=projection,
+            batch_size=batch_size,
+            use_gzip=use_gzip,
+        )
+
+    @classmethod
+    def to_columns(cls,
+                   filters=None,
+                   fields=None,
+                   output="dict",
+                   batch_size=1000):
+        """
+        Stream the result of a pymongo dict query into typed per field
+        buffers, and finish as a dict of lists, a dict of numpy arrays, a
+        pandas DataFrame or a pyarrow Table. numpy, pandas and pyarrow are
+        optional, only imported when requested. See
+        :func:`mongoengine_mate.export.to_columns`.
+
+        :type filters: dict
+        :type fields: List[str]
+
+        :type output: str
+        :param output: "dict", "numpy", "pandas" or "arrow".
+
+        **中文文档**
+
+        将查询结果按列流式写入根据字段类型确定类型的缓冲区 (例如 ``IntField`` 对应
+        int64), 最后转化为 dict, numpy 数组, pandas DataFrame 或 pyarrow Table。
+        避免了先创建大量 Document 和 dict 再转化带来的双倍内存和对象开销。
+        numpy, pandas, pyarrow 为可选依赖, 只有用到时才会导入。
+        """
+        return export.to_columns(
+            cls,
+            filters=filters,
+            fields=fields,
+            output=output,
+            batch_size=batch_size,
+        )
+
+    @classmethod
+    def parallel_scan(cls,
+                      filters=None,
+                      fn=None,
+                      reduce_fn=None,
+                      initial=None,
+                      combine_fn=None,
+                      partitions=None,
+                      processes=None,
+                      split="sample",
+                      projection=None,
+                      output="document",
+                      batch_size=1000):
+        """
+        Split the ``_id`` key space of a pymongo dict query into balanced
+        ranges, scan the ranges in a ``spawn`` process pool, apply ``fn``
+        to every item and reduce the results with ``reduce_fn``. Each worker
+        process opens its own connections from the mongoengine connection
+        settings, no connection is shared across processes. See
+        :func:`mongoengine_mate.parallel.parallel_scan`.
+
+        :type filters: dict
+        :type fn: callable
+        :type reduce_fn: callable
+        :type combine_fn: callable
+
+        :type partitions: int
+        :param partitions: number of ``_id`` ranges.
+
+        :type processes: int
+        :param processes: number of worker processes, 0 means run in current
+            process.
+
+        :type split: str
+        :param split: "sample" or "bucket_auto".
+
+        **中文文档**
+
+        将查询结果按 ``_id`` 的范围分成大致相等的若干份 (通过随机抽样或
+        ``$bucketAuto`` 找到分割点), 在 ``spawn`` 模式的进程池中并行处理, 对每一个
+        文档调用 ``fn``, 并用 ``reduce_fn`` 合并结果。用于绕开 GIL 进行 CPU 密集型
+        的计算。每个子进程根据 mongoengine 的连接配置创建自己的连接, 不会与父进程
+        共享连接。
+        """
+        return parallel.parallel_scan(
+            cls,
+            filters=filters,
+            fn=fn,
+            reduce_fn=reduce_fn,
+            initial=initial,
+            combine_fn=combine_fn,
+            partitions=partitions,
+            processes=processes,
+            split=split,
+            projection=projection,
+            output=output,
+            batch_size=batch_size,
+        )
+
+    @classmethod
+    def _to_raw_filters(cls, filters):
+        """
+        Copy a pymongo query dictionary, and map the top level primary key
+        field name to ``_id``.
+
+        :type filters: Union[Dict, None]
+
+        :rtype: dict
+        """
+        filters = dict(filters or {})
+        id_field = cls._meta["id_field"]
+        if id_field != "_id" and id_field in filters:
+            filters["_id"] = filters.pop(id_field)
+        return filters
+
+    @classmethod
+    def _choose_sample_strategy(cls, filters, n, seed, random_field):
+        """
+        Choose the random sample strategy for ``strategy="auto"``.
+
+        - ``$sample`` is used when ``n`` is less than 5% of the estimated
+          number of documents. Without filters, the estimate is the
+          collection metadata count, ``$sample`` is the first stage and
+          reads only ``n`` random documents. With filters, the matched
+          documents are counted up to :data:`sample_match_limit`,
+          ``$match`` + ``$sample`` sorts all matched documents randomly in
+          memory, so it is only used if the count is below the limit.
+        - "random_field" is used if an indexed random field is available.
+        - "reservoir" for everything else, it only streams ``_id``.
+        - ``seed`` requires a reproducible strategy, ``$sample`` is not.
+
+        :rtype: str
+        """
+        fallback = "reservoir" if random_field is None else "random_field"
+        if seed is not None:
+            return fallback
+        metrics.round_trip()
+        if filters:
+            n_matched = cls.col().count_documents(
+                filters, limit=sample_match_limit + 1)
+            if n_matched > sample_match_limit:
+                return fallback
+        else:
+            n_matched = cls.col().estimated_document_count()
+        if n < 0.05 * n_matched:
+            return "sample"
+        return fallback
+
+    @classmethod
+    def _random_sample_reservoir(cls, filters, n, rng, projection, batch_size):
+        """
+        Reservoir sampling over a streamed ``_id`` only cursor, then fetch
+        the selected documents with chunked ``$in`` query. Memory is
+        proportional to ``n``.
+
+        :rtype: Iterable[SON]
+        """
+        col = cls.col()
+        metrics.round_trip()
+        cursor = col.find(filters, {"_id": True}) \
+            .sort("_id", 1).batch_size(max(batch_size, 10000))
+        reservoir = list()
+        for i, son in enumerate(cursor):
+            if i < n:
+                reservoir.append(son["_id"])
+            else:
+                j = rng.randint(0, i)
+                if j < n:
+                    reservoir[j] = son["_id"]
+        rng.shuffle(reservoir)
+
+        for chunk in util.grouper_list(reservoir, batch_size):
+            metrics.round_trip()
+            found = {
+                son["_id"]: son
+                for son in col.find({"_id": {"$in": chunk}}, projection)
+            }
+            for _id in chunk:
+                if _id in found:  # may be deleted in between
+                    yield found[_id]
+
+    @classmethod
+    def _random_sample_random_field(cls,
+                                    filters,
+                                    n,
+                                    rng,
+                                    projection,
+                                    batch_size,
+                                    random_field):
+        """
+        Seek a random point on an indexed field holding uniform random
+        numbers in [0, 1), then take the next ``n`` documents in that
+        field's order, wrap around to the beginning if it reaches the end.
+        Because the field values are random, a contiguous range is a
+        random subset. Cost is one or two index range scans.
+
+        :rtype: Iterable[SON]
+        """
+        col = cls.col()
+        random_field = cls._db_field_map.get(random_field, random_field)
+        point = rng.random()
+        n_yield = 0
+        for condition in ({"$gte": point}, {"$lt": point}):
+            if n_yield >= n:
+                break
+            if filters:
+                query = {"$and": [filters, {random_field: condition}]}
+            else:
+                query = {random_field: condition}
+            metrics.round_trip()
+            cursor = col.find(query, projection) \
+                .sort(random_field, 1) \
+                .limit(n - n_yield) \
+                .batch_size(batch_size)
+            for son in cursor:
+                n_yield += 1
+                yield son
+
+    @classmethod
+    @metrics.instrument("iter_random_sample", item=metrics.count_item)
+    def iter_random_sample(cls,
+                           filters=None,
+                           n=5,
+                           projection=None,
+                           output="document",
+                           batch_size=1000,
+                           strategy="sample",
+                           seed=None,
+                           random_field=None):
+        """
+        Generator version of :meth:`~ExtendedDocument.random_sample`, the
+        samples are decoded while streaming the cursor.
+
+        :type filters: Union[Dict, None]
+        :param filters: nature pymongo query dictionary.
+
+        :type n: int
+        :param n: number of document you want to select.
+
+        :type projection: List[str]
+        :param projection: only load these fields, pushed into the pipeline
+            as ``$project``.
+
+        :type output: str
+        :param output: "document", "raw" or "record", see
+            :meth:`~ExtendedDocument._son_converter`.
+
+        :type batch_size: int
+        :param batch_size: number of documents per cursor batch.
+
+        :type strategy: str
+        :param strategy: "sample", "random_field", "reservoir" or "auto".
+
+            - "sample": ``$match`` + ``$sample`` aggregation.
+            - "random_field": seek a random point on ``random_field``, see
+              :meth:`~ExtendedDocument._random_sample_random_field`.
+            - "reservoir": reservoir sampling over a ``_id`` only cursor,
+              then batch fetch, see
+              :meth:`~ExtendedDocument._random_sample_reservoir`.
+            - "auto": choose one by the estimated collection size, or the
+              matched count if ``filters`` is given, see
+              :meth:`~ExtendedDocument._choose_sample_strategy`.
+
+        :type seed: Hashable
+        :param seed: random seed, the same seed returns the same samples if
+            data is not changed. Not supported by "sample".
+
+        :type random_field: str
+        :param random_field: name of an indexed field holding uniform random
+            numbers in [0, 1), for example
+            ``rand = FloatField(default=random.random)``. Default is
+            ``meta["random_field"]``.
+        """
+        converter = cls._son_converter(output)
+
+        filters = cls._to_raw_filters(filters)
+        if projection is not None:
+            projection = cls._to_projection(projection)
+        if random_field is None:
+            random_field = cls._meta.get("random_field")
+
+        if strategy == "auto":
+            strategy = cls._choose_sample_strategy(
+                filters, n, seed, random_field)
+
+        if strategy == "sample":
+            if seed is not None:
+                raise ValueError("$sample doesn't support seed")
+            pipeline = list()
+            if filters:
+                pipeline.append({"$match": filters})
+            pipeline.append({"$sample": {"size": n}})
+            if projection is not None:
+                pipeline.append({"$project": projection})
+            metrics.round_trip()
+            son_iter = cls.col().aggregate(pipeline, batchSize=batch_size)
+        elif strategy == "reservoir":
+            son_iter = cls._random_sample_reservoir(
+                filters, n, random.Random(seed), projection, batch_size)
+        elif strategy == "random_field":
+            if random_field is None:
+                raise ValueError("random_field is not defined")
+            son_iter = cls._random_sample_random_field(
+                filters, n, random.Random(seed), projection, batch_size,
+                random_field,
+            )
+        else:
+            raise ValueError("unknown random_sample strategy: %r" % strategy)
+
+        for son in son_iter:
+            yield converter(son)
+
+    @classmethod
+    def random_sample(cls,
+                      filters=None,
+                      n=5,
+                      projection=None,
+                      output="document",
+                      strategy="sample",
+                      seed=None,
+                      random_field=None,
+                      stratify_by=None,
+                      n_per_stratum=None,
+                      strata=None):
+        """
+        Randomly select n samples.
+
+        :type filters: Union[Dict, None]
+        :param filters: nature pymongo query dictionary.
+
+        :type n: int
+        :param n: number of document you want to select.
+
+        :type projection: List[str]
+        :param projection: only load these fields, pushed into the pipeline
+            as ``$project``.
+
+        :type output: str
+        :param output: "document", "raw" or "record", see
+            :meth:`~ExtendedDocument._son_converter`. Documents are built
+            with ``_from_son`` from the raw data.
+
+        :param strategy: see :meth:`~ExtendedDocument.iter_random_sample`.
+        :param seed: see :meth:`~ExtendedDocument.iter_random_sample`.
+        :param random_field: see :meth:`~ExtendedDocument.iter_random_sample`.
+
+        :param stratify_by: if given, return a stratified sample, see
+            :meth:`~ExtendedDocument.stratified_sample`.
+        :param n_per_stratum: see :meth:`~ExtendedDocument.stratified_sample`,
+            default is ``n``.
+        :param strata: see :meth:`~ExtendedDocument.stratified_sample`.
+
+        :rtype: Union[List[ExtendedDocument], OrderedDict]
+
+        **中文文档**
+
+        随机选择 ``n`` 个样本。
+
+        样本从原始数据通过 ``_from_son`` 直接构建, 也可以选择返回原始字典或是轻量级
+        的记录对象。``projection`` 会作为 ``$project`` 在服务器端执行。需要大量样本
+        时可使用 :meth:`~ExtendedDocument.iter_random_sample` 流式读取。
+
+        ``$sample`` 在 ``n`` 超过集合的 5% 或是有过滤条件时, 会退化为全表扫描加内存
+        排序。所以对于大量样本, 可以选择基于随机数索引字段的 "random_field" 策略,
+        或是只读取 ``_id`` 的蓄水池抽样 "reservoir" 策略, "auto" 会根据估计的数据
+        量 (有过滤条件时为匹配的文档数量) 自动选择。指定 ``seed`` 可以得到可重复的结果。
+        """
+        if stratify_by is not None:
+            return cls.stratified_sample(
+                stratify_by=stratify_by,
+                n_per_stratum=n if n_per_stratum is None else n_per_stratum,
+                filters=filters,
+                strata=strata,
+                projection=projection,
+                output=output,
+            )
+
+        return list(cls.iter_random_sample(
+            filters=filters,
+            n=n,
+            projection=projection,
+            output=output,
+            strategy=strategy,
+            seed=seed,
+            random_field=random_field,
+        ))
+
+    @classmethod
+    @metrics.instrument("stratified_sample", result=metrics.read_count)
+    def stratified_sample(cls,
+                          stratify_by,
+                          n_per_stratum=5,
+                          filters=None,
+                          strata=None,
+                          projection=None,
+                          output="document"):
+        """
+        Randomly select ``n_per_stratum`` samples for each distinct value of
+        ``stratify_by``, all strata are sampled in one ``$facet``
+        aggregation round trip.
+
+        .. note::
+
+            The ``$facet`` result is one document, so all samples together
+            must be smaller than 16MB.
+
+        :type stratify_by: str
+        :param stratify_by: the field name to stratify by.
+
+        :type n_per_stratum: int
+        :param n_per_stratum: number of samples per stratum.
+
+        :type filters: Union[Dict, None]
+        :param filters: nature pymongo query dictionary.
+
+        :type strata: list
+        :param strata: the values of ``stratify_by`` to sample, if not
+            given, all distinct values are queried first, it costs one more
+            round trip.
+
+        :type projection: List[str]
+        :type output: str
+
+        :rtype: OrderedDict
+        :return: stratum value -> list of samples, the number of samples
+            of each stratum is ``len()`` of the list.
+
+        **中文文档**
+
+        分层随机抽样。对 ``stratify_by`` 字段的每一个值, 随机选择 ``n_per_stratum``
+        个样本。所有分层的抽样在一次 ``$facet`` 聚合查询中完成, 而不是每一层查询一次。
+        """
+        converter = cls._son_converter(output)
+        filters = cls._to_raw_filters(filters)
+        db_field = cls._db_field_map.get(stratify_by, stratify_by)
+
+        col = cls.col()
+        if strata is None:
+            metrics.round_trip()
+            strata = col.distinct(db_field, filters)
+        strata = list(strata)
+        if len(strata) == 0:
+            return OrderedDict()
+
+        facet = OrderedDict()
+        for i, value in enumerate(strata):
+            sub_pipeline = [
+                {"$match": {db_field: value}},
+                {"$sample": {"size": n_per_stratum}},
+            ]
+            if projection is not None:
+                sub_pipeline.append(
+                    {"$project": cls._to_projection(projection)})
+            facet["s%s" % i] = sub_pipeline
+
+        pipeline = list()
+        if filters:
+            pipeline.append({"$match": filters})
+        pipeline.append({"$facet": facet})
+
+        metrics.round_trip()
+        result = list(col.aggregate(pipeline))[0]
+        samples = OrderedDict()
+        for i, value in enumerate(strata):
+            samples[value] = [converter(son) for son in result["s%s" % i]]
+        return samples
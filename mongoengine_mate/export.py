@@ -0,0 +1,519 @@
+# -*- coding: utf-8 -*-
+
+"""
+Stream query results of an :class:`~mongoengine_mate.ExtendedDocument` to
+file or to columnar buffers at constant overhead per row. The raw cursor is
+consumed directly, no document instance is created.
+"""
+
+import io
+import csv
+import gzip
+import datetime
+from array import array
+from timeit import default_timer
+from collections import OrderedDict
+
+import mongoengine
+from bson import json_util
+
+try:  # pragma: no cover
+    string_types = (basestring,)
+except NameError:  # pragma: no cover
+    string_types = (str,)
+
+
+class _CountingWriter(object):
+    """
+    Binary file wrapper counting the number of bytes written.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.n_bytes = 0
+
+    def write(self, b):
+        self.n_bytes += len(b)
+        return self.f.write(b)
+
+    def writable(self):
+        return True
+
+    def readable(self):
+        return False
+
+    def seekable(self):
+        return False
+
+    def flush(self):
+        return self.f.flush()
+
+    @property
+    def closed(self):
+        return self.f.closed
+
+    def close(self):
+        # the underlying file is managed by :func:`_open`
+        pass
+
+
+class _open(object):
+    """
+    Open a path or wrap a binary file object for writing, optionally with
+    gzip compression. The counted bytes are the uncompressed bytes.
+    """
+
+    def __init__(self, dst, use_gzip=None):
+        self.is_path = isinstance(dst, string_types)
+        if use_gzip is None:
+            use_gzip = self.is_path and dst.endswith(".gz")
+        self.dst = dst
+        self.use_gzip = use_gzip
+
+    def __enter__(self):
+        if self.is_path:
+            self.f = open(self.dst, "wb")
+        else:
+            self.f = self.dst
+        if self.use_gzip:
+            self.gz = gzip.GzipFile(fileobj=self.f, mode="wb")
+            return _CountingWriter(self.gz)
+        else:
+            self.gz = None
+            return _CountingWriter(self.f)
+
+    def __exit__(self, *exc_info):
+        if self.gz is not None:
+            self.gz.close()  # write the gzip trailer, not close self.f
+        if self.is_path:
+            self.f.close()
+        else:
+            self.f.flush()
+
+
+def _columns(document_class, projection=None):
+    """
+    :rtype: OrderedDict
+    :return: field name -> db field name, in ``fields_ordered()`` order.
+    """
+    id_field = document_class._meta["id_field"]
+    columns = OrderedDict()
+    for name in document_class._fields_ordered:
+        if projection is None or name in projection or name == id_field:
+            columns[name] = document_class._fields[name].db_field
+    return columns
+
+
+def _cursor(document_class, columns, filters, batch_size):
+    projection = {db_field: True for db_field in columns.values()}
+    return document_class.col() \
+        .find(filters or {}, projection) \
+        .batch_size(batch_size)
+
+
+def _stats(n_rows, n_bytes, elapsed):
+    return OrderedDict([
+        ("n_rows", n_rows),
+        ("n_bytes", n_bytes),
+        ("elapsed", elapsed),
+        ("rows_per_sec", n_rows / elapsed if elapsed else 0.0),
+        ("bytes_per_sec", n_bytes / elapsed if elapsed else 0.0),
+    ])
+
+
+def export_jsonl(document_class,
+                 dst,
+                 filters=None,
+                 projection=None,
+                 batch_size=1000,
+                 use_gzip=None):
+    """
+    Write query results as JSON Lines, one extended JSON object per line,
+    keyed by field name in ``fields_ordered()`` order, None field omitted.
+
+    :type document_class: Type[mongoengine_mate.ExtendedDocument]
+
+    :param dst: file path, or a binary file object.
+
+    :type filters: dict
+    :param filters: nature pymongo query dictionary.
+
+    :type projection: List[str]
+    :param projection: only export these fields, the primary key is always
+        exported.
+
+    :type batch_size: int
+    :param batch_size: number of documents per cursor batch.
+
+    :type use_gzip: bool
+    :param use_gzip: gzip compress the output, default is True if ``dst``
+        is a path ends with ``.gz``.
+
+    :rtype: OrderedDict
+    :return: number of rows, number of uncompressed bytes, elapsed seconds,
+        rows/sec and bytes/sec.
+    """
+    st = default_timer()
+    columns = _columns(document_class, projection)
+    n_rows = 0
+    with _open(dst, use_gzip) as f:
+        for son in _cursor(document_class, columns, filters, batch_size):
+            row = OrderedDict()
+            for name, db_field in columns.items():
+                value = son.get(db_field)
+                if value is not None:
+                    row[name] = value
+            f.write((json_util.dumps(row) + "\n").encode("utf-8"))
+            n_rows += 1
+        n_bytes = f.n_bytes
+    return _stats(n_rows, n_bytes, default_timer() - st)
+
+
+def _to_csv_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if isinstance(value, (list, dict)):
+        return json_util.dumps(value)
+    return value
+
+
+def export_csv(document_class,
+               dst,
+               filters=None,
+               projection=None,
+               batch_size=1000,
+               use_gzip=None):
+    """
+    Write query results as CSV with a header of field names in
+    ``fields_ordered()`` order. None is written as empty string, datetime as
+    ISO format, list and dict as extended JSON.
+
+    Arguments and return value are the same as :func:`export_jsonl`.
+
+    :rtype: OrderedDict
+    """
+    st = default_timer()
+    columns = _columns(document_class, projection)
+    n_rows = 0
+    with _open(dst, use_gzip) as f:
+        text = io.TextIOWrapper(f, encoding="utf-8", newline="")
+        writer = csv.writer(text)
+        writer.writerow(list(columns))
+        for son in _cursor(document_class, columns, filters, batch_size):
+            writer.writerow([
+                _to_csv_value(son.get(db_field))
+                for db_field in columns.values()
+            ])
+            n_rows += 1
+        text.flush()
+        n_bytes = f.n_bytes
+    return _stats(n_rows, n_bytes, default_timer() - st)
+
+
+# --- Columnar ---
+class _Column(object):
+    """
+    Append-only buffer of one field, values are kept as python objects.
+    """
+    kind = "object"
+
+    def __init__(self, name=None):
+        self.name = name
+        self.values = list()
+        self.append = self.values.append
+
+    def to_list(self):
+        return self.values
+
+    def to_numpy(self, np):
+        arr = np.empty(len(self.values), dtype=object)
+        arr[:] = self.values
+        return arr
+
+    def to_pandas(self, pd, np):
+        return self.to_numpy(np)
+
+    def to_arrow(self, pa, np):
+        return pa.array(self.values)
+
+
+class _StringColumn(_Column):
+    kind = "string"
+
+    def to_arrow(self, pa, np):
+        return pa.array(self.values, type=pa.string())
+
+
+class _ObjectIdColumn(_Column):
+    kind = "objectid"
+
+    def to_arrow(self, pa, np):
+        return pa.array(
+            [None if value is None else str(value) for value in self.values],
+            type=pa.string(),
+        )
+
+
+class _DateTimeColumn(_Column):
+    kind = "datetime"
+
+    def to_numpy(self, np):
+        return np.array(self.values, dtype="datetime64[us]")
+
+    def to_arrow(self, pa, np):
+        return pa.array(self.to_numpy(np), type=pa.timestamp("us"))
+
+
+class _TypedColumn(_Column):
+    """
+    Value buffer in a typed :class:`array.array`, plus a byte mask of null.
+    Null is stored as the ``null`` value in the value buffer.
+
+    A value the buffer rejects, for example a BSON double written by another
+    client into an int field, is converted if it is integral, otherwise a
+    ``TypeError`` naming the field is raised.
+    """
+    typecode = None
+    dtype = None
+    null = None
+
+    def __init__(self, name=None):
+        self.name = name
+        self.data = array(self.typecode)
+        self.mask = bytearray()
+        data_append = self.data.append
+        mask_append = self.mask.append
+        null = self.null
+        coerce = self.coerce
+
+        def append(value):
+            if value is None:
+                data_append(null)
+                mask_append(1)
+            else:
+                try:
+                    data_append(value)
+                except (TypeError, OverflowError):
+                    data_append(coerce(value))
+                mask_append(0)
+
+        self.append = append
+
+    def coerce(self, value):
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+            try:
+                array(self.typecode, [value])
+                return value
+            except OverflowError:
+                pass
+        raise TypeError(
+            "field %r: can not store %r in a %s column" % (
+                self.name, value, self.kind)
+        )
+
+    @property
+    def has_null(self):
+        return 1 in self.mask
+
+    def to_list(self):
+        if self.has_null:
+            return [
+                None if is_null else value
+                for value, is_null in zip(self.data, self.mask)
+            ]
+        return self.data.tolist()
+
+    def _numpy_values(self, np):
+        return np.frombuffer(self.data, dtype=self.dtype)
+
+    def _numpy_mask(self, np):
+        return np.frombuffer(self.mask, dtype=np.bool_)
+
+    def to_numpy(self, np):
+        values = self._numpy_values(np)
+        if self.has_null:
+            return np.ma.masked_array(values, mask=self._numpy_mask(np))
+        return values
+
+    def to_arrow(self, pa, np):
+        if self.has_null:
+            return pa.array(self._numpy_values(np), mask=self._numpy_mask(np))
+        return pa.array(self._numpy_values(np))
+
+
+class _IntColumn(_TypedColumn):
+    kind = "int64"
+    typecode = "q"
+    dtype = "int64"
+    null = 0
+
+    def to_pandas(self, pd, np):
+        if self.has_null:
+            return pd.arrays.IntegerArray(
+                self._numpy_values(np), self._numpy_mask(np))
+        return self._numpy_values(np)
+
+
+class _FloatColumn(_TypedColumn):
+    kind = "float64"
+    typecode = "d"
+    dtype = "float64"
+    null = float("nan")
+
+    def to_numpy(self, np):
+        # null is already NaN
+        return self._numpy_values(np)
+
+    def to_pandas(self, pd, np):
+        return self._numpy_values(np)
+
+
+class _BoolColumn(_TypedColumn):
+    kind = "bool"
+    typecode = "B"
+    dtype = "bool"
+    null = 0
+
+    def to_list(self):
+        return [
+            None if value is None else bool(value)
+            for value in super(_BoolColumn, self).to_list()
+        ]
+
+    def to_pandas(self, pd, np):
+        if self.has_null:
+            return pd.arrays.BooleanArray(
+                self._numpy_values(np), self._numpy_mask(np))
+        return self._numpy_values(np)
+
+
+#: mongoengine field class -> column class, the first match wins
+_column_class_mapper = [
+    (mongoengine.BooleanField, _BoolColumn),
+    (mongoengine.IntField, _IntColumn),
+    (mongoengine.LongField, _IntColumn),
+    (mongoengine.FloatField, _FloatColumn),
+    (mongoengine.StringField, _StringColumn),
+    (mongoengine.ObjectIdField, _ObjectIdColumn),
+    (mongoengine.DateTimeField, _DateTimeColumn),
+]
+
+
+def _make_column(field):
+    for field_class, column_class in _column_class_mapper:
+        if isinstance(field, field_class):
+            return column_class(field.name)
+    return _Column(field.name)
+
+
+def _import_optional(module_name, package_name):
+    try:
+        return __import__(module_name)
+    except ImportError:  # pragma: no cover
+        raise ImportError(
+            "%s is required, run: pip install %s" % (module_name, package_name)
+        )
+
+
+def to_columns(document_class,
+               filters=None,
+               fields=None,
+               output="dict",
+               batch_size=1000):
+    """
+    Stream the result of a pymongo dict query into one buffer per field,
+    typed by the mongoengine field class:
+
+    - ``IntField``, ``LongField``: int64, in :class:`array.array` with a null
+      mask.
+    - ``FloatField``: float64, in :class:`array.array`, null is NaN.
+    - ``BooleanField``: bool, in :class:`bytearray` with a null mask.
+    - ``StringField``: string.
+    - ``DateTimeField``: datetime64[us].
+    - others: python object.
+
+    :type document_class: Type[mongoengine_mate.ExtendedDocument]
+
+    :type filters: dict
+    :param filters: nature pymongo query dictionary.
+
+    :type fields: List[str]
+    :param fields: field names, default is all fields in
+        ``fields_ordered()`` order.
+
+    :type output: str
+    :param output:
+
+        - "dict": ``OrderedDict`` of field name -> list, null is None.
+        - "numpy": ``OrderedDict`` of field name -> ``numpy.ndarray``, int
+          and bool column with null is a ``numpy.ma.MaskedArray``.
+        - "pandas": ``pandas.DataFrame``, int and bool column with null use
+          the pandas nullable ``Int64`` and ``boolean`` dtype.
+        - "arrow": ``pyarrow.Table``, null is arrow null, ObjectId is
+          converted to string.
+
+    :type batch_size: int
+    :param batch_size: number of documents per cursor batch.
+    """
+    if output not in ("dict", "numpy", "pandas", "arrow"):
+        raise ValueError("unknown output: %r" % output)
+    # import optional dependency before reading data
+    np = pd = pa = None
+    if output in ("numpy", "pandas", "arrow"):
+        np = _import_optional("numpy", "numpy")
+    if output == "pandas":
+        pd = _import_optional("pandas", "pandas")
+    if output == "arrow":
+        pa = _import_optional("pyarrow", "pyarrow")
+
+    if fields is None:
+        fields = list(document_class._fields_ordered)
+    unknown_fields = sorted(set(fields).difference(document_class._fields))
+    if unknown_fields:
+        raise mongoengine.FieldDoesNotExist(
+            "fields %s are not defined in %s" % (
+                unknown_fields, document_class.__name__)
+        )
+    columns = OrderedDict([
+        (name, _make_column(document_class._fields[name]))
+        for name in fields
+    ])
+    appenders = [
+        (document_class._fields[name].db_field, column.append)
+        for name, column in columns.items()
+    ]
+
+    projection = {db_field: True for db_field, _ in appenders}
+    if "_id" not in projection:
+        projection["_id"] = False
+    cursor = document_class.col() \
+        .find(filters or {}, projection) \
+        .batch_size(batch_size)
+    for son in cursor:
+        get = son.get
+        for db_field, append in appenders:
+            append(get(db_field))
+
+    if output == "dict":
+        return OrderedDict([
+            (name, column.to_list())
+            for name, column in columns.items()
+        ])
+    elif output == "numpy":
+        return OrderedDict([
+            (name, column.to_numpy(np))
+            for name, column in columns.items()
+        ])
+    elif output == "pandas":
+        return pd.DataFrame(OrderedDict([
+            (name, column.to_pandas(pd, np))
+            for name, column in columns.items()
+        ]), columns=list(columns))
+    else:
+        return pa.table(OrderedDict([
+            (name, column.to_arrow(pa, np))
+            for name, column in columns.items()
+        ]))
@@ -0,0 +1,517 @@
+# -*- coding: utf-8 -*-
+
+"""
+Instrumentation of the read and write helpers of
+:class:`~mongoengine_mate.ExtendedDocument`.
+
+Every instrumented call emits one :class:`Event` to the registered
+handlers. Without handler, which is the default, the instrumented methods
+call through directly, and the round trip counters return immediately.
+
+An instrumented call made inside another one, in the same thread or in
+the worker threads of ``workers=N``, emits a child event with ``parent``
+set. Its round trips are also counted in the parent event, and the built-in
+adapters skip child events, so every call is only counted once.
+
+Usage::
+
+    import logging
+    from mongoengine_mate import metrics
+
+    metrics.add_handler(metrics.LoggingHandler(level=logging.INFO))
+
+    # or any callable takes an Event
+    metrics.add_handler(lambda event: print(event.to_dict()))
+
+**中文文档**
+
+为 :class:`~mongoengine_mate.ExtendedDocument` 的读写方法提供监控。每次调用都会
+向注册的 handler 发送一个 :class:`Event`, 包含操作名, collection, 批量大小, 网络
+往返次数, 插入 / 跳过 / 更新的数量, 耗时, 以及递归分包的深度。默认没有 handler,
+此时几乎没有额外开销。
+"""
+
+import time
+import inspect
+import logging
+import functools
+import threading
+from timeit import default_timer
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+_handlers = list()
+_local = threading.local()
+_counter_lock = threading.Lock()
+
+
+class Event(object):
+    """
+    Stats of one call of an instrumented helper.
+
+    :param operation: method name, e.g. "smart_insert".
+    :param collection: collection name.
+    :param batch_size: number of input documents or ids, 0 if not applicable.
+    :param strategy: the strategy argument if the method has one.
+    :param round_trips: number of commands sent to the server, cursor
+        ``getMore`` is not counted. Nested instrumented calls in the same
+        thread are also counted in the outer event.
+    :param n_insert: number of inserted documents.
+    :param n_skipped: number of skipped duplicate documents.
+    :param n_duplicate: number of documents dropped by the in batch
+        deduplication.
+    :param n_update: number of updated documents.
+    :param n_unchanged: number of unchanged documents.
+    :param n_delete: number of deleted documents.
+    :param n_read: number of returned documents.
+    :param elapsed: seconds spent in the method, for generator it is the
+        time spent in producing the items.
+    :param split_depth: max recursion depth of the recursive insert.
+    :param error: exception class name if the call failed.
+    :param parent: operation of the enclosing instrumented call, None for
+        top level call.
+    """
+    __slots__ = (
+        "operation", "collection", "batch_size", "strategy", "round_trips",
+        "n_insert", "n_skipped", "n_duplicate", "n_update", "n_unchanged",
+        "n_delete", "n_read", "elapsed", "split_depth", "error", "parent",
+    )
+
+    def __init__(self, operation, collection, batch_size=0, strategy=None,
+                 parent=None):
+        self.operation = operation
+        self.collection = collection
+        self.batch_size = batch_size
+        self.strategy = strategy
+        self.round_trips = 0
+        self.n_insert = 0
+        self.n_skipped = 0
+        self.n_duplicate = 0
+        self.n_update = 0
+        self.n_unchanged = 0
+        self.n_delete = 0
+        self.n_read = 0
+        self.elapsed = 0.0
+        self.split_depth = 0
+        self.error = None
+        self.parent = parent
+
+    def to_dict(self):
+        """
+        :rtype: OrderedDict
+        """
+        return OrderedDict([(attr, getattr(self, attr)) for attr in self.__slots__])
+
+    def __repr__(self):
+        return "Event(%s)" % ", ".join([
+            "%s=%r" % (key, value) for key, value in self.to_dict().items()
+        ])
+
+
+# --- Handler registry ---
+def add_handler(handler):
+    """
+    Register a callable takes an :class:`Event`.
+    """
+    if handler not in _handlers:
+        _handlers.append(handler)
+
+
+def remove_handler(handler):
+    """
+    Unregister a handler.
+    """
+    if handler in _handlers:
+        _handlers.remove(handler)
+
+
+def clear_handlers():
+    """
+    Unregister all handlers.
+    """
+    del _handlers[:]
+
+
+def is_enabled():
+    """
+    :rtype: bool
+    """
+    return bool(_handlers)
+
+
+def emit(event):
+    """
+    Send an event to all handlers, a failed handler is logged and never
+    breaks the database operation.
+    """
+    for handler in list(_handlers):
+        try:
+            handler(event)
+        except Exception:
+            logger.exception("metrics handler %r failed", handler)
+
+
+# --- Counters used inside the helpers ---
+def _active_events():
+    try:
+        return _local.events
+    except AttributeError:
+        _local.events = list()
+        return _local.events
+
+
+def round_trip(n=1):
+    """
+    Count ``n`` commands sent to the server in all active events of the
+    current thread.
+    """
+    if not _handlers:
+        return
+    with _counter_lock:  # events may be shared by worker threads
+        for event in _active_events():
+            event.round_trips += n
+
+
+def split_depth(depth):
+    """
+    Record the recursion depth of the recursive insert.
+    """
+    if not _handlers:
+        return
+    with _counter_lock:
+        for event in _active_events():
+            if depth > event.split_depth:
+                event.split_depth = depth
+
+
+def bind_context(func):
+    """
+    Wrap a function submitted to a thread pool, so the calls in the worker
+    thread are counted in the active events of the submitting thread.
+
+    :type func: callable
+    :rtype: callable
+    """
+    if not _handlers:
+        return func
+    parents = list(_active_events())
+    if not parents:
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        events = _active_events()
+        events.extend(parents)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            for event in parents:
+                events.remove(event)
+
+    return wrapper
+
+
+# --- Decorator ---
+def tuple_counts(*names):
+    """
+    Result filler, assign the items of the returned tuple to event counters,
+    also copy the ``n_*`` counters of :class:`~mongoengine_mate.util.StatsTuple`.
+    """
+
+    def fill(event, result):
+        for name, value in zip(names, result):
+            setattr(event, name, value)
+        for name, value in getattr(result, "__dict__", {}).items():
+            if name.startswith("n_") and name in Event.__slots__:
+                setattr(event, name, value)
+
+    return fill
+
+
+def read_count(event, result):
+    """
+    Result filler, count the not None items of the returned list, or of the
+    lists in the returned dict as ``n_read``.
+    """
+    if isinstance(result, dict):
+        event.n_read = sum(len(value) for value in result.values())
+    else:
+        event.n_read = sum(1 for value in result if value is not None)
+
+
+def one_read(event, result):
+    """
+    Result filler of the method returns one document.
+    """
+    event.n_read = 0 if result is None else 1
+
+
+def count_item(event, item):
+    """
+    Item filler, count each yielded item as ``n_read``.
+    """
+    event.n_read += 1
+
+
+def count_page(event, page):
+    """
+    Item filler, count the items of each yielded ``(items, token)`` page.
+    """
+    event.n_read += len(page[0])
+
+
+def _get_call_args(func, args, kwargs):
+    try:
+        return inspect.getcallargs(func, *args, **kwargs)
+    except TypeError:  # let the real call raise
+        return dict()
+
+
+def instrument(operation, result=None, item=None, batch_arg=None):
+    """
+    Decorator of a classmethod of document class, emit one :class:`Event`
+    per call. Put it under ``@classmethod``.
+
+    :type operation: str
+
+    :type result: callable
+    :param result: ``result(event, return_value)`` fills the counters.
+
+    :type item: callable
+    :param item: for generator function, ``item(event, yielded_item)``
+        fills the counters.
+
+    :type batch_arg: str
+    :param batch_arg: name of the argument whose length is the batch size.
+    """
+
+    def decorator(func):
+        is_generator = inspect.isgeneratorfunction(func)
+
+        @functools.wraps(func)
+        def wrapper(cls, *args, **kwargs):
+            if not _handlers:
+                return func(cls, *args, **kwargs)
+
+            events = _active_events()
+            call_args = _get_call_args(func, (cls,) + args, kwargs)
+            batch_size = 0
+            if batch_arg is not None:
+                value = call_args.get(batch_arg)
+                if isinstance(value, (list, tuple, set, frozenset)):
+                    batch_size = len(value)
+                elif value is not None and not hasattr(value, "__next__"):
+                    batch_size = 1  # single document or dict
+            event = Event(
+                operation,
+                cls._get_collection_name(),
+                batch_size=batch_size,
+                strategy=call_args.get("strategy"),
+                parent=events[-1].operation if events else None,
+            )
+
+            if is_generator:
+                return _traced_iter(event, func(cls, *args, **kwargs), item)
+
+            events.append(event)
+            st = default_timer()
+            try:
+                return_value = func(cls, *args, **kwargs)
+                if result is not None:
+                    result(event, return_value)
+                return return_value
+            except Exception as e:
+                event.error = e.__class__.__name__
+                raise
+            finally:
+                event.elapsed = default_timer() - st
+                events.remove(event)
+                emit(event)
+
+        return wrapper
+
+    return decorator
+
+
+def _traced_iter(event, iterator, item):
+    """
+    Activate the event only while the generator is producing an item, so
+    the time spent by the consumer is not counted.
+    """
+    events = _active_events()
+    try:
+        while True:
+            events.append(event)
+            st = default_timer()
+            try:
+                value = next(iterator)
+            except StopIteration:
+                return
+            except Exception as e:
+                event.error = e.__class__.__name__
+                raise
+            finally:
+                event.elapsed += default_timer() - st
+                events.remove(event)
+            if item is not None:
+                item(event, value)
+            yield value
+    finally:
+        emit(event)
+
+
+# --- Adapters ---
+class LoggingHandler(object):
+    """
+    Log each event in one line of ``key=value``, the :class:`Event` dict is
+    also attached as ``extra={"mongoengine_mate": ...}`` for structured
+    logging formatter. Child events are skipped.
+
+    :type logger: logging.Logger
+    :type level: int
+    """
+
+    def __init__(self, logger=None, level=logging.DEBUG):
+        if logger is None:
+            logger = logging.getLogger("mongoengine_mate.metrics.events")
+        self.logger = logger
+        self.level = level
+
+    def __call__(self, event):
+        if event.parent is not None or not self.logger.isEnabledFor(self.level):
+            return
+        data = event.to_dict()
+        self.logger.log(
+            self.level,
+            "%s %s",
+            event.operation,
+            " ".join([
+                "%s=%s" % (key, value)
+                for key, value in data.items()
+                if key != "operation" and value is not None
+            ]),
+            extra={"mongoengine_mate": data},
+        )
+
+
+class PrometheusHandler(object):
+    """
+    Export events as Prometheus counters and histogram with
+    ``prometheus_client``, labeled by operation and collection:
+
+    - ``<namespace>_operations_total{operation, collection, status}``
+    - ``<namespace>_round_trips_total{operation, collection}``
+    - ``<namespace>_documents_total{operation, collection, result}``, result
+      is "inserted", "skipped", "duplicate", "updated", "unchanged",
+      "deleted" or "read".
+    - ``<namespace>_duration_seconds{operation, collection}``
+
+    Child events are skipped, they are already counted in the parent event.
+
+    :param registry: ``prometheus_client.CollectorRegistry``, default is the
+        global registry.
+    :type namespace: str
+    """
+    _document_counters = [
+        ("n_insert", "inserted"),
+        ("n_skipped", "skipped"),
+        ("n_duplicate", "duplicate"),
+        ("n_update", "updated"),
+        ("n_unchanged", "unchanged"),
+        ("n_delete", "deleted"),
+        ("n_read", "read"),
+    ]
+
+    def __init__(self, registry=None, namespace="mongoengine_mate"):
+        import prometheus_client
+
+        if registry is None:
+            registry = prometheus_client.REGISTRY
+        labels = ["operation", "collection"]
+        self.operations = prometheus_client.Counter(
+            "%s_operations" % namespace,
+            "Number of calls of mongoengine_mate helpers.",
+            labels + ["status"],
+            registry=registry,
+        )
+        self.round_trips = prometheus_client.Counter(
+            "%s_round_trips" % namespace,
+            "Number of commands sent to the server.",
+            labels,
+            registry=registry,
+        )
+        self.documents = prometheus_client.Counter(
+            "%s_documents" % namespace,
+            "Number of documents by result.",
+            labels + ["result"],
+            registry=registry,
+        )
+        self.duration = prometheus_client.Histogram(
+            "%s_duration_seconds" % namespace,
+            "Time spent in mongoengine_mate helpers.",
+            labels,
+            registry=registry,
+        )
+
+    def __call__(self, event):
+        if event.parent is not None:
+            return
+        labels = (event.operation, event.collection)
+        self.operations.labels(
+            *(labels + ("error" if event.error else "ok",))).inc()
+        if event.round_trips:
+            self.round_trips.labels(*labels).inc(event.round_trips)
+        for attr, result in self._document_counters:
+            value = getattr(event, attr)
+            if value:
+                self.documents.labels(*(labels + (result,))).inc(value)
+        self.duration.labels(*labels).observe(event.elapsed)
+
+
+class OpenTelemetryHandler(object):
+    """
+    Record each event as an OpenTelemetry span named
+    ``mongoengine_mate.<operation>``, with the event fields as
+    ``mongoengine_mate.*`` attributes. The span is created when the event is
+    emitted with the measured start and end time, under the current span of
+    the caller. Child events are skipped.
+
+    :param tracer: ``opentelemetry.trace.Tracer``, default is the tracer of
+        the global tracer provider.
+    """
+
+    def __init__(self, tracer=None):
+        from opentelemetry import trace
+
+        if tracer is None:
+            tracer = trace.get_tracer("mongoengine_mate")
+        self.tracer = tracer
+        self._trace = trace
+
+    def __call__(self, event):
+        if event.parent is not None:
+            return
+        try:
+            end_time = time.time_ns()
+        except AttributeError:  # pragma: no cover, python < 3.7
+            end_time = int(time.time() * 1e9)
+        start_time = end_time - int(event.elapsed * 1e9)
+        attributes = {
+            "db.system": "mongodb",
+            "db.operation": event.operation,
+            "db.mongodb.collection": event.collection,
+        }
+        for key, value in event.to_dict().items():
+            if value is not None and key not in ("operation", "collection"):
+                attributes["mongoengine_mate.%s" % key] = value
+        span = self.tracer.start_span(
+            "mongoengine_mate.%s" % event.operation,
+            kind=self._trace.SpanKind.CLIENT,
+            start_time=start_time,
+            attributes=attributes,
+        )
+        if event.error:
+            span.set_status(
+                self._trace.Status(self._trace.StatusCode.ERROR, event.error))
+        span.end(end_time=end_time)
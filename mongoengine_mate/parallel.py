@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+
+"""
+Range partitioned collection scan in a process pool, for CPU heavy per
+document processing.
+
+Worker processes are started with the ``spawn`` method, so they never
+inherit the ``MongoClient`` (sockets, locks, monitor threads) of the parent
+process. Each worker opens its own connections from the mongoengine
+connection settings in the pool initializer.
+"""
+
+import copy
+import multiprocessing
+
+import mongoengine
+from mongoengine import connection
+from pymongo.errors import OperationFailure
+
+
+def _get_connection_settings():
+    """
+    Copy the registered mongoengine connection settings, they are sent to
+    the worker processes.
+
+    :rtype: dict
+    """
+    return copy.deepcopy(connection._connection_settings)
+
+
+def _init_worker(connection_settings):
+    """
+    Pool initializer, register all connections of the parent process in the
+    worker process. Connections are created lazily on first use.
+    """
+    mongoengine.disconnect_all()
+    for alias, settings in connection_settings.items():
+        mongoengine.register_connection(alias, **settings)
+
+
+def _to_id_ranges(split_points):
+    """
+    ``[a, b]`` -> ``[(None, a), (a, b), (b, None)]``
+    """
+    bounds = [None, ] + list(split_points) + [None, ]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _range_filters(filters, lower, upper):
+    """
+    Add ``lower <= _id < upper`` to a pymongo query dictionary.
+    """
+    id_range = dict()
+    if lower is not None:
+        id_range["$gte"] = lower
+    if upper is not None:
+        id_range["$lt"] = upper
+    if not id_range:
+        return filters or {}
+    if filters:
+        return {"$and": [filters, {"_id": id_range}]}
+    else:
+        return {"_id": id_range}
+
+
+def split_points_by_sample(document_class, filters, partitions, oversample=32):
+    """
+    Find ``partitions - 1`` split points of ``_id``, from the quantiles of
+    ``partitions * oversample`` randomly sampled ``_id``.
+
+    :type document_class: Type[mongoengine_mate.ExtendedDocument]
+    :type filters: dict
+    :type partitions: int
+    :type oversample: int
+
+    :rtype: list
+    """
+    pipeline = [
+        {"$match": filters or {}},
+        {"$sample": {"size": partitions * oversample}},
+        {"$project": {"_id": True}},
+    ]
+    ids = sorted(set(
+        doc["_id"] for doc in document_class.col().aggregate(pipeline)
+    ))
+    split_points = list()
+    for i in range(1, partitions):
+        index = len(ids) * i // partitions
+        if index and ids[index] not in split_points[-1:]:
+            split_points.append(ids[index])
+    return split_points
+
+
+def split_points_by_bucket_auto(document_class, filters, partitions):
+    """
+    Find ``partitions - 1`` split points of ``_id`` with ``$bucketAuto``.
+    It is exact, but reads all matched ``_id``.
+
+    :type document_class: Type[mongoengine_mate.ExtendedDocument]
+    :type filters: dict
+    :type partitions: int
+
+    :rtype: list
+    """
+    pipeline = [
+        {"$match": filters or {}},
+        {"$bucketAuto": {"groupBy": "$_id", "buckets": partitions}},
+    ]
+    buckets = list(document_class.col().aggregate(pipeline))
+    return [bucket["_id"]["min"] for bucket in buckets[1:]]
+
+
+def split_points(document_class, filters, partitions, split="sample"):
+    """
+    :type split: str
+    :param split: "sample" or "bucket_auto", fall back to "sample" if
+        ``$bucketAuto`` is not supported by the server.
+
+    :rtype: list
+    """
+    if split == "bucket_auto":
+        try:
+            return split_points_by_bucket_auto(
+                document_class, filters, partitions)
+        except (OperationFailure, NotImplementedError):
+            return split_points_by_sample(document_class, filters, partitions)
+    elif split == "sample":
+        return split_points_by_sample(document_class, filters, partitions)
+    else:
+        raise ValueError("unknown split option: %r" % split)
+
+
+def _identity(item):
+    return item
+
+
+def _append(acc, result):
+    acc.append(result)
+    return acc
+
+
+def _concat(acc, partial):
+    acc.extend(partial)
+    return acc
+
+
+def _scan_range(task):
+    """
+    Scan one ``_id`` range and reduce the results. Run in worker process.
+    """
+    (document_class, filters, fn, reduce_fn, initial,
+     projection, output, batch_size) = task
+    converter = document_class._son_converter(output)
+    cursor = document_class.col() \
+        .find(filters, projection) \
+        .batch_size(batch_size)
+    acc = initial
+    for son in cursor:
+        acc = reduce_fn(acc, fn(converter(son)))
+    return acc
+
+
+def parallel_scan(document_class,
+                  filters=None,
+                  fn=None,
+                  reduce_fn=None,
+                  initial=None,
+                  combine_fn=None,
+                  partitions=None,
+                  processes=None,
+                  split="sample",
+                  projection=None,
+                  output="document",
+                  batch_size=1000):
+    """
+    Split the ``_id`` key space of a query into ranges, scan each range in
+    a worker process, apply ``fn`` to every item and reduce the results.
+
+    ``document_class``, ``fn``, ``reduce_fn`` and ``combine_fn`` are sent
+    to the worker processes, they have to be picklable, which means defined
+    at module level of an importable module. The ``_id`` of the matched
+    documents have to be of the same BSON type, range query doesn't cross
+    types.
+
+    :type document_class: Type[mongoengine_mate.ExtendedDocument]
+
+    :type filters: dict
+    :param filters: nature pymongo query dictionary.
+
+    :type fn: callable
+    :param fn: ``fn(item) -> result``, default returns the item as it is.
+
+    :type reduce_fn: callable
+    :param reduce_fn: ``reduce_fn(acc, result) -> acc``, reduce the results
+        of a partition, starting from ``initial``. Default collects the
+        results in a list.
+
+    :param initial: initial value of the accumulator of each partition,
+        it is copied for each partition.
+
+    :type combine_fn: callable
+    :param combine_fn: ``combine_fn(acc, partial_acc) -> acc``, combine the
+        accumulators of the partitions. Default is ``reduce_fn``, or list
+        concatenation if ``reduce_fn`` is not given.
+
+    :type partitions: int
+    :param partitions: number of ``_id`` ranges, default is 4 times of
+        ``processes``.
+
+    :type processes: int
+    :param processes: number of worker processes, default is the number of
+        CPU. 0 means scan the partitions one by one in current process.
+
+    :type split: str
+    :param split: "sample" or "bucket_auto", see :func:`split_points`.
+
+    :type projection: List[str]
+    :type output: str
+    :type batch_size: int
+
+    :return: the combined accumulator.
+    """
+    if fn is None:
+        fn = _identity
+    if reduce_fn is None:
+        reduce_fn, initial = _append, list()
+        if combine_fn is None:
+            combine_fn = _concat
+    if combine_fn is None:
+        combine_fn = reduce_fn
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if partitions is None:
+        partitions = max(processes, 1) * 4
+    if projection is not None:
+        projection = document_class._to_projection(projection)
+    filters = document_class._to_raw_filters(filters)
+
+    if partitions > 1:
+        points = split_points(document_class, filters, partitions, split)
+    else:
+        points = list()
+    tasks = [
+        (
+            document_class,
+            _range_filters(filters, lower, upper),
+            fn,
+            reduce_fn,
+            copy.deepcopy(initial),
+            projection,
+            output,
+            batch_size,
+        )
+        for lower, upper in _to_id_ranges(points)
+    ]
+
+    if processes == 0:
+        partials = [_scan_range(task) for task in tasks]
+    else:
+        try:
+            context = multiprocessing.get_context("spawn")
+        except AttributeError:  # pragma: no cover, python2 only has fork
+            context = multiprocessing
+        pool = context.Pool(
+            processes=min(processes, len(tasks)),
+            initializer=_init_worker,
+            initargs=(_get_connection_settings(),),
+        )
+        try:
+            partials = pool.map(_scan_range, tasks, chunksize=1)
+        finally:
+            pool.terminate()
+            pool.join()
+
+    result = partials[0]
+    for partial in partials[1:]:
+        result = combine_fn(result, partial)
+    return result
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+"""
+Lightweight read-only records, a compact alternative of document instance
+for reading large amount of data.
+"""
+
+from collections import OrderedDict
+
+from bson.son import SON
+
+
+class BaseRecord(object):
+    """
+    Base class of the ``__slots__`` record class generated by
+    :func:`make_record_class`. A record only holds the raw BSON value of each
+    field, no change tracking, no validation.
+
+    A field may be named ``keys``, ``values`` or ``items``, which shadows
+    the method of the same name, so the other methods never call them.
+
+    **中文文档**
+
+    由 :func:`make_record_class` 生成的 ``__slots__`` 记录类的基类。记录只保存
+    每个字段的原始 BSON 值, 没有修改追踪, 也没有数据验证, 所以创建的速度很快, 占用
+    的内存很小。
+    """
+    __slots__ = ()
+
+    _document_class = None
+    _fields_ordered = ()
+    _db_fields_ordered = ()
+
+    @classmethod
+    def _from_son(cls, son):
+        """
+        Create a record from raw document returned by pymongo.
+
+        :type son: dict
+        """
+        record = cls.__new__(cls)
+        get = son.get
+        for name, db_field in zip(cls._fields_ordered, cls._db_fields_ordered):
+            setattr(record, name, get(db_field))
+        return record
+
+    def keys(self):
+        """
+        :rtype: List[str]
+        """
+        return list(self._fields_ordered)
+
+    def values(self):
+        """
+        :rtype: list
+        """
+        return [getattr(self, name) for name in self._fields_ordered]
+
+    def items(self):
+        """
+        :rtype: List[Tuple[str, Any]]
+        """
+        return [(name, getattr(self, name)) for name in self._fields_ordered]
+
+    def to_dict(self, include_none=True):
+        """
+        :type include_none: bool
+        :param include_none: if False, None value field will be removed.
+
+        :rtype: Dict[str, Any]
+        """
+        data = dict()
+        for name in self._fields_ordered:
+            value = getattr(self, name)
+            if include_none or (value is not None):
+                data[name] = value
+        return data
+
+    def to_OrderedDict(self, include_none=True):
+        """
+        :type include_none: bool
+        :param include_none: if False, None value field will be removed.
+
+        :rtype: OrderedDict
+        """
+        data = OrderedDict()
+        for name in self._fields_ordered:
+            value = getattr(self, name)
+            if include_none or (value is not None):
+                data[name] = value
+        return data
+
+    def to_son(self):
+        """
+        Convert back to raw document, keyed by db field name.
+
+        :rtype: SON
+        """
+        son = SON()
+        for name, db_field in zip(self._fields_ordered, self._db_fields_ordered):
+            value = getattr(self, name)
+            if value is not None:
+                son[db_field] = value
+        return son
+
+    def to_document(self):
+        """
+        Convert to the document instance, use it when ORM behavior is needed.
+
+        :rtype: mongoengine_mate.ExtendedDocument
+        """
+        return self._document_class._from_son(self.to_son())
+
+    def __eq__(self, other):
+        return (self.__class__ is other.__class__) and all(
+            getattr(self, name) == getattr(other, name)
+            for name in self._fields_ordered
+        )
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        kwargs = list()
+        for attr in self._fields_ordered:
+            kwargs.append("%s=%r" % (attr, getattr(self, attr)))
+        return "%s(%s)" % (self.__class__.__name__, ", ".join(kwargs))
+
+
+def make_record_class(document_class):
+    """
+    Generate a ``__slots__`` record class for a document class.
+
+    :type document_class: Type[mongoengine_mate.ExtendedDocument]
+
+    :rtype: Type[BaseRecord]
+    """
+    fields_ordered = tuple(document_class._fields_ordered)
+    db_fields_ordered = tuple(
+        document_class._fields[name].db_field
+        for name in fields_ordered
+    )
+    return type(
+        str("%sRecord" % document_class.__name__),
+        (BaseRecord,),
+        dict(
+            __slots__=fields_ordered,
+            _document_class=document_class,
+            _fields_ordered=fields_ordered,
+            _db_fields_ordered=db_fields_ordered,
+        ),
+    )
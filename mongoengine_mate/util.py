@@ -1,5 +1,27 @@
 # -*- coding: utf-8 -*-
 
+import uuid
+import decimal
+import datetime
+import hashlib
+import itertools
+from copy import deepcopy
+from collections import OrderedDict
+
+from bson import json_util, ObjectId, Decimal128, Timestamp
+
+#: immutable value types, they are never copied
+atomic_types = (
+    type(None), bool, int, float, complex, str, bytes,
+    datetime.datetime, datetime.date, datetime.time, datetime.timedelta,
+    decimal.Decimal, uuid.UUID,
+    ObjectId, Decimal128, Timestamp,
+)
+try:  # pragma: no cover
+    atomic_types += (unicode, long)
+except NameError:  # pragma: no cover
+    pass
+
 
 def grouper_list(l, n):
     """Evenly divide list into fixed-length piece, no filled value if chunk
@@ -32,3 +54,169 @@ def grouper_list(l, n):
             counter = 0
     if len(chunk) > 0:
         yield chunk
+
+
+def grouper_iterable(iterable, n):
+    """Evenly divide any iterable, including generator, into fixed-length
+    list, the last chunk may be smaller. Only one chunk is held in memory
+    at a time, the iterable is never materialized.
+
+    Example::
+
+        >>> list(grouper_iterable((i for i in range(10)), n=3))
+        [[0, 1, 2], [3, 4, 5], [6, 7, 8], [9]]
+
+    **中文文档**
+
+    将任意可迭代对象 (包括生成器) 按照尺寸n, 依次打包为列表输出。内存中同时只有一个
+    包, 不会将整个可迭代对象读入内存。
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, n))
+        if not chunk:
+            break
+        yield chunk
+
+
+def parallel_imap(func, iterable, workers, max_pending=None):
+    """Apply ``func`` to each item of ``iterable`` in a thread pool, yield
+    the results in completion order. At most ``max_pending`` items are
+    submitted but not yet consumed, so the iterable is pulled lazily and
+    memory stays flat.
+
+    :type workers: int
+    :param workers: number of threads.
+
+    :type max_pending: int
+    :param max_pending: bound of in-flight items, default ``2 * workers``.
+
+    **中文文档**
+
+    使用线程池并行的对每个元素执行 ``func``, 按照完成的顺序返回结果。同时在处理中的
+    元素最多只有 ``max_pending`` 个, 所以可迭代对象是被逐渐读取的, 内存占用保持稳定。
+    """
+    from concurrent.futures import (
+        ThreadPoolExecutor, FIRST_COMPLETED, wait,
+    )
+
+    if max_pending is None:
+        max_pending = 2 * workers
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        for item in iterable:
+            if len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            pending.add(executor.submit(func, item))
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+
+def _canonical_query(query):
+    """Sort the keys of a query document and of the operator documents in
+    it. Embedded document in equality match is kept as it is, because its
+    key order matters in MongoDB.
+    """
+    canonical = OrderedDict()
+    for key in sorted(query):
+        canonical[key] = _canonical_value(key, query[key])
+    return canonical
+
+
+def _canonical_value(key, value):
+    if key in ("$and", "$or", "$nor") and isinstance(value, list):
+        return [
+            _canonical_query(item) if isinstance(item, dict) else item
+            for item in value
+        ]
+    if key == "$elemMatch" and isinstance(value, dict):
+        return _canonical_query(value)
+    if isinstance(value, dict) and value \
+            and all(k.startswith("$") for k in value):  # operator document
+        return _canonical_query(value)
+    return value
+
+
+def canonical_key(*args):
+    """Compute a stable hash of pymongo query arguments. The key order of
+    dict arguments, of the operator documents and of the ``$and`` / ``$or``
+    sub queries doesn't matter. The key order of embedded document in
+    equality match is kept, ``{"a": 1, "b": 2}`` and ``{"b": 2, "a": 1}``
+    match different documents in MongoDB.
+
+    Example::
+
+        >>> canonical_key({"a": 1, "b": 2}) == canonical_key({"b": 2, "a": 1})
+        True
+
+    :rtype: str
+
+    **中文文档**
+
+    计算 pymongo 查询参数的哈希值, 与查询字典和操作符字典中键的顺序无关, 可用作
+    缓存的键。嵌套文档的相等匹配中键的顺序会被保留, 因为在 MongoDB 中键的顺序不同
+    的嵌套文档并不相等。
+    """
+    return hashlib.sha1(
+        json_util.dumps([
+            _canonical_query(arg) if isinstance(arg, dict) else arg
+            for arg in args
+        ]).encode("utf-8")
+    ).hexdigest()
+
+
+def smart_copy(value):
+    """Copy a value for assignment, only copy what is necessary:
+
+    - immutable value, such as int, str, datetime, is returned as it is.
+    - flat list or dict, which only contains immutable value, is copied
+      shallowly.
+    - anything else, such as nested container or embedded document, is
+      deep copied.
+
+    **中文文档**
+
+    只在必要的时候复制数据, 以避免 ``deepcopy`` 的开销: 不可变的值直接返回,
+    只包含不可变值的列表和字典进行浅拷贝, 其他情况才使用 ``deepcopy``。
+    """
+    if isinstance(value, atomic_types):
+        return value
+    if isinstance(value, list):
+        for item in value:
+            if not isinstance(item, atomic_types):
+                return deepcopy(value)
+        return list(value)
+    if isinstance(value, dict):
+        for item in value.values():
+            if not isinstance(item, atomic_types):
+                return deepcopy(value)
+        return dict(value)
+    return deepcopy(value)
+
+
+class StatsTuple(tuple):
+    """
+    A tuple of counters which also carries extra statistics as attributes.
+    It can be unpacked and compared like a plain tuple.
+
+    Example::
+
+        >>> stats = StatsTuple((3, 1), elapsed={"update": 0.01})
+        >>> n_update, n_insert = stats
+        >>> stats.elapsed
+        {'update': 0.01}
+
+    **中文文档**
+
+    一个可以像普通 tuple 一样解包和比较的计数器, 同时以属性的方式携带额外的统计信息。
+    """
+
+    def __new__(cls, counts, **kwargs):
+        self = super(StatsTuple, cls).__new__(cls, counts)
+        self.__dict__.update(kwargs)
+        return self
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from mongoengine_mate.adaptive import InsertTuner
+
+
+def observe_workload(tuner, p, latency, doc_cost, sizes=(1, 10, 100)):
+    for size in sizes * 10:
+        n_dup = int(round(size * p))
+        tuner.observe(size, size, n_dup, latency + doc_cost * size)
+
+
+def test_fit():
+    tuner = InsertTuner()
+    observe_workload(tuner, p=0.1, latency=0.01, doc_cost=0.0001)
+    assert tuner.dup_rate == pytest.approx(0.1, rel=0.1)
+    assert tuner.latency == pytest.approx(0.01)
+    assert tuner.doc_cost == pytest.approx(0.0001)
+
+
+def test_plan():
+    # no observation, or no duplicate, use max batch size
+    tuner = InsertTuner(max_batch_size=500)
+    assert tuner.plan(1000).to_dict() == \
+        dict(strategy="bulk", batch_size=500)
+    assert tuner.plan(20).batch_size == 20
+    observe_workload(tuner, p=0, latency=0.01, doc_cost=0.0001)
+    assert tuner.plan(1000).batch_size == 500
+
+    # rare duplicates, high latency -> large batch
+    sparse = InsertTuner()
+    observe_workload(sparse, p=0.01, latency=0.05, doc_cost=0.00001)
+    # dense duplicates, low latency -> small batch
+    dense = InsertTuner()
+    observe_workload(dense, p=0.5, latency=0.0001, doc_cost=0.001)
+    assert sparse.plan(1000).batch_size > dense.plan(1000).batch_size
+    assert dense.plan(1000).strategy == "one_by_one"
+    assert dense.plan(1000, has_ids=True).strategy == "precheck"
+    assert tuner.plan(1000, has_ids=True).strategy == "bulk"
+
+    info = dense.info()
+    assert info["last_plan"] == dict(strategy="precheck", batch_size=1000)
+    assert info["n_round_trips"] == 30
+
+
+def test_unknown_doc_cost():
+    # same size round trips can't tell the per document cost
+    tuner = InsertTuner()
+    tuner.observe(1000, 1, 1, 0.01)
+    assert tuner.doc_cost == 0
+    assert tuner.plan(999).to_dict() == dict(strategy="one_by_one", batch_size=1)
+    assert tuner.plan(999, has_ids=True).strategy == "precheck"
+
+    tuner = InsertTuner()
+    tuner.observe(1000, 10, 1, 0.01)
+    assert tuner.batch_size(1000) == 10
+
+
+def test_decay_by_documents():
+    tuner = InsertTuner(max_batch_size=1000, decay=0.9)
+    # one batch of 1000 documents, 90% duplicates, stopped at each duplicate
+    for _ in range(900):
+        tuner.observe(1000, 1, 1, 0.001)
+    tuner.observe(100, 100, 0, 0.001)
+    assert tuner.dup_rate == pytest.approx(0.9, rel=0.05)
+
+
+def test_precheck_cost():
+    tuner = InsertTuner()
+    observe_workload(tuner, p=0.1, latency=0.01, doc_cost=0.0001)
+    tuner.observe_precheck(1000, 900, 1.5)
+    # query timing is not in the insert cost fit
+    assert tuner.latency == pytest.approx(0.01)
+    assert tuner.doc_cost == pytest.approx(0.0001)
+    assert tuner.query_cost == pytest.approx(0.0015)
+    assert tuner.info()["query_cost"] == pytest.approx(0.0015)
+    assert tuner.dup_rate > 0.1
+
+
+if __name__ == "__main__":
+    import os
+
+    basename = os.path.basename(__file__)
+    pytest.main([basename, "-s", "--tb=native"])
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+from pytest import raises
+
+import time
+from mongoengine_mate.cache import LRUCache, QueryCache, MISSING
+
+
+def test_lru_cache():
+    cache = LRUCache(max_size=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1  # "a" is recently used
+    cache.set("c", 3)  # evict "b"
+    assert cache.get("b") is MISSING
+    assert "a" in cache
+    assert "c" in cache
+
+    cache.delete("a")
+    assert cache.get("a") is MISSING
+    cache.clear()
+    assert len(cache) == 0
+
+    info = cache.info()
+    assert info["hits"] == 1
+    assert info["misses"] == 2
+    assert info["evictions"] == 1
+    assert info["invalidations"] == 2
+
+
+def test_fifo_cache():
+    cache = LRUCache(max_size=2, policy="fifo")
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)  # evict "a", the first inserted
+    assert cache.get("a") is MISSING
+    assert cache.get("b") == 2
+
+    with raises(ValueError):
+        LRUCache(policy="random")
+
+
+def test_ttl():
+    cache = LRUCache(ttl=0.01)
+    cache.set("a", 1)
+    assert cache.get("a") == 1
+    time.sleep(0.02)
+    assert cache.get("a") is MISSING
+
+
+def test_query_cache():
+    cache = QueryCache(max_size=2)
+    cache.set("q1", [{"_id": 1}, {"_id": 2}])
+    cache.set("q2", [{"_id": 2}, {"_id": 3}])
+    cache.delete_ids([1])
+    assert cache.get("q1") is MISSING
+    assert cache.get("q2") == [{"_id": 2}, {"_id": 3}]
+    assert set(cache._keys_by_id) == {2, 3}
+
+    cache.set("q3", [{"_id": 4}])
+    cache.set("q4", [{"_id": 5}])  # evict "q2"
+    assert set(cache._keys_by_id) == {4, 5}
+
+
+if __name__ == "__main__":
+    import os
+
+    basename = os.path.basename(__file__)
+    pytest.main([basename, "-s", "--tb=native"])
@@ -1,9 +1,12 @@
 # -*- coding: utf-8 -*-
 
 import pytest
+from pytest import raises
 
 import sys
+import random
 from pymongo.database import Database
+from pymongo.errors import BulkWriteError
 import mongoengine
 from mongoengine_mate import ExtendedDocument
 
@@ -49,6 +52,244 @@ def test_query(connect):
     assert User.by_filter({"_id": 2})[:][0].name == "Tom"
 
 
+def test_by_ids(connect):
+    User.objects.delete()
+    User.smart_insert([User(user_id=i, name="u%s" % i) for i in range(1, 11)])
+
+    users = User.by_ids([3, 1, 20, 3, 2], chunk_size=2)
+    assert [user.user_id for user in users] == [3, 1, 3, 2]
+    assert users[0] is users[2]
+
+    users = User.by_ids([3, 20, 1], missing="none")
+    assert [user.user_id if user else None for user in users] == [3, None, 1]
+
+    with raises(User.DoesNotExist):
+        User.by_ids([3, 20, 1], missing="raise")
+
+    users = User.by_ids([1, 2], projection=["user_id"])
+    assert [(user.user_id, user.name) for user in users] == \
+        [(1, None), (2, None)]
+
+    assert User.by_ids([]) == []
+
+
+class Country(ExtendedDocument):
+    code = mongoengine.StringField(primary_key=True)
+    name = mongoengine.StringField()
+    tags = mongoengine.ListField(mongoengine.StringField())
+
+    meta = {
+        "collection": "country_%s" % py_ver,
+        "cache": {"max_size": 100, "ttl": 60},
+    }
+
+
+def test_by_id_cache(connect):
+    assert User.cache_info() is None
+
+    Country.objects.delete()
+    Country.smart_insert([Country(code="US", name="United States")])
+    Country._invalidate_cache()
+
+    assert Country.by_id("US").name == "United States"
+    assert Country.by_id("US").name == "United States"
+    info = Country.cache_info()
+    assert (info["hits"], info["misses"]) == (1, 1)
+
+    with raises(Country.DoesNotExist):
+        Country.by_id("CN")
+
+    # write through smart_update invalidates the cache
+    Country.smart_update(Country(code="US", name="USA"))
+    assert Country.by_id("US").name == "USA"
+
+    # write through save invalidates the cache
+    country = Country.by_id("US")
+    country.name = "America"
+    country.save()
+    assert Country.by_id("US").name == "America"
+
+    # by_ids reads through the cache
+    Country.smart_insert([Country(code="CN", name="China")])
+    assert [c.name for c in Country.by_ids(["US", "CN"])] == ["America", "China"]
+    info = Country.cache_info()
+    assert Country.by_ids(["US", "CN"])
+    assert Country.cache_info()["hits"] == info["hits"] + 2
+
+    # raw and record output don't share nested values with the cache
+    Country.by_ids(["US"], output="raw")[0]["tags"].append("raw")
+    Country.by_ids(["US"], output="record")[0].tags.append("record")
+    assert Country.by_id("US").tags == []
+
+    # delete invalidates the cache
+    Country.by_id("CN").delete()
+    with raises(Country.DoesNotExist):
+        Country.by_id("CN")
+
+
+class Currency(ExtendedDocument):
+    symbol = mongoengine.StringField(unique=True)
+
+    meta = {
+        "collection": "currency_%s" % py_ver,
+        "cache": {},
+    }
+
+
+def test_cache_invalidation_without_id(connect):
+    Currency.objects.delete()
+    Currency(symbol="USD").save()
+    # duplicate on a unique index other than _id, pk stays None
+    n_insert, n_skipped = Currency.smart_insert(
+        [Currency(symbol="USD"), Currency(symbol="CNY")])
+    assert n_insert + n_skipped == 2
+    assert Currency.objects.count() == 2
+
+
+class Contact(ExtendedDocument):
+    _id = mongoengine.IntField(primary_key=True)
+    email = mongoengine.StringField(unique=True)
+
+    meta = {
+        "collection": "contact_%s" % py_ver,
+        "cache": {},
+    }
+
+
+def test_cache_invalidation_on_failed_write(connect):
+    Contact.objects.delete()
+    Contact._invalidate_cache()
+    Contact.smart_insert([Contact(_id=1, email="a"), Contact(_id=2, email="b")])
+    assert Contact.by_id(1).email == "a"
+
+    # the first update is applied before the unique index error
+    for strategy in ["bulk", "one_by_one"]:
+        with raises((BulkWriteError, mongoengine.NotUniqueError)):
+            Contact.smart_update(
+                [Contact(_id=1, email="a2"), Contact(_id=2, email="a2")],
+                strategy=strategy,
+            )
+        assert Contact.by_id(1).email == "a2"
+        Contact.smart_update(Contact(_id=1, email="a"))
+        assert Contact.by_id(1).email == "a"
+
+
+class City(ExtendedDocument):
+    _id = mongoengine.IntField(primary_key=True)
+    name = mongoengine.StringField()
+    country = mongoengine.StringField()
+
+    meta = {
+        "collection": "city_%s" % py_ver,
+        "query_cache": {"max_size": 100, "invalidation": "id"},
+    }
+
+
+def test_by_filter_cached(connect):
+    City.objects.delete()
+    City.smart_insert([
+        City(_id=1, name="New York", country="US"),
+        City(_id=2, name="Beijing", country="CN"),
+        City(_id=3, name="Boston", country="US"),
+    ])
+
+    cities = City.by_filter_cached(
+        {"country": "US", "_id": {"$gte": 1}}, sort=[("_id", 1)])
+    assert [city.name for city in cities] == ["New York", "Boston"]
+
+    # same filter in different key order hits the cache
+    cities = City.by_filter_cached(
+        {"_id": {"$gte": 1}, "country": "US"}, sort=[("_id", 1)])
+    assert [city.name for city in cities] == ["New York", "Boston"]
+    assert City.query_cache_info()["hits"] == 1
+
+    raw = City.by_filter_cached({"country": "CN"}, output="raw")
+    assert raw == [{"_id": 2, "name": "Beijing", "country": "CN"}]
+    # the returned raw document is not the cached one
+    raw[0]["name"] = "Peking"
+    assert City.by_filter_cached({"country": "CN"}, output="raw")[0]["name"] \
+        == "Beijing"
+    raw[0]["name"] = "Beijing"
+
+    # update only invalidates the results containing the document
+    City.smart_update(City(_id=3, name="Chicago"))
+    assert City.by_filter_cached({"country": "CN"}, output="raw") == raw
+    assert City.query_cache_info()["hits"] == 3
+    cities = City.by_filter_cached(
+        {"country": "US", "_id": {"$gte": 1}}, sort=[("_id", 1)])
+    assert [city.name for city in cities] == ["New York", "Chicago"]
+
+    # insert invalidates all results
+    City.smart_insert(City(_id=4, name="Shanghai", country="CN"))
+    assert len(City.by_filter_cached({"country": "CN"})) == 2
+
+    assert [
+        city.name
+        for city in City.by_filter_cached(
+            {}, projection=["name"], sort=[("_id", -1)], limit=2)
+    ] == ["Shanghai", "Chicago"]
+
+    # no query cache
+    assert User.query_cache_info() is None
+    assert User.by_filter_cached({"_id": {"$lt": 0}}) == []
+
+
+def test_iter_by_filter(connect):
+    User.objects.delete()
+    User.smart_insert([User(user_id=i, name="u%s" % i) for i in range(1, 11)])
+
+    records = list(User.iter_by_filter(
+        {"_id": {"$gte": 5}}, sort=[("_id", 1)], limit=3, batch_size=2))
+    assert [record.user_id for record in records] == [5, 6, 7]
+    assert records[0].to_document().name == "u5"
+
+    users = list(User.iter_by_filter(
+        {"_id": 1}, projection=["user_id"], output="document"))
+    assert users[0].to_dict() == {"user_id": 1, "name": None}
+
+    assert list(User.iter_by_filter({"_id": 1}, output="raw")) == \
+        [{"_id": 1, "name": "u1"}]
+
+    records = User.by_ids([2, 1], output="record")
+    assert [record.name for record in records] == ["u2", "u1"]
+
+    with raises(ValueError):
+        list(User.iter_by_filter(output="unknown"))
+
+
+def test_iter_pages(connect):
+    User.objects.delete()
+    User.smart_insert([User(user_id=i, name="u%s" % i) for i in range(1, 11)])
+
+    pages = list(User.iter_pages({"_id": {"$gte": 3}}, page_size=3))
+    assert [[user.user_id for user in users] for users, _ in pages] == \
+        [[3, 4, 5], [6, 7, 8], [9, 10]]
+
+    # resume from token
+    token = pages[0][1]
+    pages = list(User.iter_pages(
+        {"_id": {"$gte": 3}}, page_size=4, token=token, output="raw"))
+    assert [[son["_id"] for son in sons] for sons, _ in pages] == \
+        [[6, 7, 8, 9], [10]]
+
+    # page on non unique field, with null, ties are broken by _id
+    City.objects.delete()
+    City.smart_insert([
+        City(_id=1, name="a", country="US"),
+        City(_id=2, name="b", country="CN"),
+        City(_id=3, name="c"),
+        City(_id=4, name="d", country="US"),
+        City(_id=5, name="e", country="CN"),
+        City(_id=6, name="f"),
+    ])
+    pages = list(City.iter_pages(
+        page_size=2, sort_key="country", projection=["name"], output="record"))
+    assert [[city.name for city in cities] for cities, _ in pages] == \
+        [["c", "f"], ["b", "e"], ["a", "d"]]
+    assert pages[0][0][0].country is None
+    assert list(City.iter_pages(filters={"_id": 100})) == []
+
+
 def test_random_sample(connect):
     User.smart_insert([User(user_id=i) for i in range(100)])
     assert len(User.random_sample(n=3)) == 3
@@ -60,6 +301,100 @@ def test_random_sample(connect):
     for item in Item.random_sample(filters={"_id": {"$gte": 50}}, n=3):
         assert item._id >= 50
 
+    # filter without primary key, projection and output
+    User.objects.delete()
+    User.smart_insert([User(user_id=i, name="u%s" % (i % 2)) for i in range(100)])
+    users = User.random_sample(filters={"name": "u1"}, n=3, projection=["user_id"])
+    assert len(users) == 3
+    for user in users:
+        assert user.user_id % 2 == 1
+        assert user.name is None
+
+    for record in User.random_sample(n=3, output="record"):
+        assert record.name in ("u0", "u1")
+
+    samples = User.iter_random_sample(n=10, output="raw", batch_size=2)
+    assert not isinstance(samples, list)
+    assert len(list(samples)) == 10
+
+
+class Sample(ExtendedDocument):
+    _id = mongoengine.IntField(primary_key=True)
+    group = mongoengine.IntField()
+    rand = mongoengine.FloatField(default=random.random)
+
+    meta = {
+        "collection": "sample_%s" % py_ver,
+        "indexes": ["rand", ],
+        "random_field": "rand",
+    }
+
+
+def test_random_sample_strategy(connect):
+    Sample.objects.delete()
+    Sample.smart_insert([Sample(_id=i, group=i % 3) for i in range(100)])
+
+    for strategy in ["sample", "random_field", "reservoir", "auto"]:
+        samples = Sample.random_sample(n=10, strategy=strategy)
+        assert len(set(sample._id for sample in samples)) == 10
+
+        samples = Sample.random_sample(
+            filters={"group": 1}, n=10, strategy=strategy)
+        assert len(set(sample._id for sample in samples)) == 10
+        for sample in samples:
+            assert sample.group == 1
+
+    # n is larger than the number of matched documents
+    assert len(Sample.random_sample(
+        filters={"group": 1}, n=1000, strategy="random_field")) == 33
+    assert len(Sample.random_sample(
+        filters={"group": 1}, n=1000, strategy="reservoir")) == 33
+
+    # reproducible
+    for strategy in ["random_field", "reservoir", "auto"]:
+        samples1 = Sample.random_sample(n=10, strategy=strategy, seed=1)
+        samples2 = Sample.random_sample(n=10, strategy=strategy, seed=1)
+        assert [s._id for s in samples1] == [s._id for s in samples2]
+
+    # auto chooses $sample from the matched count
+    assert Sample._choose_sample_strategy({"group": 1}, 1, None, "rand") == \
+        "sample"
+    assert Sample._choose_sample_strategy({"group": 1}, 10, None, "rand") == \
+        "random_field"
+    assert Sample._choose_sample_strategy({}, 1, None, None) == "sample"
+    assert Sample._choose_sample_strategy({}, 1, 1, None) == "reservoir"
+
+    with raises(ValueError):
+        Sample.random_sample(n=10, strategy="sample", seed=1)
+    with raises(ValueError):
+        Item.random_sample(n=10, strategy="random_field")
+
+
+def test_stratified_sample(connect):
+    Sample.objects.delete()
+    Sample.smart_insert([Sample(_id=i, group=i % 3) for i in range(100)])
+
+    samples = Sample.random_sample(n=5, stratify_by="group")
+    assert sorted(samples) == [0, 1, 2]
+    for group, sample_list in samples.items():
+        assert len(sample_list) == 5
+        for sample in sample_list:
+            assert sample.group == group
+
+    samples = Sample.stratified_sample(
+        "group",
+        n_per_stratum=50,
+        filters={"_id": {"$lt": 30}},
+        strata=[1, 2, 5],
+        projection=["group"],
+        output="record",
+    )
+    assert list(samples) == [1, 2, 5]
+    assert [len(sample_list) for sample_list in samples.values()] == [10, 10, 0]
+    assert samples[1][0].rand is None
+
+    assert Sample.stratified_sample("group", filters={"_id": -1}) == {}
+
 
 if __name__ == "__main__":
     import os
@@ -55,6 +55,25 @@ def test_to_tuple_list_dict_OrderedDict_json(connect):
     assert user.to_json() == '{"_id": 1, "name": "Jack"}'
 
 
+def test_to_dicts(connect):
+    users = [User(user_id=1, name="Jack"), User(user_id=2)]
+    assert User.to_dicts(users) == [
+        {"user_id": 1, "name": "Jack"},
+        {"user_id": 2, "name": None},
+    ]
+    assert User.to_dicts(users, include_none=False) == [
+        {"user_id": 1, "name": "Jack"},
+        {"user_id": 2},
+    ]
+    assert User.to_dicts([]) == []
+
+    class Tag(ExtendedDocument):
+        name = mongoengine.StringField(primary_key=True)
+
+    assert Tag(name="a").to_dict() == {"name": "a"}
+    assert Tag.to_dicts([Tag(name="a")]) == [{"name": "a"}]
+
+
 def test_absorb(connect):
     user = User(id=1, name="Jack")
     overwritten_data = user.absorb(User(name="Tom"))
@@ -71,6 +90,39 @@ def test_absorb(connect):
         user.absorb(MyClass())
 
 
+class Profile(ExtendedDocument):
+    _id = mongoengine.IntField(primary_key=True)
+    tags = mongoengine.ListField(mongoengine.StringField())
+    history = mongoengine.ListField(mongoengine.DictField())
+
+
+def test_absorb_copy(connect):
+    other = Profile(tags=["a", "b"], history=[{"k": 1}])
+    profile = Profile(_id=1)
+    profile.absorb(other)
+    assert profile.tags == ["a", "b"]
+    assert profile.history == [{"k": 1}]
+    other.tags.append("c")
+    other.history[0]["k"] = 2
+    assert profile.tags == ["a", "b"]
+    assert profile.history == [{"k": 1}]
+
+    profile = Profile(_id=1)
+    history = [{"k": 1}]
+    profile.revise({"history": history}, copy=False)
+    history[0]["k"] = 2
+    assert profile.history == [{"k": 2}]
+
+    docs = [Profile(_id=1), Profile(_id=2)]
+    overwritten_data = Profile.absorb_many(
+        docs, [Profile(tags=["a"]), Profile(tags=["b"])])
+    assert [doc.tags for doc in docs] == [["a"], ["b"]]
+    assert [data["tags"] for data in overwritten_data] == [["a"], ["b"]]
+
+    with raises(ValueError):
+        Profile.absorb_many(docs, [])
+
+
 def test_revise(connect):
     user = User(id=1, name="Jack")
     user_data = {"name": "Tom"}
@@ -82,6 +134,42 @@ def test_revise(connect):
         user.revise([("name", "Tome")])
 
 
+class Cart(ExtendedDocument):
+    id = mongoengine.IntField(primary_key=True)
+    items = mongoengine.ListField(mongoengine.StringField())
+    values = mongoengine.ListField(mongoengine.IntField())
+
+
+def test_record_class(connect):
+    UserRecord = User.record_class()
+    assert User.record_class() is UserRecord
+    assert UserRecord.__slots__ == ("user_id", "name")
+
+    record = UserRecord._from_son({"_id": 1, "name": "Jack"})
+    assert record.user_id == 1
+    assert record.to_dict() == {"user_id": 1, "name": "Jack"}
+    assert record.to_son() == {"_id": 1, "name": "Jack"}
+    assert str(record) == "UserRecord(user_id=1, name='Jack')"
+    assert record == UserRecord._from_son({"_id": 1, "name": "Jack"})
+    with raises(AttributeError):
+        record.age = 30
+
+    user = record.to_document()
+    assert isinstance(user, User)
+    assert user.to_dict() == {"user_id": 1, "name": "Jack"}
+
+    item = Item.record_class()._from_son({"_id": 1})
+    assert item.to_dict(include_none=False) == {"_id": 1}
+
+    # field names shadow the methods
+    cart = Cart.record_class()._from_son({"_id": 1, "items": ["a"]})
+    assert cart.items == ["a"]
+    assert cart.to_dict() == {"id": 1, "items": ["a"], "values": None}
+    assert list(cart.to_OrderedDict(include_none=False)) == ["id", "items"]
+    assert repr(cart) == "CartRecord(id=1, items=['a'], values=None)"
+    assert cart == Cart.record_class()._from_son({"_id": 1, "items": ["a"]})
+
+
 if __name__ == "__main__":
     import os
 
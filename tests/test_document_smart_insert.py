@@ -1,10 +1,13 @@
 # -*- coding: utf-8 -*-
 
 import pytest
+from pytest import raises
 
 import sys
+import random
 from pymongo.database import Database
 import mongoengine
+from bson.son import SON
 from mongoengine_mate import ExtendedDocument
 
 py_ver = "%s.%s" % (sys.version_info.major, sys.version_info.minor)
@@ -79,6 +82,223 @@ def test_smart_insert(connect):
     User.smart_insert(User(id=1))
 
 
+def test_smart_insert_unordered(connect):
+    n_breaker = 5
+    n_total = 120
+
+    User.objects.delete()
+
+    total_user_ids = list(range(1, 1 + n_total))
+    random.shuffle(total_user_ids)
+    breaker_user_ids = total_user_ids[:n_breaker]
+
+    total_users = [User(user_id=_id) for _id in total_user_ids]
+    User.objects.insert([User(user_id=_id) for _id in breaker_user_ids])
+
+    n_insert, n_skipped, failed_indices = User.smart_insert_unordered(total_users)
+    assert n_insert == n_total - n_breaker
+    assert n_skipped == n_breaker
+    assert failed_indices == list(range(n_breaker))
+    assert User.objects.count() == n_total
+
+    # strategy switch returns the same tuple as the recursive strategy
+    User.objects.delete()
+    total_users = [User(user_id=_id) for _id in total_user_ids]
+    User.objects.insert([User(user_id=_id) for _id in breaker_user_ids])
+    assert User.smart_insert(total_users, strategy="unordered") == \
+        (n_total - n_breaker, n_breaker)
+    assert User.objects.count() == n_total
+
+    # single document and empty list
+    assert User.smart_insert(User(user_id=1), strategy="unordered") == (0, 1)
+    assert User.smart_insert_unordered([]) == (0, 0, [])
+
+
+class Post(ExtendedDocument):
+    post_id = mongoengine.IntField(primary_key=True)
+    title = mongoengine.StringField(db_field="t")
+
+    meta = {
+        "collection": "post_%s" % py_ver
+    }
+
+
+def test_smart_insert_raw_dict(connect):
+    for strategy in ["recursive", "unordered"]:
+        Post.objects.delete()
+        Post.objects.insert([Post(post_id=2), Post(post_id=7)])
+
+        data = [dict(post_id=i, title="t%s" % i) for i in range(1, 31)]
+        data[10] = SON([("_id", 11), ("t", "t11")])  # pre-converted
+        n_insert, n_skipped = Post.smart_insert(data, strategy=strategy)
+        assert n_insert + n_skipped == 30
+        if strategy == "unordered":
+            assert (n_insert, n_skipped) == (28, 2)
+        assert Post.objects.count() == 30
+        assert Post.by_id(3).title == "t3"
+        assert Post.by_id(11).title == "t11"
+        assert Post.col().find_one({"_id": 5}) == {"_id": 5, "t": "t5"}
+
+        # single dict, ``id`` is an alias of the primary key
+        assert Post.smart_insert(dict(id=100), strategy=strategy) == (1, 0)
+
+        with raises(mongoengine.FieldDoesNotExist):
+            Post.smart_insert([dict(post_id=200, name="x")], strategy=strategy)
+        assert Post.smart_insert(
+            [dict(post_id=200, name="x")], strategy=strategy, validate=False,
+        ) == (1, 0)
+        assert Post.col().find_one({"_id": 200}) == {"_id": 200, "name": "x"}
+
+
+class Animal(ExtendedDocument):
+    name = mongoengine.StringField()
+    rand = mongoengine.FloatField(default=random.random)
+    tags = mongoengine.ListField(mongoengine.StringField())
+
+    meta = {
+        "collection": "animal_%s" % py_ver,
+        "allow_inheritance": True,
+    }
+
+
+class Dog(Animal):
+    pass
+
+
+def test_smart_insert_raw_dict_default(connect):
+    Animal.objects.delete()
+    Dog.smart_insert([Dog(name="orm")])
+    Dog.smart_insert([dict(name="raw")])
+    for name in ["orm", "raw"]:
+        son = Animal.col().find_one({"name": name})
+        assert sorted(son) == ["_cls", "_id", "name", "rand", "tags"]
+        assert son["_cls"] == "Animal.Dog"
+        assert son["tags"] == []
+    assert Dog.objects.count() == 2
+
+
+def test_smart_insert_stream(connect):
+    for strategy in ["recursive", "unordered"]:
+        Post.objects.delete()
+        Post.objects.insert([Post(post_id=2), Post(post_id=7)])
+
+        def generate():
+            for i in range(1, 26):
+                yield Post(post_id=i)
+
+        stats = list(Post.iter_smart_insert(
+            generate(), chunk_size=10, strategy=strategy))
+        assert len(stats) == 3
+        assert sum(n_insert + n_skipped for n_insert, n_skipped in stats) == 25
+        assert Post.objects.count() == 25
+
+        Post.objects.delete()
+        n_insert, n_skipped = Post.smart_insert_stream(
+            (dict(post_id=i) for i in range(1, 26)),
+            chunk_size=10, strategy="unordered",
+        )
+        assert (n_insert, n_skipped) == (25, 0)
+
+
+def test_smart_insert_workers(connect):
+    for strategy in ["recursive", "unordered"]:
+        Post.objects.delete()
+        Post.objects.insert([Post(post_id=2), Post(post_id=7)])
+
+        data = [Post(post_id=i) for i in range(1, 101)]
+        n_insert, n_skipped = Post.smart_insert(
+            data, strategy=strategy, workers=4, chunk_size=10)
+        assert n_insert + n_skipped == 100
+        assert Post.objects.count() == 100
+
+        Post.objects.delete()
+        stats = list(Post.iter_smart_insert(
+            (dict(post_id=i) for i in range(1, 101)),
+            chunk_size=10, strategy=strategy, workers=4,
+        ))
+        assert len(stats) == 10
+        assert Post.objects.count() == 100
+
+
+def test_smart_insert_adaptive(connect):
+    Post.objects.delete()
+    Post.objects.insert([Post(post_id=i) for i in range(0, 100, 10)])
+
+    data = [Post(post_id=i) for i in range(100)]
+    assert Post.smart_insert(data, strategy="adaptive") == (90, 10)
+    assert Post.objects.count() == 100
+    info = Post.adaptive_insert_info()
+    assert info["dup_rate"] > 0
+    assert info["n_round_trips"] > 1
+
+    # dense duplicates with known _id
+    data = [dict(post_id=i) for i in range(110)]
+    assert Post.smart_insert_adaptive(data) == (10, 100)
+    assert Post.objects.count() == 110
+
+    # a fresh tuner switches to precheck within the first call
+    delattr(Post, "_insert_tuner")
+    Post.objects.delete()
+    Post.objects.insert([Post(post_id=i) for i in range(1000) if i % 10])
+    data = [Post(post_id=i) for i in range(1000)]
+    assert Post.smart_insert_adaptive(data) == (100, 900)
+    info = Post.adaptive_insert_info()
+    assert info["last_plan"]["strategy"] == "precheck"
+    assert info["n_round_trips"] <= 3
+    assert info["dup_rate"] > 0.5
+
+
+def test_smart_insert_dedup(connect):
+    for dedup in ["first", "last"]:
+        Post.objects.delete()
+        Post.objects.insert(Post(post_id=2))
+
+        data = [
+            Post(post_id=1, title="a"),
+            Post(post_id=2, title="b"),
+            Post(post_id=3, title="c"),
+            Post(post_id=1, title="d"),
+            Post(title="e"),
+            Post(post_id=3, title="f"),
+        ]
+        n_insert, n_skipped = stats = Post.smart_insert(data, dedup=dedup)
+        assert n_insert + n_skipped == 4
+        assert stats.n_duplicate == 2
+        expected = "a" if dedup == "first" else "d"
+        assert Post.by_id(1).title == expected
+        assert Post.objects.count() == 4
+
+    Post.objects.delete()
+    data = [dict(post_id=1, title="a"), dict(post_id=1), dict(post_id=2)]
+    stats = Post.smart_insert(data, strategy="unordered", dedup="merge")
+    assert tuple(stats) == (2, 0)
+    assert stats.n_duplicate == 1
+    assert Post.by_id(1).title == "a"
+
+    with raises(ValueError):
+        Post.smart_insert(data, dedup="unknown")
+
+
+class Counter(ExtendedDocument):
+    _id = mongoengine.IntField(primary_key=True)
+    name = mongoengine.StringField()
+    n = mongoengine.IntField(default=0)
+
+    meta = {
+        "collection": "counter_%s" % py_ver
+    }
+
+
+def test_smart_insert_dedup_merge_default(connect):
+    Counter.objects.delete()
+    data = [dict(_id=1, n=5, name="a"), dict(id=1, name="b"), dict(_id=2)]
+    stats = Counter.smart_insert(data, dedup="merge")
+    assert stats.n_duplicate == 1
+    assert data[0] == dict(_id=1, n=5, name="a")
+    assert Counter.by_id(1).to_dict() == {"_id": 1, "n": 5, "name": "b"}
+    assert Counter.by_id(2).n == 0
+
+
 if __name__ == "__main__":
     import os
 
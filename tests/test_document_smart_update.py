@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import pytest
+from pytest import raises
 
 import sys
 import random
@@ -75,6 +76,259 @@ def test_smart_update_correctness(connect):
     ]
 
 
+def test_smart_update_bulk(connect):
+    User.objects.delete()
+    User.objects.insert(User(_id=2, name="Bob", dob="1990-01-01"))
+
+    # upsert = False
+    data = [
+        User(_id=1, name="Alice"),
+        User(_id=2, name="Bryan"),
+        User(_id=3, name="Cathy"),
+    ]
+    assert User.smart_update(data, upsert=False, strategy="bulk") == (1, 0)
+    assert [
+        obj.to_dict()
+        for obj in User.objects()
+    ] == [
+        {"_id": 2, "name": "Bryan", "dob": "1990-01-01"},
+    ]
+
+    # upsert = True, small batch size to use multiple round trips
+    data = [
+        User(_id=1, name="Alice"),
+        User(_id=2, name="Bruce"),
+        User(_id=3, name="Cathy"),
+    ]
+    assert User.smart_update(
+        data, upsert=True, strategy="bulk", batch_size=2) == (1, 2)
+    assert User.objects.count() == 3
+    assert User.objects(_id=2).get().to_dict() == \
+        {"_id": 2, "name": "Bruce", "dob": "1990-01-01"}
+
+    # single document
+    assert User.smart_update(
+        User(_id=4, name="David"), upsert=True, strategy="bulk") == (0, 1)
+    assert User.objects.count() == 4
+
+
+def test_smart_update_precheck(connect):
+    User.objects.delete()
+    User.objects.insert(User(_id=2, name="Bob", dob="1990-01-01"))
+
+    # upsert = False, missing documents are not inserted
+    data = [
+        User(_id=1, name="Alice"),
+        User(_id=2, name="Bryan"),
+        User(_id=3, name="Cathy"),
+    ]
+    assert User.smart_update(data, upsert=False, strategy="precheck") == (1, 0)
+    assert User.objects.count() == 1
+
+    # upsert = True
+    data = [
+        User(_id=1, name="Alice"),
+        User(_id=2, name="Bruce"),
+        User(_id=3, name="Cathy"),
+    ]
+    stats = User.smart_update(
+        data, upsert=True, strategy="precheck", batch_size=2)
+    n_update, n_insert = stats
+    assert (n_update, n_insert) == (1, 2)
+    assert list(stats.elapsed) == ["precheck", "update", "insert"]
+    assert [
+        obj.to_dict()
+        for obj in User.objects().order_by("_id")
+    ] == [
+        {"_id": 1, "name": "Alice", "dob": None},
+        {"_id": 2, "name": "Bruce", "dob": "1990-01-01"},
+        {"_id": 3, "name": "Cathy", "dob": None},
+    ]
+
+
+def test_smart_update_raw_dict(connect):
+    for strategy in ["one_by_one", "bulk", "precheck"]:
+        User.objects.delete()
+        User.objects.insert(User(_id=2, name="Bob", dob="1990-01-01"))
+
+        data = [
+            dict(_id=1, name="Alice"),
+            dict(_id=2, name="Bruce", dob=None),
+            dict(_id=3, name="Cathy"),
+        ]
+        # same counts as the documents
+        assert tuple(User.smart_update(
+            [User(**row) for row in data], upsert=True, strategy=strategy,
+        )) == (1, 2)
+        User.objects.delete()
+        User.objects.insert(User(_id=2, name="Bob", dob="1990-01-01"))
+        assert tuple(
+            User.smart_update(data, upsert=True, strategy=strategy)) == (1, 2)
+        assert [
+            obj.to_dict()
+            for obj in User.objects().order_by("_id")
+        ] == [
+            {"_id": 1, "name": "Alice", "dob": None},
+            {"_id": 2, "name": "Bruce", "dob": "1990-01-01"},
+            {"_id": 3, "name": "Cathy", "dob": None},
+        ]
+
+        User.smart_update(dict(_id=1, dob="2000-01-01"), strategy=strategy)
+        assert User.objects(_id=1).get().dob == "2000-01-01"
+
+        with raises(ValueError):
+            User.smart_update([dict(name="Alice")], strategy=strategy)
+
+
+def test_smart_update_workers(connect):
+    for strategy in ["one_by_one", "bulk", "precheck"]:
+        User.objects.delete()
+        User.smart_insert([User(_id=i, name="Alice") for i in range(0, 50)])
+
+        data = [User(_id=i, name="Bob") for i in range(0, 100)]
+        stats = User.smart_update(
+            data, upsert=True, strategy=strategy, batch_size=10, workers=4)
+        assert User.objects.count() == 100
+        assert User.objects(name="Bob").count() == 100
+        if strategy != "one_by_one":
+            assert tuple(stats) == (50, 50)
+
+
+def test_smart_update_dedup(connect):
+    for strategy in ["one_by_one", "bulk", "precheck"]:
+        User.objects.delete()
+        User.objects.insert(User(_id=1, name="Alice", dob="1990-01-01"))
+
+        data = [
+            User(_id=1, name="Bob"),
+            User(_id=2, name="Cathy"),
+            User(_id=1, dob="2000-01-01"),
+        ]
+        stats = User.smart_update(
+            data, upsert=True, strategy=strategy, dedup="merge")
+        assert stats.n_duplicate == 1
+        assert len(data) == 3
+        assert User.objects(_id=1).get().to_dict() == \
+            {"_id": 1, "name": "Bob", "dob": "2000-01-01"}
+        assert User.objects.count() == 2
+
+        data = [dict(_id=2, name="David"), dict(_id=2, name="Edward")]
+        stats = User.smart_update(data, strategy=strategy, dedup="last")
+        assert stats.n_duplicate == 1
+        assert User.objects(_id=2).get().name == "Edward"
+
+    User.smart_insert([User(_id=i, name="Alice") for i in range(3, 6)])
+    data = [User(_id=i % 3 + 3, name="Bob") for i in range(9)]
+    stats = User.smart_update(data, strategy="changed", dedup="first")
+    assert tuple(stats) == (3, 0)
+    assert stats.n_duplicate == 6
+    assert stats.n_unchanged == 0
+
+
+class Counter(ExtendedDocument):
+    _id = mongoengine.IntField(primary_key=True)
+    name = mongoengine.StringField()
+    n = mongoengine.IntField(default=0)
+
+    meta = {
+        "collection": "counter_%s" % py_ver
+    }
+
+
+def test_smart_update_dedup_merge_default(connect):
+    for strategy in ["one_by_one", "bulk", "precheck"]:
+        Counter.objects.delete()
+        data = [dict(_id=1, n=5, name="a"), dict(_id=1, name="b")]
+        stats = Counter.smart_update(
+            data, upsert=True, strategy=strategy, dedup="merge")
+        assert stats.n_duplicate == 1
+        assert Counter.by_id(1).to_dict() == {"_id": 1, "n": 5, "name": "b"}
+
+
+class Profile(ExtendedDocument):
+    _id = mongoengine.IntField(primary_key=True)
+    name = mongoengine.StringField()
+    age = mongoengine.IntField()
+    tags = mongoengine.ListField(mongoengine.StringField())
+
+    meta = {
+        "collection": "profile_%s" % py_ver
+    }
+
+
+def test_smart_update_changed(connect):
+    Profile.objects.delete()
+    Profile.smart_insert([
+        Profile(_id=i, name="p%s" % i, age=i, tags=["a"]) for i in range(1, 5)
+    ])
+
+    profiles = list(Profile.objects().order_by("_id"))
+    profiles[0].age = 100
+    profiles[1].tags.append("b")
+    profiles[2].name = None
+    data = profiles + [Profile(_id=5, name="p5")]
+
+    stats = Profile.smart_update(
+        data, upsert=True, strategy="changed", batch_size=2)
+    assert tuple(stats) == (3, 1)
+    assert stats.n_unchanged == 1
+    assert [
+        profile.to_mongo().to_dict()
+        for profile in Profile.objects().order_by("_id")
+    ] == [
+        {"_id": 1, "name": "p1", "age": 100, "tags": ["a"]},
+        {"_id": 2, "name": "p2", "age": 2, "tags": ["a", "b"]},
+        {"_id": 3, "age": 3, "tags": ["a"]},
+        {"_id": 4, "name": "p4", "age": 4, "tags": ["a"]},
+        {"_id": 5, "name": "p5", "tags": []},
+    ]
+
+    # changed fields are cleared after update
+    stats = Profile.smart_update(profiles, strategy="changed")
+    assert tuple(stats) == (0, 0)
+    assert stats.n_unchanged == 4
+
+    stats = Profile.smart_update(profiles, strategy="changed", workers=2, batch_size=2)
+    assert stats.n_unchanged == 4
+
+
+class Product(ExtendedDocument):
+    sku = mongoengine.StringField(unique=True)
+    price = mongoengine.IntField()
+    content_hash = mongoengine.StringField()
+
+    meta = {
+        "collection": "product_%s" % py_ver,
+        "hash_field": "content_hash",
+    }
+
+
+def test_smart_sync(connect):
+    Profile.objects.delete()
+
+    data = [Profile(_id=i, name="p%s" % i) for i in range(1, 6)]
+    with raises(ValueError):
+        Profile.smart_sync(data)
+
+    Product.objects.delete()
+    data = [dict(sku="s%s" % i, price=i) for i in range(1, 6)]
+    assert Product.smart_sync(data, key="sku", chunk_size=2) == (5, 0, 0, 0)
+    assert Product.objects.count() == 5
+
+    data = (
+        [dict(sku="s1", price=100)]
+        + [dict(sku="s%s" % i, price=i) for i in range(2, 5)]
+        + [dict(sku="s6", price=6)]
+    )
+    assert Product.smart_sync(
+        iter(data), key="sku", delete=True, chunk_size=2) == (1, 1, 3, 1)
+    assert sorted(
+        (product.sku, product.price) for product in Product.objects()
+    ) == [("s1", 100), ("s2", 2), ("s3", 3), ("s4", 4), ("s6", 6)]
+
+    assert Product.smart_sync(data, key="sku") == (0, 0, 5, 0)
+
+
 def test_smart_update_performance(connect):
     n_total = 100
     n_breaker = 25
@@ -104,6 +358,17 @@ def test_smart_update_performance(connect):
         User.smart_update(total_users, upsert=True, _insert_after_update=True)
     assert User.objects.count() == n_total
 
+    # bulk strategy
+    User.objects.delete()
+    total_users = [User(_id=_id, name="Bob") for _id in total_user_ids]
+    breaker_users = [User(_id=_id, name="Alice") for _id in breaker_user_ids]
+
+    User.smart_insert(breaker_users)
+    assert User.objects.count() == n_breaker
+    with DateTimeTimer(title="bulk"):
+        User.smart_update(total_users, upsert=True, strategy="bulk")
+    assert User.objects.count() == n_total
+
 
 if __name__ == "__main__":
     import os
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+import io
+import sys
+import csv
+import gzip
+from datetime import datetime
+
+import mongoengine
+from bson import json_util
+from mongoengine_mate import ExtendedDocument
+
+py_ver = "%s.%s" % (sys.version_info.major, sys.version_info.minor)
+
+
+class Order(ExtendedDocument):
+    order_id = mongoengine.IntField(primary_key=True)
+    customer = mongoengine.StringField(db_field="cust")
+    items = mongoengine.ListField(mongoengine.StringField())
+    create_at = mongoengine.DateTimeField()
+
+    meta = {
+        "collection": "order_%s" % py_ver
+    }
+
+
+def setup_orders():
+    Order.objects.delete()
+    Order.smart_insert([
+        Order(order_id=1, customer="Alice", items=["a", "b"],
+              create_at=datetime(2020, 1, 1)),
+        Order(order_id=2, customer="Bob"),
+        Order(order_id=3, customer="Cathy", items=["c"]),
+    ])
+
+
+def test_export_jsonl(connect, tmpdir):
+    setup_orders()
+
+    f = io.BytesIO()
+    stats = Order.export_jsonl(f, filters={"_id": {"$lte": 2}}, batch_size=1)
+    assert stats["n_rows"] == 2
+    assert stats["n_bytes"] == len(f.getvalue())
+    rows = [
+        json_util.loads(line)
+        for line in f.getvalue().decode("utf-8").splitlines()
+    ]
+    assert list(rows[0]) == ["order_id", "customer", "items", "create_at"]
+    assert rows[0]["create_at"] == datetime(2020, 1, 1)
+    assert list(rows[1]) == ["order_id", "customer", "items"]
+
+    path = str(tmpdir.join("order.jsonl.gz"))
+    stats = Order.export_jsonl(path, projection=["customer"])
+    assert stats["n_rows"] == 3
+    with gzip.open(path, "rb") as f:
+        lines = f.read().decode("utf-8").splitlines()
+    assert json_util.loads(lines[2]) == {"order_id": 3, "customer": "Cathy"}
+
+
+def test_export_csv(connect, tmpdir):
+    setup_orders()
+
+    path = str(tmpdir.join("order.csv"))
+    stats = Order.export_csv(path)
+    assert stats["n_rows"] == 3
+    with io.open(path, "r", encoding="utf-8", newline="") as f:
+        rows = list(csv.reader(f))
+    assert rows[0] == ["order_id", "customer", "items", "create_at"]
+    assert rows[1] == ["1", "Alice", '["a", "b"]', "2020-01-01T00:00:00"]
+    assert rows[2] == ["2", "Bob", "[]", ""]
+
+    f = io.BytesIO()
+    Order.export_csv(f, projection=["customer"], use_gzip=True)
+    rows = gzip.GzipFile(fileobj=io.BytesIO(f.getvalue())) \
+        .read().decode("utf-8").splitlines()
+    assert rows == ["order_id,customer", "1,Alice", "2,Bob", "3,Cathy"]
+
+
+class Measure(ExtendedDocument):
+    measure_id = mongoengine.IntField(primary_key=True)
+    value = mongoengine.FloatField(db_field="v")
+    count = mongoengine.IntField()
+    valid = mongoengine.BooleanField()
+    name = mongoengine.StringField()
+    create_at = mongoengine.DateTimeField()
+
+    meta = {
+        "collection": "measure_%s" % py_ver
+    }
+
+
+def setup_measures():
+    Measure.objects.delete()
+    Measure.smart_insert([
+        Measure(measure_id=1, value=1.5, count=10, valid=True,
+                name="a", create_at=datetime(2020, 1, 1)),
+        Measure(measure_id=2, value=None, count=None, valid=None),
+        Measure(measure_id=3, value=3.5, count=30, valid=False, name="c"),
+    ])
+
+
+def test_to_columns(connect):
+    setup_measures()
+
+    columns = Measure.to_columns()
+    assert list(columns) == Measure.fields_ordered()
+    assert columns["measure_id"] == [1, 2, 3]
+    assert columns["count"] == [10, None, 30]
+    assert columns["valid"] == [True, None, False]
+    assert columns["name"] == ["a", None, "c"]
+
+    columns = Measure.to_columns(
+        filters={"_id": {"$ne": 2}}, fields=["value", "count"])
+    assert columns == {"value": [1.5, 3.5], "count": [10, 30]}
+
+    with pytest.raises(mongoengine.FieldDoesNotExist):
+        Measure.to_columns(fields=["value", "weight"])
+    with pytest.raises(ValueError):
+        Measure.to_columns(output="xlsx")
+
+
+def test_to_columns_coerce_double(connect):
+    setup_measures()
+    # written by another client, stored as BSON double in int field
+    Measure.col().insert_one({"_id": 4, "count": 40.0, "valid": 1.0})
+
+    columns = Measure.to_columns(fields=["count", "valid"])
+    assert columns["count"] == [10, None, 30, 40]
+    assert columns["valid"] == [True, None, False, True]
+
+    Measure.col().insert_one({"_id": 5, "count": 4.5})
+    with pytest.raises(TypeError) as e:
+        Measure.to_columns(fields=["count"])
+    assert "'count'" in str(e.value)
+
+
+def test_to_columns_optional_output(connect):
+    setup_measures()
+
+    np = pytest.importorskip("numpy")
+    arrays = Measure.to_columns(output="numpy")
+    assert arrays["measure_id"].dtype == np.int64
+    assert arrays["value"].dtype == np.float64
+    assert np.isnan(arrays["value"][1])
+    assert arrays["count"].mask.tolist() == [False, True, False]
+    assert arrays["create_at"].dtype == np.dtype("datetime64[us]")
+
+    pd = pytest.importorskip("pandas")
+    df = Measure.to_columns(output="pandas")
+    assert list(df.columns) == Measure.fields_ordered()
+    assert str(df["count"].dtype) == "Int64"
+    assert str(df["valid"].dtype) == "boolean"
+    assert df["count"].isna().tolist() == [False, True, False]
+
+    pa = pytest.importorskip("pyarrow")
+    table = Measure.to_columns(output="arrow")
+    assert table.column_names == Measure.fields_ordered()
+    assert table.schema.field("count").type == pa.int64()
+    assert table.schema.field("name").type == pa.string()
+    assert table.column("count").null_count == 1
+    assert table.column("value").to_pylist()[1] is None
+
+
+if __name__ == "__main__":
+    import os
+
+    basename = os.path.basename(__file__)
+    pytest.main([basename, "-s", "--tb=native"])
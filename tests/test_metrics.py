@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+import sys
+import logging
+
+import mongoengine
+from mongoengine_mate import ExtendedDocument
+from mongoengine_mate import metrics
+
+py_ver = "%s.%s" % (sys.version_info.major, sys.version_info.minor)
+
+
+class Account(ExtendedDocument):
+    account_id = mongoengine.IntField(primary_key=True)
+    name = mongoengine.StringField()
+
+    meta = {
+        "collection": "account_%s" % py_ver
+    }
+
+
+@pytest.fixture
+def events():
+    events = list()
+    metrics.add_handler(events.append)
+    yield events
+    metrics.clear_handlers()
+
+
+def test_no_handler(connect):
+    assert metrics.is_enabled() is False
+    Account.objects.delete()
+    assert Account.smart_insert([Account(account_id=1)]) == (1, 0)
+
+
+def test_write_events(connect, events):
+    Account.objects.delete()
+    Account.smart_insert([Account(account_id=i) for i in range(0, 100, 10)])
+    del events[:]
+
+    data = [Account(account_id=i, name="a%s" % i) for i in range(100)]
+    Account.smart_insert(data, minimal_size=3)
+    event = events[-1]
+    assert event.operation == "smart_insert"
+    assert event.collection == Account._get_collection_name()
+    assert event.strategy == "recursive"
+    assert event.batch_size == 100
+    assert event.n_insert == 90
+    assert event.round_trips > 1
+    assert event.split_depth >= 1
+    assert event.elapsed > 0
+
+    del events[:]
+    Account.smart_update(data[:10], strategy="bulk", batch_size=4)
+    assert len(events) == 1
+    event = events[0]
+    assert (event.operation, event.strategy) == ("smart_update", "bulk")
+    assert (event.n_update, event.round_trips) == (10, 3)
+
+    # nested call is counted in the outer event
+    del events[:]
+    Account.smart_insert(
+        [Account(account_id=i) for i in range(95, 105)], strategy="unordered")
+    inner, outer = events
+    assert (inner.operation, inner.parent) == \
+        ("smart_insert_unordered", "smart_insert")
+    assert (inner.n_insert, inner.n_skipped, inner.round_trips) == (5, 5, 1)
+    assert outer.parent is None
+    assert (outer.n_insert, outer.n_skipped, outer.round_trips) == (5, 5, 1)
+
+
+def test_worker_events(connect, events):
+    Account.objects.delete()
+    data = [Account(account_id=i) for i in range(100)]
+    Account.smart_insert(data, workers=4, chunk_size=25)
+    outer = events[-1]
+    children = events[:-1]
+    assert (outer.operation, outer.parent) == ("smart_insert", None)
+    assert (outer.n_insert, outer.round_trips) == (100, 4)
+    assert len(children) == 4
+    assert all(event.parent == "smart_insert" for event in children)
+
+    del events[:]
+    Account.smart_update(data, strategy="bulk", batch_size=10, workers=4)
+    outer = events[-1]
+    assert (outer.operation, outer.parent) == ("smart_update", None)
+    assert (outer.n_update, outer.round_trips) == (100, 10)
+    assert len([event for event in events if event.parent is None]) == 1
+
+
+def test_dedup_events(connect, events):
+    Account.objects.delete()
+    data = [Account(account_id=i % 10) for i in range(11)]
+    Account.smart_insert(data, dedup="first")
+    Account.smart_update(data, strategy="bulk", dedup="last")
+    assert [
+        (event.operation, event.n_insert, event.n_update, event.n_duplicate)
+        for event in events
+    ] == [("smart_insert", 10, 0, 1), ("smart_update", 0, 10, 1)]
+
+
+def test_read_events(connect, events):
+    Account.objects.delete()
+    Account.smart_insert([Account(account_id=i) for i in range(10)])
+    del events[:]
+
+    Account.by_id(1)
+    assert (events[-1].operation, events[-1].n_read) == ("by_id", 1)
+
+    with pytest.raises(Account.DoesNotExist):
+        Account.by_id(100)
+    assert events[-1].error == "DoesNotExist"
+
+    Account.by_ids([1, 2, 100], chunk_size=2)
+    event = events[-1]
+    assert (event.batch_size, event.n_read, event.round_trips) == (3, 2, 2)
+
+    pages = Account.iter_pages(page_size=4)
+    next(pages)
+    assert events[-1].operation == "by_ids"  # not emitted until finished
+    list(pages)
+    event = events[-1]
+    assert (event.operation, event.n_read, event.round_trips) == \
+        ("iter_pages", 10, 3)
+
+
+def test_handler_error(connect, events):
+    def broken_handler(event):
+        raise RuntimeError
+
+    metrics.add_handler(broken_handler)
+    Account.objects.delete()
+    assert Account.smart_insert([Account(account_id=1)]) == (1, 0)
+    assert events[-1].n_insert == 1
+
+
+def test_logging_handler(connect, caplog):
+    metrics.add_handler(metrics.LoggingHandler(level=logging.INFO))
+    try:
+        with caplog.at_level(logging.INFO):
+            Account.objects.delete()
+            Account.smart_insert([Account(account_id=1)])
+    finally:
+        metrics.clear_handlers()
+    record = caplog.records[-1]
+    assert record.getMessage().startswith("smart_insert collection=")
+    assert record.mongoengine_mate["n_insert"] == 1
+
+
+def test_prometheus_handler(connect):
+    prometheus_client = pytest.importorskip("prometheus_client")
+    registry = prometheus_client.CollectorRegistry()
+    metrics.add_handler(metrics.PrometheusHandler(registry=registry))
+    try:
+        Account.objects.delete()
+        Account.smart_insert([Account(account_id=1), Account(account_id=2)])
+        # child events of the worker chunks are not counted again
+        Account.smart_insert(
+            [Account(account_id=i) for i in range(10, 20)],
+            workers=2, chunk_size=5,
+        )
+    finally:
+        metrics.clear_handlers()
+    labels = {
+        "operation": "smart_insert",
+        "collection": Account._get_collection_name(),
+    }
+    assert registry.get_sample_value(
+        "mongoengine_mate_operations_total", dict(labels, status="ok")) == 2
+    assert registry.get_sample_value(
+        "mongoengine_mate_round_trips_total", labels) == 3
+    assert registry.get_sample_value(
+        "mongoengine_mate_documents_total",
+        dict(labels, result="inserted")) == 12
+
+
+
+def test_opentelemetry_handler(connect):
+    pytest.importorskip("opentelemetry.sdk")
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+    from opentelemetry.sdk.trace.export.in_memory_span_exporter import \
+        InMemorySpanExporter
+
+    exporter = InMemorySpanExporter()
+    provider = TracerProvider()
+    provider.add_span_processor(SimpleSpanProcessor(exporter))
+    metrics.add_handler(
+        metrics.OpenTelemetryHandler(tracer=provider.get_tracer(__name__)))
+    try:
+        Account.objects.delete()
+        Account.smart_insert([Account(account_id=1)])
+    finally:
+        metrics.clear_handlers()
+    span = exporter.get_finished_spans()[-1]
+    assert span.name == "mongoengine_mate.smart_insert"
+    assert span.attributes["mongoengine_mate.n_insert"] == 1
+    assert span.end_time >= span.start_time
+
+
+if __name__ == "__main__":
+    import os
+
+    basename = os.path.basename(__file__)
+    pytest.main([basename, "-s", "--tb=native"])
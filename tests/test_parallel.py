@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+import sys
+import operator
+
+import mongoengine
+from mongoengine_mate import ExtendedDocument
+from mongoengine_mate import parallel
+
+py_ver = "%s.%s" % (sys.version_info.major, sys.version_info.minor)
+
+
+class Event(ExtendedDocument):
+    event_id = mongoengine.IntField(primary_key=True)
+    kind = mongoengine.StringField()
+    value = mongoengine.IntField()
+
+    meta = {
+        "collection": "event_%s" % py_ver
+    }
+
+
+def get_value(event):
+    return event.value
+
+
+def test_split_points(connect):
+    Event.objects.delete()
+    Event.smart_insert([Event(event_id=i) for i in range(100)])
+
+    points = parallel.split_points(Event, {}, 4, split="sample")
+    assert points == sorted(points)
+    assert 1 <= len(points) <= 3
+    assert parallel.split_points(Event, {"_id": -1}, 4) == []
+    # fall back to sample if $bucketAuto is not supported
+    assert parallel.split_points(Event, {}, 4, split="bucket_auto") == \
+        sorted(parallel.split_points(Event, {}, 4, split="bucket_auto"))
+
+
+def test_parallel_scan(connect):
+    Event.objects.delete()
+    Event.smart_insert([
+        Event(event_id=i, kind="even" if i % 2 == 0 else "odd", value=i)
+        for i in range(100)
+    ])
+
+    total = Event.parallel_scan(
+        fn=get_value, reduce_fn=operator.add, initial=0,
+        partitions=5, processes=0,
+    )
+    assert total == sum(range(100))
+
+    sons = Event.parallel_scan(
+        filters={"kind": "odd", "event_id": {"$lt": 50}},
+        partitions=3, processes=0, projection=["kind"], output="raw",
+    )
+    assert sorted(son["_id"] for son in sons) == list(range(1, 50, 2))
+    assert sons[0].get("value") is None
+
+    assert Event.parallel_scan(
+        filters={"_id": -1}, fn=get_value, reduce_fn=operator.add, initial=0,
+        processes=0,
+    ) == 0
+
+
+def test_parallel_scan_process_pool(connect):
+    Event.objects.delete()
+
+    # tasks are pickled to spawned workers, which import this module and
+    # reconnect with the connection settings of this process
+    assert Event.parallel_scan(
+        fn=get_value, partitions=2, processes=2) == []
+    assert Event.parallel_scan(
+        fn=get_value, reduce_fn=operator.add, initial=0,
+        partitions=2, processes=2,
+    ) == 0
+
+
+if __name__ == "__main__":
+    import os
+
+    basename = os.path.basename(__file__)
+    pytest.main([basename, "-s", "--tb=native"])
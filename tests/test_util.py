@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from datetime import datetime
+from mongoengine_mate import util
+
+
+def test_grouper_iterable():
+    assert list(util.grouper_iterable((i for i in range(10)), 3)) == \
+        [[0, 1, 2], [3, 4, 5], [6, 7, 8], [9]]
+    assert list(util.grouper_iterable([], 3)) == []
+
+
+def test_canonical_key():
+    assert util.canonical_key({"a": 1, "b": {"$gte": 2, "$lt": 3}}) == \
+        util.canonical_key({"b": {"$lt": 3, "$gte": 2}, "a": 1})
+    assert util.canonical_key({"$or": [{"a": 1, "b": 2}]}) == \
+        util.canonical_key({"$or": [{"b": 2, "a": 1}]})
+    assert util.canonical_key({"a": 1}) != util.canonical_key({"a": 2})
+    # embedded document equality depends on the key order
+    assert util.canonical_key({"addr": {"a": 1, "b": 2}}) != \
+        util.canonical_key({"addr": {"b": 2, "a": 1}})
+
+
+def test_smart_copy():
+    value = datetime(2000, 1, 1)
+    assert util.smart_copy(value) is value
+
+    value = [1, "a"]
+    copied = util.smart_copy(value)
+    assert copied == value and copied is not value
+
+    value = {"a": [1, 2]}
+    copied = util.smart_copy(value)
+    assert copied == value and copied["a"] is not value["a"]
+
+
+def test_stats_tuple():
+    stats = util.StatsTuple((1, 2), elapsed={"update": 0.1})
+    n_update, n_insert = stats
+    assert (n_update, n_insert) == (1, 2)
+    assert stats == (1, 2)
+    assert stats.elapsed == {"update": 0.1}
+
+
+if __name__ == "__main__":
+    import os
+
+    basename = os.path.basename(__file__)
+    pytest.main([basename, "-s", "--tb=native"])